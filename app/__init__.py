@@ -1,4 +1,5 @@
 from flask import Flask
+import mysql.connector
 import config
 from flask_bcrypt import Bcrypt
 from flask_cors import CORS
@@ -18,3 +19,20 @@ bcrypt = Bcrypt(app)
 # import the routes so Flask knows about them
 from app import routes
 
+def start_background_tasks():
+    """
+    Starts the optional background jobs. Called once per server process, by
+    run.py for the development server and by app/asgi.py under uvicorn.
+    """
+    from app import crypto, chain, snapshot
+    # creating the side tables and adding the columns an older 'patients' table is missing
+    try:
+        chain.ensure_tables()
+    except mysql.connector.Error as err:
+        print(f"WARNING: couldn't check the database tables: {err}")
+    # pre-warming the OPE cache in the background (only if OPE_CACHE_WARM_RANGE is set)
+    crypto.start_ope_cache_warmup()
+    # re-verifying the hash chain segment by segment (only if CHAIN_VERIFY_INTERVAL is set)
+    chain.start_segment_verifier()
+    # reading back the decrypted-column snapshot (only if SNAPSHOT_FILE is set)
+    snapshot.load_snapshot()
@@ -0,0 +1,24 @@
+from a2wsgi import WSGIMiddleware
+from app import app, start_background_tasks
+
+# ASGI entry point, for serving with uvicorn:
+#
+#   python run.py --asgi
+#   uvicorn app.asgi:asgi_app --port 5000 --workers 4
+#
+# The event loop does the HTTP work (keep-alive, slow clients, streaming
+# /query_all responses) and hands each request to a bounded pool of threads that
+# runs the same Flask routes. So the blocking mysql.connector calls and the
+# crypto stay off the event loop, and no route had to be rewritten. bcrypt and
+# pyope release the loop too: they only ever run on those threads (or on the
+# DECRYPT_WORKERS processes).
+#
+# Keep DB_POOL_SIZE close to ASGI_THREADS, otherwise the extra threads just
+# queue for a database connection.
+
+ASGI_THREADS = app.config.get('ASGI_THREADS', 16)
+
+asgi_app = WSGIMiddleware(app, workers=ASGI_THREADS)
+
+# every uvicorn worker process imports this module once
+start_background_tasks()
@@ -1,8 +1,97 @@
 import jwt
+import time
+import threading
+from collections import OrderedDict
 from functools import wraps
 from flask import request, jsonify
 from app import app, database
 
+
+class PrincipalCache:
+    """
+    A small in-process cache of authenticated users, keyed on user_id.
+    Entries expire after `ttl` seconds and the least recently used entry is
+    evicted once `max_size` is reached.
+    """
+
+    def __init__(self, max_size=1024, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # user_id -> (principal, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._entries[user_id]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, user_id, principal):
+        with self._lock:
+            self._entries[user_id] = (principal, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+principal_cache = PrincipalCache(
+    max_size=app.config.get('PRINCIPAL_CACHE_SIZE', 1024),
+    ttl=app.config.get('PRINCIPAL_CACHE_TTL', 300)
+)
+
+def invalidate_principal(user_id):
+    """
+    Drops a cached user. Call this whenever a user is changed or deleted,
+    otherwise their old group stays valid until the cache entry expires.
+    It only reaches this process: a change made elsewhere (by hand in MySQL, or
+    by another server process) takes up to PRINCIPAL_CACHE_TTL seconds.
+    """
+    principal_cache.invalidate(user_id)
+
+def _load_principal(user_id):
+    """
+    (Private) Looks the user up in the database and keeps only the fields the
+    routes need (never the password hash). Returns None if the user is gone.
+    """
+    with database.db_connection() as cnx:
+        if not cnx:
+            raise ConnectionError("Database connection failed")
+
+        cursor = cnx.cursor(dictionary=True)
+        try:
+            cursor.execute(
+                "SELECT user_id, username, user_group FROM users WHERE user_id = %s",
+                (user_id,)
+            )
+            return cursor.fetchone()
+        finally:
+            cursor.close()
+
 def token_required(f):
     """
     A decorator function to validate JWT tokens and pass user info to the route.
@@ -27,14 +116,17 @@ def token_required(f):
             # decoding the token using our secret key
             data = jwt.decode(token, app.config['JWT_SECRET_KEY'], algorithms=["HS256"])
             
-            # finding the user in the database based on the user_id in the token
-            cnx = database.get_db_connection()
-            if not cnx:
-                return jsonify({"error": "Database connection failed"}), 500
-                
-            cursor = cnx.cursor(dictionary=True)
-            cursor.execute("SELECT * FROM users WHERE user_id = %s", (data['user_id'],))
-            current_user = cursor.fetchone()
+            # finding the user based on the user_id in the token.
+            # hot clients are served from the cache, so only a miss goes to the database
+            current_user = principal_cache.get(data['user_id'])
+            if current_user is None:
+                try:
+                    current_user = _load_principal(data['user_id'])
+                except ConnectionError:
+                    return jsonify({"error": "Database connection failed"}), 500
+
+                if current_user:
+                    principal_cache.put(data['user_id'], current_user)
 
             if not current_user:
                 return jsonify({'message': 'Token is invalid (user not found)!'}), 401
@@ -43,12 +135,6 @@ def token_required(f):
             return jsonify({'message': 'Token has expired! Please log in again.'}), 401
         except jwt.InvalidTokenError:
             return jsonify({'message': 'Token is invalid!'}), 401
-        finally:
-            # we ensure that DB connection is closed even if errors happen
-            if 'cursor' in locals() and cursor:
-                cursor.close()
-            if 'cnx' in locals() and cnx:
-                cnx.close()
 
         # passing the 'current_user' dictionary (containing user_id, username, group)
         # to the guarded function eg., get_all_patients function
@@ -0,0 +1,537 @@
+import hmac
+import time
+import threading
+import mysql.connector
+from app import app, database, crypto, merkle
+
+# Hash chain checkpoints
+#
+# Every CHECKPOINT_INTERVAL rows the writer stores (patient_id, chain_hash) in
+# chain_checkpoints together with an HMAC signature. A reader can then check any
+# window of the chain starting from the nearest signed checkpoint instead of
+# replaying it from GENESIS_HASH.
+
+CHECKPOINT_INTERVAL = app.config.get('CHECKPOINT_INTERVAL', 1000)
+
+CREATE_CHECKPOINTS_TABLE = """
+CREATE TABLE IF NOT EXISTS chain_checkpoints (
+    patient_id INT PRIMARY KEY,
+    chain_hash VARBINARY(32) NOT NULL,
+    signature VARBINARY(32) NOT NULL
+)
+"""
+
+def write_checkpoint(cursor, patient_id, chain_hash):
+    """Stores a signed checkpoint. Runs in the caller's transaction."""
+    cursor.execute(
+        "REPLACE INTO chain_checkpoints (patient_id, chain_hash, signature) VALUES (%s, %s, %s)",
+        (patient_id, chain_hash, crypto.checkpoint_signature(patient_id, chain_hash))
+    )
+
+def maybe_write_checkpoint(cursor, patient_id, chain_hash):
+    """Stores a checkpoint if patient_id falls on CHECKPOINT_INTERVAL."""
+    if CHECKPOINT_INTERVAL and patient_id % CHECKPOINT_INTERVAL == 0:
+        write_checkpoint(cursor, patient_id, chain_hash)
+
+def nearest_checkpoint(cursor, patient_id):
+    """
+    Finds the last trusted checkpoint at or before patient_id.
+    Checkpoints with a bad signature are skipped.
+    Returns: (checkpoint_patient_id, chain_hash), (0, GENESIS_HASH) if there is none
+    """
+    ensure_tables()
+    cursor.execute(
+        "SELECT patient_id, chain_hash, signature FROM chain_checkpoints "
+        "WHERE patient_id <= %s ORDER BY patient_id DESC",
+        (patient_id,)
+    )
+    # checkpoints are ordered newest first, usually the first one is used
+    for row in cursor.fetchall():
+        cp_id, chain_hash, signature = _as_tuple(row)
+        if crypto.verify_checkpoint(cp_id, chain_hash, signature):
+            return cp_id, chain_hash
+        print(f"WARNING: checkpoint at patient_id {cp_id} has a bad signature, skipping it")
+    return 0, crypto.GENESIS_HASH
+
+def chain_hash_at(cursor, patient_id):
+    """
+    Works out the trusted chain_hash of row `patient_id` by replaying the chain
+    from the nearest checkpoint. Only the stored row MACs are hashed (nothing is
+    decrypted), so this costs at most CHECKPOINT_INTERVAL SHA-256 calls.
+    If the Merkle tree covers the row, it is proved from the tree instead, with
+    O(log n) node hashes (see app/merkle.py).
+    Returns: chain_hash, or None if the stored chain doesn't match.
+    """
+    ensure_tables()
+    if merkle.MERKLE_ENABLED:
+        cursor.execute(f"SELECT {merkle.LEAF_COLUMNS} FROM patients WHERE patient_id = %s", (patient_id,))
+        row = cursor.fetchone()
+        proved = merkle.verify_rows(cursor, [row]) if row else None
+        if proved is False:
+            return None
+        if proved:
+            return bytes(_as_tuple(row)[-1])
+
+    cp_id, last_hash = nearest_checkpoint(cursor, patient_id)
+    if cp_id == patient_id:
+        return last_hash
+
+    cursor.execute(
+        "SELECT patient_id, row_mac, chain_hash FROM patients "
+        "WHERE patient_id > %s AND patient_id <= %s ORDER BY patient_id ASC",
+        (cp_id, patient_id)
+    )
+    last_id = cp_id
+    for row in cursor.fetchall():
+        row_id, row_mac, stored_hash = _as_tuple(row)
+        expected = crypto.generate_chain_hash(row_mac, last_hash)
+        if not hmac.compare_digest(expected, stored_hash):
+            return None
+        last_hash, last_id = stored_hash, row_id
+
+    # the row itself must be there, otherwise we only proved a shorter chain
+    if last_id != patient_id:
+        return None
+    return last_hash
+
+def _as_tuple(row):
+    # works for both plain and dictionary cursors
+    return tuple(row.values()) if isinstance(row, dict) else tuple(row)
+
+
+# Appending rows
+#
+# New rows get the next patient_id and are chained onto the current tail in
+# memory, so a batch of any size costs one tail read and one executemany().
+#
+# Two writers must never chain off the same tail, so appends are serialized:
+#   - threads of this process wait on _append_lock
+#   - every process (and host) waits on the row lock of chain_tail, which is
+#     taken with SELECT ... FOR UPDATE and held until the insert commits
+# chain_tail holds the last patient_id and chain_hash, and the new patient_ids
+# are handed out from it rather than by AUTO_INCREMENT.
+
+PATIENT_COLUMNS = (
+    'key_id',
+    'first_name', 'last_name',
+    'gender', 'gender_nonce',
+    'age', 'age_nonce', 'age_ope',
+    'weight', 'height', 'health_history',
+    'gender_bidx', 'first_name_bidx', 'last_name_bidx',
+    'field_macs', 'mac_version', 'row_mac'
+)
+
+INSERT_PATIENT_QUERY = (
+    f"INSERT INTO patients (patient_id, {', '.join(PATIENT_COLUMNS)}, chain_hash) "
+    f"VALUES ({', '.join(['%s'] * (len(PATIENT_COLUMNS) + 2))})"
+)
+
+CREATE_TAIL_TABLE = """
+CREATE TABLE IF NOT EXISTS chain_tail (
+    id TINYINT PRIMARY KEY,
+    patient_id INT NOT NULL,
+    chain_hash VARBINARY(32) NOT NULL
+)
+"""
+
+_append_lock = threading.Lock()
+
+def read_tail(cursor):
+    """
+    Returns: (patient_id, chain_hash) of the last row, (0, GENESIS_HASH) if the table is empty
+    """
+    cursor.execute("SELECT patient_id, chain_hash FROM patients ORDER BY patient_id DESC LIMIT 1")
+    row = cursor.fetchone()
+    return _as_tuple(row) if row else (0, crypto.GENESIS_HASH)
+
+def _lock_tail(cursor):
+    """
+    (Private) Locks the chain_tail row for the rest of the transaction.
+    The row is created from the patients table the first time.
+    Returns: (patient_id, chain_hash) of the current tail
+    """
+    cursor.execute("SELECT patient_id, chain_hash FROM chain_tail WHERE id = 1 FOR UPDATE")
+    row = cursor.fetchone()
+    if row:
+        return _as_tuple(row)
+
+    # if another writer gets here at the same time, INSERT IGNORE keeps its row
+    cursor.execute(
+        "INSERT IGNORE INTO chain_tail (id, patient_id, chain_hash) VALUES (1, %s, %s)",
+        read_tail(cursor)
+    )
+    cursor.execute("SELECT patient_id, chain_hash FROM chain_tail WHERE id = 1 FOR UPDATE")
+    return _as_tuple(cursor.fetchone())
+
+def append_patients(cnx, sealed_rows, before_commit=None):
+    """
+    Appends rows made by crypto.seal_patient() to the end of the hash chain and
+    commits, in a transaction of its own. Safe to call from many threads and
+    processes at once.
+    before_commit(cursor, tail_id, tail_hash) is called right before the commit,
+    so callers can record their own progress in the same transaction.
+    Returns: list of the new patient_ids, in order
+    Raises: mysql.connector.Error (the transaction is rolled back)
+    """
+    ensure_tables()
+
+    with _append_lock:
+        cursor = cnx.cursor()
+        try:
+            tail_id, tail_hash = _lock_tail(cursor)
+            tree = merkle.load_for_append(cursor, tail_id)
+
+            values = []
+            patient_ids = []
+            checkpoints = []
+            nodes = []
+            for sealed in sealed_rows:
+                tail_id += 1
+                # the MACs are bound to the patient_id, which is only known now
+                sealed = crypto.bind_patient_id(sealed, tail_id)
+                tail_hash = crypto.generate_chain_hash(sealed['row_mac'], tail_hash)
+                values.append((tail_id,) + tuple(sealed[col] for col in PATIENT_COLUMNS) + (tail_hash,))
+                patient_ids.append(tail_id)
+                if tree is not None:
+                    nodes.extend(tree.append(merkle.leaf_hash(tail_id, sealed['key_id'], sealed['weight'],
+                                                              sealed['row_mac'], tail_hash)))
+                if CHECKPOINT_INTERVAL and tail_id % CHECKPOINT_INTERVAL == 0:
+                    checkpoints.append((tail_id, tail_hash))
+
+            if values:
+                cursor.executemany(INSERT_PATIENT_QUERY, values)
+            for patient_id, chain_hash in checkpoints:
+                write_checkpoint(cursor, patient_id, chain_hash)
+            if tree is not None and values:
+                merkle.store_nodes(cursor, nodes)
+                merkle.save_state(cursor, tree)
+            cursor.execute(
+                "UPDATE chain_tail SET patient_id = %s, chain_hash = %s WHERE id = 1",
+                (tail_id, tail_hash)
+            )
+            if before_commit:
+                before_commit(cursor, tail_id, tail_hash)
+            cnx.commit()
+            return patient_ids
+
+        except mysql.connector.Error:
+            cnx.rollback()
+            raise
+        finally:
+            cursor.close()
+
+
+# Rewriting the chain
+#
+# A change to how row MACs are made (see scripts/migrate_row_macs.py) changes
+# the chain_hash of every row from the first changed one to the tail.
+# rebuild_chain() does that in one transaction while holding the chain_tail
+# lock, so writers wait and readers keep seeing the old, consistent chain until
+# the commit. It only hashes, nothing is decrypted, so do the expensive part
+# (anything that needs the plaintext) before calling it.
+#
+# The Merkle tree is rebuilt with it: the old rows must give the signed root,
+# then the new ones are signed. A rebuild from after_id 0 starts a new tree if
+# there is none yet (that is all scripts/build_merkle_tree.py does).
+#
+# Tables from before chain_tail can have gaps in their patient_ids (rolled back
+# or deleted AUTO_INCREMENT inserts). The chain links over a gap like over any
+# other row, so the rebuild follows the ids that exist. A leaf of the tree is a
+# patient_id though, so such a table can't get a tree: a rebuild that only
+# rewrites columns goes on without one, a tree build raises IdGaps.
+
+class ChainBroken(Exception):
+    """The stored chain doesn't verify, so it must not be rebuilt."""
+
+class IdGaps(Exception):
+    """The patient_ids have gaps, so the Merkle tree can't cover the table. This is not tampering."""
+
+
+def _trees_for_rebuild(cursor, after_id, tail_id):
+    """
+    (Private) Returns: (signed Frontier or None, Frontier of the old rows, Frontier of the new rows),
+    both at after_id, or (None, None, None) if the tree isn't kept
+    """
+    if not merkle.MERKLE_ENABLED:
+        return None, None, None
+    try:
+        signed = merkle.load_state(cursor)
+    except merkle.TreeBroken as e:
+        print(f"WARNING: {e}")
+        signed = None
+    if signed is not None and signed.count != tail_id:
+        signed = None
+
+    if after_id == 0:
+        return signed, merkle.Frontier(), merkle.Frontier()
+    if signed is None:
+        print("WARNING: the Merkle tree doesn't cover the table, not updating it. Run scripts/build_merkle_tree.py")
+        return None, None, None
+    old_tree = merkle.frontier_at(cursor, after_id)
+    if old_tree is None:
+        raise ChainBroken(f"merkle nodes before patient_id {after_id + 1} are missing")
+    return signed, old_tree, old_tree.copy()
+
+def _missing_ids(cursor, after_id, tail_id):
+    """(Private) Returns: how many patient_ids in (after_id, tail_id] have no row"""
+    cursor.execute("SELECT COUNT(*) AS n FROM patients WHERE patient_id > %s AND patient_id <= %s",
+                   (after_id, tail_id))
+    return (tail_id - after_id) - _as_tuple(cursor.fetchone())[0]
+
+def rebuild_chain(cnx, columns, reseal, after_id=0, batch_size=1000):
+    """
+    Rewrites `columns` (which must include 'row_mac', or be empty to only
+    rebuild the Merkle tree) of every row after after_id and chains the new row
+    MACs on from the trusted chain_hash of after_id. reseal(row) gets the stored
+    row (a dictionary) and returns the new values of `columns`, in order. The old
+    chain is checked link by link on the way, a tampered chain raises ChainBroken
+    instead of being sealed again. Checkpoints after after_id are written again.
+    Returns: number of rows rewritten
+    Raises: ChainBroken, IdGaps (only when building a tree, `columns` empty),
+            mysql.connector.Error or whatever reseal() raises (the transaction is rolled back)
+    """
+    ensure_tables()
+    if columns:
+        mac_index = columns.index('row_mac')
+        update = (f"UPDATE patients SET {', '.join(f'{column} = %s' for column in columns)}, chain_hash = %s "
+                  f"WHERE patient_id = %s")
+
+    with _append_lock:
+        cursor = cnx.cursor(dictionary=True)
+        try:
+            tail_id, tail_hash = _lock_tail(cursor)
+            old_hash = chain_hash_at(cursor, after_id) if after_id else crypto.GENESIS_HASH
+            if old_hash is None:
+                raise ChainBroken(f"chain does not reach patient_id {after_id} from its checkpoint")
+            new_hash = old_hash
+            signed, old_tree, new_tree = _trees_for_rebuild(cursor, after_id, tail_id)
+            if new_tree is not None and signed is None:
+                # a new tree, which needs one row per patient_id. (with a signed tree
+                # the ids had no gaps, so a missing row now breaks the chain below)
+                missing = _missing_ids(cursor, after_id, tail_id)
+                if missing and not columns:
+                    raise IdGaps(f"{missing} patient_ids up to {tail_id} have no row, "
+                                 "the Merkle tree needs one row per patient_id")
+                if missing:
+                    print(f"WARNING: {missing} patient_ids up to {tail_id} have no row, "
+                          "not building a Merkle tree for this table")
+                    old_tree = new_tree = None
+            cursor.execute("DELETE FROM chain_checkpoints WHERE patient_id > %s", (after_id,))
+
+            last_id = after_id
+            rewritten = 0
+            while last_id < tail_id:
+                cursor.execute(
+                    "SELECT * FROM patients WHERE patient_id > %s AND patient_id <= %s ORDER BY patient_id ASC LIMIT %s",
+                    (last_id, tail_id, batch_size)
+                )
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+
+                values = []
+                nodes = []
+                for row in rows:
+                    # an id gap is only allowed without a tree, the link is checked either way
+                    if (new_tree is not None and row['patient_id'] != last_id + 1) or not hmac.compare_digest(
+                            crypto.generate_chain_hash(row['row_mac'], old_hash), row['chain_hash']):
+                        raise ChainBroken(f"chain broken at patient_id {row['patient_id']}")
+                    old_hash = row['chain_hash']
+                    last_id = row['patient_id']
+
+                    new_row = row
+                    if columns:
+                        new_values = tuple(reseal(row))
+                        new_hash = crypto.generate_chain_hash(new_values[mac_index], new_hash)
+                        values.append(new_values + (new_hash, last_id))
+                        new_row = dict(row, **dict(zip(columns, new_values)), chain_hash=new_hash)
+                    else:
+                        new_hash = old_hash
+                    if CHECKPOINT_INTERVAL and last_id % CHECKPOINT_INTERVAL == 0:
+                        write_checkpoint(cursor, last_id, new_hash)
+                    if new_tree is not None:
+                        old_tree.append(merkle.row_leaf(row))
+                        nodes.extend(new_tree.append(merkle.row_leaf(new_row)))
+
+                if values:
+                    cursor.executemany(update, values)
+                merkle.store_nodes(cursor, nodes)
+                rewritten += len(values)
+
+            if last_id != tail_id or not hmac.compare_digest(old_hash, tail_hash):
+                raise ChainBroken(f"chain ends at patient_id {last_id}, the tail is at {tail_id}")
+            if signed is not None and not hmac.compare_digest(old_tree.root(), signed.root()):
+                raise ChainBroken("the rows don't match the signed Merkle root")
+            if new_tree is not None:
+                merkle.save_state(cursor, new_tree)
+            cursor.execute("UPDATE chain_tail SET chain_hash = %s WHERE id = 1", (new_hash,))
+            cnx.commit()
+            return rewritten
+
+        except Exception:
+            # including whatever reseal() raises
+            cnx.rollback()
+            raise
+        finally:
+            cursor.close()
+
+# Columns added to 'patients' after the first release, as (column, type, index or None).
+# ensure_tables() adds the missing ones, so an existing table keeps working after
+# an upgrade. Filling them in for the old rows is left to the scripts (see README).
+PATIENT_UPGRADES = (
+    ('age_ope', 'BIGINT', 'idx_patients_age'),
+    ('gender_bidx', 'VARBINARY(16)', 'idx_patients_gender'),
+    ('first_name_bidx', 'VARBINARY(16)', 'idx_patients_first_name'),
+    ('last_name_bidx', 'VARBINARY(16)', 'idx_patients_last_name'),
+    ('field_macs', f"VARBINARY({len(crypto.MAC_FIELDS) * crypto.FIELD_MAC_BYTES})", None),
+    ('mac_version', 'TINYINT', None),
+    # rows without one are key 1
+    ('key_id', 'TINYINT', None),
+)
+
+def _patient_columns(cursor):
+    """Returns: the column names of 'patients', or None if there is no such table yet"""
+    try:
+        cursor.execute("SELECT * FROM patients LIMIT 0")
+        cursor.fetchall()
+    except mysql.connector.Error:
+        # populate_db.py creates it with every column
+        return None
+    return {column[0] for column in cursor.description}
+
+def upgrade_patients_table(cursor):
+    """
+    Adds any missing PATIENT_UPGRADES column (and its index) to 'patients'.
+    Returns: list of the columns added
+    """
+    existing = _patient_columns(cursor)
+    if existing is None:
+        return []
+
+    added = []
+    for column, column_type, index in PATIENT_UPGRADES:
+        if column in existing:
+            continue
+        print(f"Adding column '{column}' to 'patients'...")
+        try:
+            cursor.execute(f"ALTER TABLE patients ADD COLUMN {column} {column_type}")
+        except mysql.connector.Error:
+            # another process may have added it just now
+            if column not in (_patient_columns(cursor) or ()):
+                raise
+            continue
+        if index:
+            cursor.execute(f"CREATE INDEX {index} ON patients ({column})")
+        added.append(column)
+    return added
+
+_tables_ready = False
+
+def ensure_tables():
+    """
+    Creates the side tables this module needs if they don't exist yet and adds
+    any missing column to 'patients', once per process. It uses its own
+    connection because CREATE TABLE and ALTER TABLE commit implicitly.
+    """
+    global _tables_ready
+    if _tables_ready:
+        return
+
+    with database.db_connection() as cnx:
+        if not cnx:
+            raise mysql.connector.errors.InterfaceError(msg="Database connection failed")
+        cursor = cnx.cursor()
+        try:
+            cursor.execute(CREATE_CHECKPOINTS_TABLE)
+            cursor.execute(CREATE_TAIL_TABLE)
+            cursor.execute(merkle.CREATE_NODES_TABLE)
+            cursor.execute(merkle.CREATE_STATE_TABLE)
+            upgrade_patients_table(cursor)
+            cnx.commit()
+        finally:
+            cursor.close()
+    _tables_ready = True
+
+
+# Segment re-verification
+#
+# A segment is the run of rows between two checkpoints. verify_segments() fully
+# decrypts and verifies every segment and checks that it ends exactly on the next
+# signed checkpoint. It is meant to run in the background (see
+# start_segment_verifier) or from scripts/verify_chain.py.
+
+def verify_segments():
+    """
+    Re-verifies the whole table segment by segment.
+    Returns: list of (start_id, end_id, problem) for every bad segment.
+    """
+    problems = []
+    ensure_tables()
+    with database.db_connection() as cnx:
+        if not cnx:
+            return [(None, None, "Database connection failed")]
+
+        cursor = cnx.cursor(dictionary=True)
+        try:
+            cursor.execute(
+                "SELECT patient_id, chain_hash, signature FROM chain_checkpoints ORDER BY patient_id ASC"
+            )
+            checkpoints = cursor.fetchall()
+            cursor.execute("SELECT MAX(patient_id) AS last_id FROM patients")
+            last_id = cursor.fetchone()['last_id'] or 0
+
+            start_id, start_hash = 0, crypto.GENESIS_HASH
+            # the rows after the last checkpoint form an open segment
+            ends = [(cp['patient_id'], cp) for cp in checkpoints] + [(last_id, None)]
+
+            for end_id, cp in ends:
+                if end_id <= start_id:
+                    continue
+                if cp and not crypto.verify_checkpoint(cp['patient_id'], cp['chain_hash'], cp['signature']):
+                    problems.append((start_id, end_id, "bad checkpoint signature"))
+                    continue
+
+                cursor.execute(
+                    "SELECT * FROM patients WHERE patient_id > %s AND patient_id <= %s ORDER BY patient_id ASC",
+                    (start_id, end_id)
+                )
+                batch = crypto.process_rows(cursor.fetchall(), verify_chain=True, previous_hash=start_hash)
+
+                if batch.chain_broken_at is not None:
+                    problems.append((start_id, end_id, f"chain broken at patient_id {batch.chain_broken_at}"))
+                elif batch.failures:
+                    problems.append((start_id, end_id, f"{len(batch.failures)} rows failed verification"))
+                elif cp and not hmac.compare_digest(batch.last_hash, cp['chain_hash']):
+                    problems.append((start_id, end_id, "segment does not end on its checkpoint"))
+
+                # the next segment starts from the signed hash, not from what we computed
+                if cp:
+                    start_id, start_hash = cp['patient_id'], cp['chain_hash']
+                else:
+                    start_id, start_hash = end_id, batch.last_hash
+
+        except mysql.connector.Error as err:
+            problems.append((None, None, f"Database query failed: {err}"))
+        finally:
+            cursor.close()
+
+    return problems
+
+def start_segment_verifier():
+    """
+    Runs verify_segments() every CHAIN_VERIFY_INTERVAL seconds on a background
+    thread. Does nothing if CHAIN_VERIFY_INTERVAL is not set in config.py.
+    """
+    interval = app.config.get('CHAIN_VERIFY_INTERVAL')
+    if not interval:
+        return None
+
+    def run():
+        while True:
+            time.sleep(interval)
+            for start_id, end_id, problem in verify_segments():
+                print(f"FATAL: chain segment ({start_id}, {end_id}] failed re-verification: {problem}")
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
@@ -1,47 +1,135 @@
 import os
 import hmac
+import sys
+import json
+import time
+import struct
+import atexit
 import hashlib
+import threading
+import unicodedata
+import multiprocessing
+from array import array
+from bisect import bisect_left
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from app import app # importing 'app' to get config keys
-from pyope.ope import OPE
+from app import metrics
+from pyope.ope import OPE, ValueRange
+
+
+# Key versions
+#
+# Every row stores the key_id of the keys it was sealed with (NULL for rows
+# written before key ids existed, which is key 1). KEYRING in config.py maps
+# more key ids to their keys:
+#
+#   KEYRING = {2: {'ENCRYPTION_KEY': ..., 'HMAC_KEY': ..., 'OPE_KEY': ...}}
+#   CURRENT_KEY_ID = 2
+#
+# The keys at the top of config.py are key 1. New rows are sealed with
+# CURRENT_KEY_ID (default: the highest key id), reads use whatever key_id the
+# row has, and app/rotation.py moves old rows over. Local files (OPE cache, OPE
+# table, snapshot) and the cursor and checkpoint signatures use the current keys.
+
+
+class KeySet:
+    """The AES, HMAC and OPE keys of one key version, and what is derived from them."""
+
+    def __init__(self, key_id, keys):
+        self.key_id = key_id
+        self.aes_key = keys['ENCRYPTION_KEY']
+        self.hmac_key = keys['HMAC_KEY']
+        self.ope_key = keys['OPE_KEY']
+
+        # AESGCM objects hold no per-message state, so one instance is shared by every call
+        # instead of building a new one per field
+        self.aesgcm = AESGCM(self.aes_key)
+        # keyed HMAC state, copied for every row instead of re-keying each time
+        self.hmac_base = hmac.new(self.hmac_key, digestmod=hashlib.sha256)
+        self.ope = OPE(self.ope_key)
+
+        # see "Searchable age", "Blind indexes" and "Per-field MACs" below
+        self.age_ope_key = keys.get('AGE_OPE_KEY') or hmac.new(self.ope_key, b'age-ope', hashlib.sha256).digest()
+        self.blind_index_key = (keys.get('BLIND_INDEX_KEY')
+                                or hmac.new(self.hmac_key, b'blind-index', hashlib.sha256).digest())
+        self.field_mac_key = hmac.new(self.hmac_key, b'field-mac', hashlib.sha256).digest()
+        # digest_size is FIELD_MAC_BYTES
+        self.field_mac_base = hashlib.blake2s(key=self.field_mac_key, digest_size=16, person=b'field')
+        self.fields_row_mac_base = hashlib.blake2s(key=self.field_mac_key, digest_size=32, person=b'row')
+        self.age_ope_table = None  # built on first use
 
 
 # i am loading keys from config
+_keyring_config = dict(app.config.get('KEYRING') or {})
+if 1 not in _keyring_config:
+    try:
+        _keyring_config[1] = {name: app.config[name] for name in ('ENCRYPTION_KEY', 'HMAC_KEY', 'OPE_KEY')}
+    except KeyError:
+        raise RuntimeError("ENCRYPTION_KEY, HMAC_KEY or OPE_KEY not set in config.py")
+    for name in ('AGE_OPE_KEY', 'BLIND_INDEX_KEY'):
+        if app.config.get(name):
+            _keyring_config[1][name] = app.config[name]
+
+# key_id is a TINYINT column (and the weight index keeps it in a signed byte)
+KEY_ID_MAX = 127
+for _key_id in _keyring_config:
+    if not isinstance(_key_id, int) or not 1 <= _key_id <= KEY_ID_MAX:
+        raise RuntimeError(f"KEYRING key id {_key_id!r} must be an int from 1 to {KEY_ID_MAX}")
+
 try:
-    AES_KEY = app.config['ENCRYPTION_KEY']
-    HMAC_KEY = app.config['HMAC_KEY']
-    OPE_KEY = app.config['OPE_KEY']
-except KeyError:
-    raise RuntimeError("ENCRYPTION_KEY or HMAC_KEY not set in config.py")
+    keyring = {key_id: KeySet(key_id, keys) for key_id, keys in _keyring_config.items()}
+except KeyError as e:
+    raise RuntimeError(f"KEYRING entry is missing {e} in config.py")
+
+CURRENT_KEY_ID = app.config.get('CURRENT_KEY_ID', max(keyring))
+if CURRENT_KEY_ID not in keyring:
+    raise RuntimeError(f"CURRENT_KEY_ID {CURRENT_KEY_ID} is not in KEYRING")
+# every key id there may be rows for, in order
+KEY_IDS = tuple(sorted(keyring))
+
+def get_keys(key_id=None):
+    """Returns: the KeySet of key_id (None: the current keys). Raises KeyError for a key_id not in the keyring"""
+    return keyring[CURRENT_KEY_ID if key_id is None else key_id]
+
+def row_key_id(row):
+    """Returns: the key_id a `patients` row was sealed with"""
+    return row.get('key_id') or 1
+
+_current_keys = get_keys()
+AES_KEY = _current_keys.aes_key
+HMAC_KEY = _current_keys.hmac_key
+OPE_KEY = _current_keys.ope_key
+_aesgcm = _current_keys.aesgcm
+_hmac_base = _current_keys.hmac_base
 
 # Confidentiality (AES-GCM)
 
-def encrypt_field(data):
+def encrypt_field(data, key_id=None):
     """
-    Encrypts a single piece of data (like age or gender).
+    Encrypts a single piece of data (like age or gender), with the keys of
+    key_id (default: the current keys).
     Returns: (ciphertext, nonce) as bytes.
     """
     # Converting data to bytes. str() handles int, bool, etc.
     plaintext = str(data).encode('utf-8')
     
-    # getting the AES-GCM cipher object
-    aesgcm = AESGCM(AES_KEY)
-    
     # generating a unique 12-byte nonce
     nonce = os.urandom(12)
     
     # encrypting
-    ciphertext = aesgcm.encrypt(nonce, plaintext, None) # 'None' is is for noassociated data
+    ciphertext = get_keys(key_id).aesgcm.encrypt(nonce, plaintext, None) # 'None' is is for noassociated data
     
     return ciphertext, nonce
 
-def decrypt_field(ciphertext, nonce, original_type):
+def decrypt_field(ciphertext, nonce, original_type, key_id=None):
     """
     Decrypts a single piece of data and casts it back to its original type.
     """
     try:
-        aesgcm = AESGCM(AES_KEY)
-        plaintext_bytes = aesgcm.decrypt(nonce, ciphertext, None)
+        plaintext_bytes = get_keys(key_id).aesgcm.decrypt(nonce, ciphertext, None)
         
         # decoding from bytes back to string
         plaintext_str = plaintext_bytes.decode('utf-8')
@@ -59,37 +147,351 @@ def decrypt_field(ciphertext, nonce, original_type):
         return None
 
 OPE_PRECISION = 100
-ope_cipher = None
+# the OPE cipher of the current keys
+ope_cipher = _current_keys.ope
 
-try:
-    # Initialize the OPE cipher
-    ope_cipher = OPE(app.config['OPE_KEY'])
-except KeyError:
-     raise RuntimeError("OPE_KEY not set in config.py")
+def _key_aad(aad):
+    # (Private) binds a local file to the current key_id. Key 1 files keep the AAD they always had
+    return aad if CURRENT_KEY_ID == 1 else aad + b'|key' + str(CURRENT_KEY_ID).encode('utf-8')
+
+# files are sealed with ENCRYPTION_KEY, this ties the OPE mappings in them to OPE_KEY too
+_OPE_KEY_FINGERPRINT = hmac.new(OPE_KEY, b'ope-key-fingerprint', hashlib.sha256).hexdigest()[:16].encode('utf-8')
+
+def _ope_key_aad(aad):
+    # (Private) _key_aad() plus the OPE key fingerprint, a file made with another OPE_KEY fails to decrypt
+    return _key_aad(aad) + b'|ope-key:' + _OPE_KEY_FINGERPRINT
 
-def ope_encrypt(data_float):
-    if not ope_cipher: return None
+class OPECache:
+    """
+    Bounded, thread-safe two-way cache of OPE results (plaintext int <-> ciphertext).
+    pyope costs milliseconds per call, while weights come from a small set of
+    2-decimal values that repeat across rows and query bounds.
+    The least recently used pair is evicted once max_size is reached.
+    """
+
+    def __init__(self, max_size=50000):
+        self.max_size = max_size
+        self._by_plain = OrderedDict()  # plaintext int -> ciphertext, in LRU order
+        self._by_cipher = {}            # ciphertext -> plaintext int
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_cipher(self, data_int):
+        with self._lock:
+            ciphertext = self._by_plain.get(data_int)
+            if ciphertext is None:
+                self.misses += 1
+                return None
+            self._by_plain.move_to_end(data_int)
+            self.hits += 1
+            return ciphertext
+
+    def get_plain(self, ciphertext):
+        with self._lock:
+            data_int = self._by_cipher.get(ciphertext)
+            if data_int is None:
+                self.misses += 1
+                return None
+            self._by_plain.move_to_end(data_int)
+            self.hits += 1
+            return data_int
+
+    def put(self, data_int, ciphertext):
+        with self._lock:
+            self._by_plain[data_int] = ciphertext
+            self._by_plain.move_to_end(data_int)
+            self._by_cipher[ciphertext] = data_int
+            while len(self._by_plain) > self.max_size:
+                _, old_ciphertext = self._by_plain.popitem(last=False)
+                del self._by_cipher[old_ciphertext]
+
+    def items(self):
+        with self._lock:
+            return list(self._by_plain.items())
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._by_plain),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+    def save(self, path):
+        """
+        Writes the cache to `path`, AES-GCM encrypted, since the plaintext/ciphertext
+        pairs would otherwise give the OPE mapping away. The file is bound to
+        OPE_KEY, so pairs made with another OPE key are never loaded.
+        """
+        payload = json.dumps(self.items()).encode('utf-8')
+        nonce = os.urandom(12)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(nonce + _aesgcm.encrypt(nonce, payload, _ope_key_aad(b'ope-cache')))
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        """Loads pairs written by save(). Returns the number of pairs loaded."""
+        with open(path, 'rb') as f:
+            blob = f.read()
+        payload = _aesgcm.decrypt(blob[:12], blob[12:], _ope_key_aad(b'ope-cache'))
+        pairs = json.loads(payload.decode('utf-8'))
+        for data_int, ciphertext in pairs:
+            self.put(data_int, ciphertext)
+        return len(pairs)
+
+
+# the cache of the current keys, the other key versions get one each on first use
+ope_cache = OPECache(max_size=app.config.get('OPE_CACHE_SIZE', 50000))
+_other_ope_caches = {}
+_other_ope_caches_lock = threading.Lock()
+
+def _ope_cache_for(key_id):
+    if key_id is None or key_id == CURRENT_KEY_ID:
+        return ope_cache
+    with _other_ope_caches_lock:
+        cache = _other_ope_caches.get(key_id)
+        if cache is None:
+            cache = _other_ope_caches[key_id] = OPECache(max_size=ope_cache.max_size)
+        return cache
+
+# optional local file the cache is kept in between restarts
+OPE_CACHE_FILE = app.config.get('OPE_CACHE_FILE')
+
+def _is_main_process():
+    # decrypt workers (see process_rows) must not write the cache file
+    return multiprocessing.parent_process() is None
+
+def save_ope_cache():
+    """Writes the OPE cache to OPE_CACHE_FILE, if one is configured."""
+    if not OPE_CACHE_FILE or not _is_main_process():
+        return
+    try:
+        ope_cache.save(OPE_CACHE_FILE)
+    except OSError as e:
+        print(f"WARNING: could not save OPE cache: {e}")
+
+if OPE_CACHE_FILE and os.path.exists(OPE_CACHE_FILE):
+    try:
+        ope_cache.load(OPE_CACHE_FILE)
+    except Exception as e:
+        # wrong key or a damaged file, we just start with an empty cache
+        print(f"WARNING: could not load OPE cache from {OPE_CACHE_FILE}: {e}")
+
+atexit.register(save_ope_cache)
+
+def warm_ope_cache(min_value, max_value):
+    """
+    Encrypts every value in [min_value, max_value] (at OPE_PRECISION) that is not
+    cached yet, so later encryptions and decryptions in that domain are lookups.
+    Values the OPE table already covers are skipped.
+    """
+    start = int(round(min_value * OPE_PRECISION))
+    end = int(round(max_value * OPE_PRECISION))
+    table = get_ope_table()
+    for data_int in range(start, end + 1):
+        if table is not None and table.encrypt(data_int) is not None:
+            continue
+        if ope_cache.get_cipher(data_int) is None:
+            ope_cache.put(data_int, ope_cipher.encrypt(data_int))
+    save_ope_cache()
+
+def start_ope_cache_warmup():
+    """
+    Starts warm_ope_cache() on a background thread for the OPE_CACHE_WARM_RANGE
+    weight domain in config.py, eg. (30.0, 250.0). Does nothing if it is not set.
+    """
+    warm_range = app.config.get('OPE_CACHE_WARM_RANGE')
+    if not warm_range:
+        return None
+    thread = threading.Thread(target=warm_ope_cache, args=tuple(warm_range), daemon=True)
+    thread.start()
+    return thread
+
+# OPE table
+#
+# The OPE plaintext domain is small (pyope's default is 0..32767, ie. weights
+# 0.00 to 327.67), so the ciphertext of every value can be computed once ahead
+# of time (scripts/build_ope_table.py). OPE keeps order, so the ciphertexts of
+# consecutive plaintexts form a sorted array: encryption is an index lookup and
+# decryption a binary search, no pyope call at all.
+#
+# The file gives the OPE mapping away just like the cache file would, so it is
+# AES-GCM encrypted as well. It is read on first use.
+
+OPE_TABLE_FILE = app.config.get('OPE_TABLE_FILE')
+
+_OPE_TABLE_MAGIC = b'DSPOPET1'
+
+
+class OPETable:
+    """
+    Ciphertexts of the plaintext ints start, start+1, ... in a compact array
+    (4 bytes per value, since pyope ciphertexts are below 2**31).
+    """
+
+    def __init__(self, start, ciphertexts):
+        self.start = start
+        self.ciphertexts = ciphertexts
+
+    def __len__(self):
+        return len(self.ciphertexts)
+
+    def encrypt(self, data_int):
+        """Returns: the ciphertext of data_int, or None if it is outside the table"""
+        i = data_int - self.start
+        if 0 <= i < len(self.ciphertexts):
+            return self.ciphertexts[i]
+        return None
+
+    def decrypt(self, ciphertext):
+        """Returns: the plaintext int of ciphertext, or None if it isn't in the table"""
+        i = bisect_left(self.ciphertexts, ciphertext)
+        if i < len(self.ciphertexts) and self.ciphertexts[i] == ciphertext:
+            return self.start + i
+        return None
+
+    @staticmethod
+    def _aad(start, count):
+        # binds the array to its position in the domain, and to the OPE key it was built with
+        return _ope_key_aad(b'ope-table|' + str(start).encode('utf-8') + b'|' + str(count).encode('utf-8'))
+
+    def save(self, path):
+        """Writes the table to `path`: magic, start, count, nonce, then the AES-GCM encrypted array."""
+        data = array('I', self.ciphertexts)
+        if sys.byteorder == 'big':
+            data.byteswap()  # the file is always little-endian
+        nonce = os.urandom(12)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(_OPE_TABLE_MAGIC + struct.pack('<II', self.start, len(self)) + nonce)
+            f.write(_aesgcm.encrypt(nonce, data.tobytes(), self._aad(self.start, len(self))))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Reads a table written by save(). Raises on a wrong key or a damaged file."""
+        with open(path, 'rb') as f:
+            blob = f.read()
+        if blob[:len(_OPE_TABLE_MAGIC)] != _OPE_TABLE_MAGIC:
+            raise ValueError("not an OPE table file")
+        offset = len(_OPE_TABLE_MAGIC)
+        start, count = struct.unpack('<II', blob[offset:offset + 8])
+        nonce = blob[offset + 8:offset + 20]
+
+        ciphertexts = array('I')
+        ciphertexts.frombytes(_aesgcm.decrypt(nonce, blob[offset + 20:], cls._aad(start, count)))
+        if sys.byteorder == 'big':
+            ciphertexts.byteswap()
+        if len(ciphertexts) != count:
+            raise ValueError("OPE table has the wrong length")
+        return cls(start, ciphertexts)
+
+
+def _ope_encrypt_range(start, end):
+    """(Private) Worker entry point, pyope ciphertexts of start..end-1."""
+    return [ope_cipher.encrypt(data_int) for data_int in range(start, end)]
+
+def build_ope_table(start=None, end=None, workers=0, chunk_size=1000):
+    """
+    Encrypts every plaintext int in [start, end] (default: pyope's whole input
+    range) with pyope, on `workers` processes if given.
+    Returns: OPETable
+    """
+    start = ope_cipher.in_range.start if start is None else start
+    end = ope_cipher.in_range.end if end is None else end
+    bounds = [(i, min(i + chunk_size, end + 1)) for i in range(start, end + 1, chunk_size)]
+
+    ciphertexts = array('I')
+    if workers:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            for chunk in executor.map(_ope_encrypt_range, *zip(*bounds)):
+                ciphertexts.extend(chunk)
+    else:
+        for chunk_start, chunk_end in bounds:
+            ciphertexts.extend(_ope_encrypt_range(chunk_start, chunk_end))
+    return OPETable(start, ciphertexts)
+
+_ope_table = None
+_ope_table_loaded = False
+_ope_table_lock = threading.Lock()
+
+def get_ope_table():
+    """Returns: the OPETable from OPE_TABLE_FILE (read on the first call), or None"""
+    global _ope_table, _ope_table_loaded
+    if _ope_table_loaded:
+        return _ope_table
+    with _ope_table_lock:
+        if not _ope_table_loaded:
+            if OPE_TABLE_FILE and os.path.exists(OPE_TABLE_FILE):
+                try:
+                    _ope_table = OPETable.load(OPE_TABLE_FILE)
+                except Exception as e:
+                    # wrong key or a damaged file, the cache and pyope still work
+                    print(f"WARNING: could not load OPE table from {OPE_TABLE_FILE}: {e}")
+            elif OPE_TABLE_FILE:
+                print(f"WARNING: OPE table {OPE_TABLE_FILE} not found, run scripts/build_ope_table.py")
+            _ope_table_loaded = True
+    return _ope_table
+
+def ope_table_stats():
+    table = get_ope_table()
+    if table is None:
+        return {'loaded': False}
+    return {
+        'loaded': True,
+        'start': table.start,
+        'size': len(table),
+        'bytes': len(table) * table.ciphertexts.itemsize,
+    }
+
+def ope_encrypt(data_float, key_id=None):
     """
     Encrypts a float using OPE by first converting it to a precision integer.
+    key_id picks the OPE key (default: the current one).
     """
     try:
         # convert float (eg., 68.5) to int (eg., 6850)
         # data_int = int(data_float * OPE_PRECISION)
         data_int = int(round(data_float * OPE_PRECISION))
-        
-        # encrypt the integer
-        return ope_cipher.encrypt(data_int)
+
+        # the precomputed table has it, if there is one (it is for the current key)
+        current = key_id is None or key_id == CURRENT_KEY_ID
+        table = get_ope_table() if current else None
+        if table is not None:
+            ciphertext = table.encrypt(data_int)
+            if ciphertext is not None:
+                return ciphertext
+
+        # encrypt the integer, repeated values come from the cache
+        cache = _ope_cache_for(key_id)
+        ciphertext = cache.get_cipher(data_int)
+        if ciphertext is None:
+            ciphertext = get_keys(key_id).ope.encrypt(data_int)
+            cache.put(data_int, ciphertext)
+        return ciphertext
     except Exception as e:
         print(f"OPE Encryption Error: {e}")
         return None
 
-def ope_decrypt(data_ciphertext):
+def ope_decrypt(data_ciphertext, key_id=None):
     """
     Decrypts an OPE-encrypted integer back to a float.
     """
     try:
-        # decrypt the large integer
-        data_int = ope_cipher.decrypt(data_ciphertext)
+        # the precomputed table first, then the cache
+        current = key_id is None or key_id == CURRENT_KEY_ID
+        table = get_ope_table() if current else None
+        data_int = table.decrypt(data_ciphertext) if table is not None else None
+        cache = _ope_cache_for(key_id)
+        if data_int is None:
+            data_int = cache.get_plain(data_ciphertext)
+        if data_int is None:
+            data_int = get_keys(key_id).ope.decrypt(data_ciphertext)
+            cache.put(data_int, data_ciphertext)
         
         # convert int (eg., 6850) back to float (eg., 68.5)
         return float(data_int) / OPE_PRECISION
@@ -97,6 +499,64 @@ def ope_decrypt(data_ciphertext):
         print(f"OPE Decryption Error: {e}")
         return None
 
+# Searchable age
+#
+# age itself stays randomized AES-GCM. Next to it, age_ope holds an OPE
+# ciphertext of the age so MySQL can filter age ranges (indexed) before
+# anything is decrypted. It uses its own key, derived from OPE_KEY unless
+# AGE_OPE_KEY is set, so age and weight ciphertexts can't be compared with
+# each other. Like weight, it reveals the order of the ages to the database.
+# The domain is tiny, so all AGE_OPE_MAX + 1 ciphertexts are kept in an
+# OPETable built on first use (one per key version).
+
+AGE_OPE_MAX = 150
+AGE_OPE_KEY = _current_keys.age_ope_key
+
+def _get_age_ope_table(key_id=None):
+    keys = get_keys(key_id)
+    if keys.age_ope_table is None:
+        # about 0.2 s, two threads building it at once just do it twice
+        cipher = OPE(keys.age_ope_key, in_range=ValueRange(0, AGE_OPE_MAX))
+        keys.age_ope_table = OPETable(0, array('I', (cipher.encrypt(age) for age in range(AGE_OPE_MAX + 1))))
+    return keys.age_ope_table
+
+def age_ope_encrypt(age, key_id=None):
+    """Returns: the age_ope ciphertext of `age`, or None if it is not a whole number in 0..AGE_OPE_MAX"""
+    try:
+        age = int(age)
+    except (TypeError, ValueError):
+        return None
+    return _get_age_ope_table(key_id).encrypt(age)
+
+# Blind indexes
+#
+# For exact-match lookups, gender and the normalized first and last name are
+# also stored as keyed HMAC tokens (gender_bidx, first_name_bidx,
+# last_name_bidx), indexed in MySQL. Equal values give equal tokens, so a
+# lookup is an index probe, but without BLIND_INDEX_KEY a token can't be tied
+# to a value. The field name is part of the HMAC input, so tokens of different
+# fields never match. Tokens do reveal which rows share a value (for gender,
+# that splits the table in two).
+
+BLIND_INDEX_FIELDS = ('gender', 'first_name', 'last_name')
+BLIND_INDEX_BYTES = 16
+BLIND_INDEX_KEY = _current_keys.blind_index_key
+
+def normalize_name(name):
+    """Case, Unicode form and extra whitespace don't matter for name lookups."""
+    return " ".join(unicodedata.normalize('NFKC', name).casefold().split())
+
+def blind_index(field, value, key_id=None):
+    """Returns: the blind index token (bytes) of `value` for `field`, or None if value is None"""
+    if value is None:
+        return None
+    if field == 'gender':
+        text = 'true' if value else 'false'
+    else:
+        text = normalize_name(str(value))
+    message = field.encode('utf-8') + b'|' + text.encode('utf-8')
+    return hmac.new(get_keys(key_id).blind_index_key, message, hashlib.sha256).digest()[:BLIND_INDEX_BYTES]
+
 # Integrity (HMAC-SHA256) 
 
 def _get_row_string(first, last, gender, age, weight, height, history):
@@ -106,7 +566,7 @@ def _get_row_string(first, last, gender, age, weight, height, history):
     """
     return f"{first}|{last}|{gender}|{age}|{weight}|{height}|{history}"
 
-def generate_row_mac(first, last, gender, age, weight, height, history):
+def generate_row_mac(first, last, gender, age, weight, height, history, key_id=None):
     """
     Generates a new HMAC (tamper-proof seal) for a row of data.
     """
@@ -114,26 +574,77 @@ def generate_row_mac(first, last, gender, age, weight, height, history):
     row_string = _get_row_string(first, last, gender, age, weight, height, history)
     
     # creating the HMAC-SHA256
-    mac = hmac.new(
-        HMAC_KEY,
-        msg=row_string.encode('utf-8'),
-        digestmod=hashlib.sha256
-    ).digest() # this .digest() returns bytes
+    mac = get_keys(key_id).hmac_base.copy()
+    mac.update(row_string.encode('utf-8'))
+    mac = mac.digest() # this .digest() returns bytes
     
     return mac
 
-def verify_row_mac(first, last, gender, age, weight, height, history, mac_to_check):
+def verify_row_mac(first, last, gender, age, weight, height, history, mac_to_check, key_id=None):
     """
     Verifies if a received HMAC is valid for a row of data.
     Returns: True or False
     """
     # Re-generate the HMAC from the plaintext data we have
-    calculated_mac = generate_row_mac(first, last, gender, age, weight, height, history)
+    calculated_mac = generate_row_mac(first, last, gender, age, weight, height, history, key_id)
     
     # comparing the two MACs securely.
     # hmac.compare_digest prevents timing attacks.
     return hmac.compare_digest(calculated_mac, mac_to_check)
 
+# Per-field MACs (mac_version 2)
+#
+# generate_row_mac() seals all seven fields at once, so checking any one of them
+# means decrypting all of them. Rows written now get a MAC per field instead,
+# each bound to the row's patient_id, and a row MAC over those field MACs:
+#
+#   field_macs = MAC(first_name) || MAC(last_name) || ... || MAC(health_history)
+#   row_mac    = HMAC(patient_id, field_macs)
+#
+# The hash chain links row_mac as before. A projected read (see process_rows
+# fields=) checks row_mac against the stored field_macs, which costs no
+# decryption, and then only the MACs of the fields it decrypted.
+# Rows with mac_version NULL or 1 still use the single MAC above, see
+# scripts/migrate_row_macs.py to move them over.
+#
+# A full read checks seven field MACs instead of one row MAC, so the MACs here
+# are keyed BLAKE2s (a single C call each) rather than HMAC-SHA256 objects,
+# with a key derived from HMAC_KEY. Field and row MACs use different BLAKE2
+# personalizations so one can never pass for the other. The keyed states are
+# made once per key version (KeySet.field_mac_base, fields_row_mac_base).
+
+MAC_VERSION = 2
+MAC_FIELDS = ('first_name', 'last_name', 'gender', 'age', 'weight', 'height', 'health_history')
+FIELD_MAC_BYTES = 16
+# where each field's MAC sits in field_macs
+_FIELD_MAC_OFFSETS = {field: i * FIELD_MAC_BYTES for i, field in enumerate(MAC_FIELDS)}
+
+def generate_field_mac(field, patient_id, value, key_id=None):
+    """Returns: the MAC of one plaintext field of row patient_id"""
+    mac = get_keys(key_id).field_mac_base.copy()
+    mac.update(f"{field}|{patient_id}|{value}".encode('utf-8'))
+    return mac.digest()
+
+def generate_field_macs(patient_id, values, key_id=None):
+    """
+    values are the seven plaintext fields in MAC_FIELDS order.
+    Returns: the field MACs of the row, concatenated in MAC_FIELDS order
+    """
+    # generate_field_mac() inlined, this runs seven times per row on a full read
+    base = get_keys(key_id).field_mac_base
+    macs = []
+    for field, value in zip(MAC_FIELDS, values):
+        mac = base.copy()
+        mac.update(f"{field}|{patient_id}|{value}".encode('utf-8'))
+        macs.append(mac.digest())
+    return b''.join(macs)
+
+def generate_fields_row_mac(patient_id, field_macs, key_id=None):
+    """Returns: the row MAC of a mac_version 2 row, over its concatenated field MACs"""
+    mac = get_keys(key_id).fields_row_mac_base.copy()
+    mac.update(f"{patient_id}|".encode('utf-8') + field_macs)
+    return mac.digest()
+
 # This is starting point for the chain
 # it is just 32 empty bytes for SHA-256
 GENESIS_HASH = b'\x00' * 32
@@ -152,4 +663,415 @@ def generate_chain_hash(current_data_hash, previous_chain_hash):
     # hashing the result to create the new chain link
     new_chain_hash = hashlib.sha256(combined_hash).digest()
     
-    return new_chain_hash
\ No newline at end of file
+    return new_chain_hash
+
+# Sealing new rows
+
+def seal_patient(first, last, gender, age, weight, height, history, key_id=None):
+    """
+    Encrypts one patient and generates its integrity seal, with the keys of
+    key_id (default: the current keys).
+    weight and height must already be rounded to 2 decimals.
+    Returns: dict of `patients` column values, or None if the weight could not
+             be encrypted. patient_id, the MACs and chain_hash are filled in by
+             bind_patient_id() once chain.append_patients() hands out the id.
+    """
+    if key_id is None:
+        key_id = CURRENT_KEY_ID
+
+    # 1. Encrypt Standard Fields
+    gender_ct, gender_nonce = encrypt_field(gender, key_id)
+    age_ct, age_nonce = encrypt_field(age, key_id)
+
+    # 2. Encrypt Weight (OPE)
+    encrypted_weight = ope_encrypt(weight, key_id) if weight is not None else None
+    if weight is not None and encrypted_weight is None:
+        return None
+
+    return {
+        'key_id': key_id,
+        'first_name': first, 'last_name': last,
+        'gender': gender_ct, 'gender_nonce': gender_nonce,
+        'age': age_ct, 'age_nonce': age_nonce,
+        'age_ope': age_ope_encrypt(age, key_id),
+        'gender_bidx': blind_index('gender', gender, key_id),
+        'first_name_bidx': blind_index('first_name', first, key_id),
+        'last_name_bidx': blind_index('last_name', last, key_id),
+        'weight': encrypted_weight, 'height': height,
+        'health_history': history,
+        # the plaintext the MACs are made from, never stored
+        'mac_values': (first, last, gender, age, weight, height, history),
+    }
+
+def bind_patient_id(sealed, patient_id):
+    """
+    Generates the integrity seal of a row from seal_patient() now that its
+    patient_id is known. Returns: the row with field_macs, row_mac and mac_version
+    """
+    key_id = sealed['key_id']
+    field_macs = generate_field_macs(patient_id, sealed['mac_values'], key_id)
+    return dict(sealed, field_macs=field_macs, mac_version=MAC_VERSION,
+                row_mac=generate_fields_row_mac(patient_id, field_macs, key_id))
+
+def reseal_row(row, key_id=None):
+    """
+    Decrypts and verifies a stored `patients` row and seals it again with the
+    keys of key_id (default: the current keys), under the same patient_id.
+    Used by the key rotation job (app/rotation.py).
+    Returns: (sealed row, None) or (None, failure_reason). The sealed row has
+             every column but chain_hash.
+    """
+    plain, _, reason = _open_row(row)
+    if reason:
+        return None, reason
+    sealed = seal_patient(plain['first_name'], plain['last_name'], plain['gender'], plain['age'],
+                          plain['weight'], plain['height'], plain['health_history'], key_id)
+    if sealed is None:
+        return None, 'weight could not be encrypted'
+    sealed = bind_patient_id(sealed, row['patient_id'])
+    del sealed['mac_values']
+    sealed['patient_id'] = row['patient_id']
+    return sealed, None
+
+# Page cursors
+#
+# A cursor is handed out after a page has been verified and marks where the
+# next page starts: "<patient_id>.<chain_hash hex>.<signature hex>".
+# It is signed so a client can't point it at a chain_hash of its own choosing.
+# Cursors are signed with the current keys and accepted from any key in the
+# keyring, so the ones handed out just before a key change keep working. Their
+# chain_hash is stale once the key switch rebuilds the chain, the listing then
+# re-anchors on the row's trusted chain_hash (see routes._get_patient_page).
+
+def _cursor_signature(patient_id, chain_hash, key_id=None):
+    mac = get_keys(key_id).hmac_base.copy()
+    mac.update(f"cursor|{patient_id}|{chain_hash.hex()}".encode('utf-8'))
+    return mac.hexdigest()
+
+def sign_cursor(patient_id, chain_hash):
+    """Creates a signed page cursor for a verified row."""
+    return f"{patient_id}.{chain_hash.hex()}.{_cursor_signature(patient_id, chain_hash)}"
+
+def open_cursor(token):
+    """
+    Checks a page cursor made by sign_cursor().
+    Returns: (patient_id, chain_hash) or None if the token is invalid.
+    """
+    try:
+        patient_id, chain_hex, signature = token.split('.')
+        patient_id = int(patient_id)
+        chain_hash = bytes.fromhex(chain_hex)
+    except (ValueError, AttributeError):
+        return None
+
+    if not any(hmac.compare_digest(signature, _cursor_signature(patient_id, chain_hash, key_id))
+               for key_id in KEY_IDS):
+        return None
+    return patient_id, chain_hash
+
+# Chain checkpoints
+
+def checkpoint_signature(patient_id, chain_hash, key_id=None):
+    """
+    Signs a (patient_id, chain_hash) checkpoint of the hash chain.
+    Unlike the chain itself this is keyed, so the database can't forge one.
+    """
+    mac = get_keys(key_id).hmac_base.copy()
+    mac.update(f"checkpoint|{patient_id}|".encode('utf-8') + chain_hash)
+    return mac.digest()
+
+def verify_checkpoint(patient_id, chain_hash, signature):
+    """Returns True if the checkpoint was signed by checkpoint_signature(), with any key in the keyring."""
+    return any(hmac.compare_digest(checkpoint_signature(patient_id, chain_hash, key_id), signature)
+               for key_id in KEY_IDS)
+
+# Merkle roots (see app/merkle.py)
+
+def merkle_root_signature(leaf_count, root, key_id=None):
+    """Signs the root of the Merkle tree over the first leaf_count rows, so the database can't forge one."""
+    mac = get_keys(key_id).hmac_base.copy()
+    mac.update(f"merkle|{leaf_count}|".encode('utf-8') + root)
+    return mac.digest()
+
+def verify_merkle_root(leaf_count, root, signature):
+    """Returns True if the root was signed by merkle_root_signature(), with any key in the keyring."""
+    return any(hmac.compare_digest(merkle_root_signature(leaf_count, root, key_id), signature)
+               for key_id in KEY_IDS)
+
+# Batch row processing
+
+# result of process_rows()
+#   rows: decrypted and verified rows, in the order they came in
+#   failures: (patient_id, reason) for every row that was dropped
+#   last_hash: chain_hash of the last verified row
+#   chain_broken_at: patient_id where the hash chain broke, or None
+RowBatch = namedtuple('RowBatch', ['rows', 'failures', 'last_hash', 'chain_broken_at'])
+
+# columns that only matter for verification and are never returned
+_SEAL_COLUMNS = ('key_id', 'gender_nonce', 'age_nonce', 'age_ope', 'gender_bidx', 'first_name_bidx',
+                 'last_name_bidx', 'field_macs', 'mac_version', 'row_mac', 'chain_hash')
+
+# optional parallel decryption, see process_rows()
+# 0 workers keeps everything on the request thread
+DECRYPT_WORKERS = app.config.get('DECRYPT_WORKERS', 0)
+# result sets smaller than this are always decrypted serially
+DECRYPT_PARALLEL_MIN_ROWS = app.config.get('DECRYPT_PARALLEL_MIN_ROWS', 2000)
+# number of rows sent to a worker at a time
+DECRYPT_CHUNK_SIZE = app.config.get('DECRYPT_CHUNK_SIZE', 500)
+
+_decrypt_executor = None
+_decrypt_executor_lock = threading.Lock()
+
+def _open_row(row, known_values=None, timings=None, fields=None):
+    """
+    (Private) Decrypts one row and checks its integrity seal.
+    known_values is an optional (gender, age, weight) already decrypted earlier
+    (eg., from a snapshot). It is only used if the row MAC agrees with it.
+    timings, if given, is a [aes, ope, hmac] list of seconds to add to.
+    fields, if given, is the MAC_FIELDS to return (next to patient_id). On a
+    mac_version 2 row only those are decrypted and checked.
+    Returns: (plaintext_row, row_mac, None) or (None, None, failure_reason)
+    """
+    key_id = row_key_id(row)
+    if key_id not in keyring:
+        return None, None, f'unknown key_id {key_id}'
+    if (row.get('mac_version') or 1) >= 2:
+        return _open_row_v2(row, key_id, known_values, timings, fields)
+
+    plain, row_mac, reason = _open_row_v1(row, key_id, known_values, timings)
+    if plain is None or fields is None:
+        return plain, row_mac, reason
+    return {'patient_id': plain['patient_id'], **{field: plain[field] for field in fields}}, row_mac, None
+
+def _decrypt_values(row, key_id, known_values, timings, wanted):
+    """
+    (Private) Decrypts whichever of gender, age and weight are in `wanted`, with the keys of key_id.
+    Returns: dict of field -> value (None where decryption failed)
+    """
+    if known_values is not None:
+        gender, age, weight = known_values
+        return {'gender': gender, 'age': age, 'weight': weight}
+
+    values = {}
+    start = time.perf_counter()
+    if 'gender' in wanted:
+        values['gender'] = decrypt_field(row['gender'], row['gender_nonce'], bool, key_id)
+    if 'age' in wanted:
+        values['age'] = decrypt_field(row['age'], row['age_nonce'], int, key_id)
+    aes_done = time.perf_counter()
+
+    if 'weight' in wanted:
+        weight = ope_decrypt(row['weight'], key_id)
+        values['weight'] = round(weight, 2) if weight is not None else None
+    if timings is not None:
+        timings[0] += aes_done - start
+        timings[1] += time.perf_counter() - aes_done
+    return values
+
+def _plain_row(row, values):
+    # (Private) the row without its seal columns, with the decrypted values put in
+    plain = {k: v for k, v in row.items() if k not in _SEAL_COLUMNS}
+    plain.update(values)
+    return plain
+
+def _open_row_v1(row, key_id, known_values=None, timings=None):
+    """(Private) _open_row() for rows sealed with a single row MAC."""
+    try:
+        # 1. Decrypt (Confidentiality)
+        values = _decrypt_values(row, key_id, known_values, timings, ('gender', 'age', 'weight'))
+        gender, age, weight = values['gender'], values['age'], values['weight']
+
+        if gender is None or age is None or weight is None:
+            return None, None, 'decryption failed'
+
+        height = row['height']
+        if height is not None:
+            height = round(float(height), 2)
+
+        # 2. Verify Integrity
+        start = time.perf_counter()
+        row_mac = generate_row_mac(
+            row['first_name'], row['last_name'],
+            gender, age, weight, height,
+            row['health_history'], key_id
+        )
+        matches = hmac.compare_digest(row_mac, row['row_mac'])
+        if timings is not None:
+            timings[2] += time.perf_counter() - start
+        if not matches:
+            if known_values is not None:
+                # the known values are out of date, decrypt for real
+                return _open_row_v1(row, key_id, timings=timings)
+            return None, None, 'integrity check failed'
+
+    except Exception as e:
+        return None, None, f'error: {e}'
+
+    return _plain_row(row, {'gender': gender, 'age': age, 'weight': weight, 'height': height}), row_mac, None
+
+def _open_row_v2(row, key_id, known_values=None, timings=None, fields=None):
+    """(Private) _open_row() for rows sealed with per-field MACs."""
+    wanted = MAC_FIELDS if fields is None else fields
+    try:
+        patient_id = row['patient_id']
+        field_macs = bytes(row['field_macs'])
+
+        # 1. the field MACs must be the ones the row MAC (and so the chain) covers.
+        # nothing is decrypted for this
+        start = time.perf_counter()
+        row_mac = generate_fields_row_mac(patient_id, field_macs, key_id)
+        sealed = len(field_macs) == len(MAC_FIELDS) * FIELD_MAC_BYTES and hmac.compare_digest(row_mac, row['row_mac'])
+        if timings is not None:
+            timings[2] += time.perf_counter() - start
+        if not sealed:
+            return None, None, 'integrity check failed'
+
+        # 2. Decrypt (Confidentiality), only what was asked for
+        values = _decrypt_values(row, key_id, known_values, timings, wanted)
+        if None in values.values():
+            return None, None, 'decryption failed'
+        for field in wanted:
+            if field not in values:
+                value = row[field]
+                if field == 'height' and value is not None:
+                    value = round(float(value), 2)
+                values[field] = value
+
+        # 3. Verify Integrity of every returned field
+        start = time.perf_counter()
+        if fields is None:
+            # all of them, compared in one go
+            matches = hmac.compare_digest(generate_field_macs(patient_id, [values[f] for f in MAC_FIELDS], key_id),
+                                          field_macs)
+        else:
+            matches = all(
+                hmac.compare_digest(generate_field_mac(field, patient_id, values[field], key_id),
+                                    field_macs[_FIELD_MAC_OFFSETS[field]:_FIELD_MAC_OFFSETS[field] + FIELD_MAC_BYTES])
+                for field in fields
+            )
+        if timings is not None:
+            timings[2] += time.perf_counter() - start
+        if not matches:
+            if known_values is not None:
+                # the known values are out of date, decrypt for real
+                return _open_row_v2(row, key_id, timings=timings, fields=fields)
+            return None, None, 'integrity check failed'
+
+    except Exception as e:
+        return None, None, f'error: {e}'
+
+    if fields is None:
+        return _plain_row(row, values), row_mac, None
+    return {'patient_id': patient_id, **{field: values[field] for field in fields}}, row_mac, None
+
+def _open_chunk(rows, fields=None):
+    """(Private) Worker entry point, opens a chunk of rows in order. Returns (opened, timings)."""
+    timings = [0.0, 0.0, 0.0]
+    return [_open_row(row, timings=timings, fields=fields) for row in rows], timings
+
+def _get_decrypt_executor():
+    """(Private) Returns the shared worker pool, creating it on first use."""
+    global _decrypt_executor
+    if _decrypt_executor is None:
+        with _decrypt_executor_lock:
+            if _decrypt_executor is None:
+                # 'spawn' so workers never inherit locks held by request threads
+                _decrypt_executor = ProcessPoolExecutor(
+                    max_workers=DECRYPT_WORKERS,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+    return _decrypt_executor
+
+def _open_rows_parallel(rows, fields=None):
+    """
+    (Private) Opens rows across the worker pool, one chunk per task.
+    map() keeps the chunks in submission order, so results stay in patient_id order.
+    Returns: (opened rows, [aes, ope, hmac] seconds summed over the workers), or None
+    """
+    global _decrypt_executor
+    chunks = [rows[i:i + DECRYPT_CHUNK_SIZE] for i in range(0, len(rows), DECRYPT_CHUNK_SIZE)]
+    try:
+        opened = []
+        timings = [0.0, 0.0, 0.0]
+        for opened_chunk, chunk_timings in _get_decrypt_executor().map(_open_chunk, chunks, [fields] * len(chunks)):
+            opened.extend(opened_chunk)
+            timings = [a + b for a, b in zip(timings, chunk_timings)]
+        return opened, timings
+    except BrokenProcessPool as e:
+        # a worker died. drop the pool (a new one is made next time) and let the caller go serial
+        print(f"WARNING: decrypt worker pool failed ({e}), falling back to serial decryption")
+        _decrypt_executor = None
+        return None
+
+def process_rows(rows, verify_chain=False, previous_hash=GENESIS_HASH, parallel=None, known=None, fields=None):
+    """
+    Decrypts and verifies a whole result set of `patients` rows in one pass.
+
+    Every row MAC is computed once and used for both the integrity check and,
+    if verify_chain is True, the next link of the hash chain starting at
+    previous_hash. Processing stops at the first broken link.
+
+    Decryption runs on the DECRYPT_WORKERS process pool when parallel is True
+    (or None and the result set has at least DECRYPT_PARALLEL_MIN_ROWS rows).
+    The chain is always checked here, in order, over the MACs the workers return.
+
+    known(patient_id) may return the (gender, age, weight) of a row decrypted
+    before, which then skips decryption (but not the MAC). Rows it returns None
+    for are decrypted as usual, on this thread.
+
+    fields, if given, is a tuple of MAC_FIELDS to return (next to patient_id).
+    Rows with per-field MACs then only have those fields decrypted and checked,
+    older rows are still opened in full. The chain is verified either way.
+    Returns: RowBatch
+    """
+    if parallel is None:
+        parallel = known is None and DECRYPT_WORKERS > 0 and len(rows) >= DECRYPT_PARALLEL_MIN_ROWS
+
+    timings = [0.0, 0.0, 0.0]
+    opened = _open_rows_parallel(rows, fields) if parallel else None
+    if opened is not None:
+        opened, timings = opened
+    elif known is not None:
+        opened = (_open_row(row, known(row.get('patient_id')), timings, fields) for row in rows)
+    else:
+        opened = (_open_row(row, None, timings, fields) for row in rows)
+
+    plaintext_rows = []
+    failures = []
+    last_hash = previous_hash
+    chain_time = 0.0
+    broken_at = None
+
+    for row, (plain, row_mac, reason) in zip(rows, opened):
+        patient_id = row.get('patient_id')
+        if reason:
+            failures.append((patient_id, reason))
+            continue
+
+        # 3. Verify Completeness, reusing the MAC from the integrity check
+        if verify_chain:
+            start = time.perf_counter()
+            expected_chain_hash = generate_chain_hash(row_mac, last_hash)
+            linked = hmac.compare_digest(expected_chain_hash, row['chain_hash'])
+            chain_time += time.perf_counter() - start
+            if not linked:
+                broken_at = patient_id
+                break
+            last_hash = row['chain_hash']
+
+        plaintext_rows.append(plain)
+
+    _record_timings(len(plaintext_rows) + len(failures), failures, timings, chain_time, broken_at)
+    return RowBatch(plaintext_rows, failures, last_hash, broken_at)
+
+def _record_timings(scanned, failures, timings, chain_time, broken_at):
+    """(Private) Adds one process_rows() call to the request metrics."""
+    metrics.add_stage('aes_decrypt', timings[0])
+    metrics.add_stage('ope_decrypt', timings[1])
+    metrics.add_stage('hmac_verify', timings[2])
+    metrics.add_stage('chain_verify', chain_time)
+    metrics.count('rows_scanned', scanned)
+    if failures:
+        metrics.count('rows_dropped', len(failures))
+    if broken_at is not None:
+        metrics.count('chain_breaks')
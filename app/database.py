@@ -1,6 +1,10 @@
 import mysql.connector
 import config 
 import os
+import time
+import threading
+from contextlib import contextmanager
+from app import metrics
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 CERT_PATH = os.path.join(BASE_DIR, '..', 'certs', 'ca.pem')
@@ -15,6 +19,22 @@ db_config = {
     'ssl_verify_cert': True
 }
 
+# set DB_SSL = False in config.py for a local MySQL without TLS (eg., a test container)
+if not getattr(config, 'DB_SSL', True):
+    for key in ('ssl_ca', 'ssl_verify_cert'):
+        db_config.pop(key)
+    db_config['ssl_disabled'] = True
+
+# pool settings, these can be overridden in config.py
+POOL_SIZE = getattr(config, 'DB_POOL_SIZE', 5)
+# how long (seconds) a request waits for a free connection before giving up
+POOL_TIMEOUT = getattr(config, 'DB_POOL_TIMEOUT', 10)
+# connections older than this (seconds) are closed and reopened
+POOL_RECYCLE = getattr(config, 'DB_POOL_RECYCLE', 1800)
+# connections idle for longer than this (seconds) are pinged before reuse
+POOL_PING_AFTER = getattr(config, 'DB_POOL_PING_AFTER', 30)
+
+
 def get_db_connection():
     """To Establish and return a new database connection."""
     try:
@@ -22,4 +42,277 @@ def get_db_connection():
         return cnx
     except mysql.connector.Error as err:
         print(f"Error connecting to database: {err}")
-        return None
\ No newline at end of file
+        return None
+
+
+class ConnectionPool:
+    """
+    A small pool of open MySQL connections.
+    Every new connection costs a full TCP + TLS + auth handshake with the
+    remote server, so we keep them open and hand them out again.
+    """
+
+    def __init__(self, size=POOL_SIZE, timeout=POOL_TIMEOUT,
+                 recycle=POOL_RECYCLE, ping_after=POOL_PING_AFTER):
+        self.size = size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_after = ping_after
+
+        # idle connections as (cnx, last_used) tuples, the newest is reused first
+        self._idle = []
+        self._lock = threading.Lock()
+        # notified whenever a connection goes back to _idle or a slot is freed
+        self._available = threading.Condition(self._lock)
+        self._open = 0
+        self._created_at = {}
+
+        # metrics
+        self.in_use = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.reconnects = 0
+        self.total_checkout_time = 0.0
+        self.max_checkout_time = 0.0
+
+    def _connect(self):
+        cnx = mysql.connector.connect(**db_config)
+        self._created_at[id(cnx)] = time.monotonic()
+        return cnx
+
+    def _discard(self, cnx):
+        self._created_at.pop(id(cnx), None)
+        try:
+            cnx.close()
+        except Exception:
+            pass
+
+    def _make_healthy(self, cnx, last_used):
+        """
+        (Private) Returns a usable connection, replacing `cnx` if it is too old
+        or no longer answers a ping.
+        """
+        now = time.monotonic()
+        created_at = self._created_at.get(id(cnx), now)
+
+        if now - created_at > self.recycle:
+            self._discard(cnx)
+            with self._lock:
+                self.reconnects += 1
+            return self._connect()
+
+        if now - last_used > self.ping_after:
+            try:
+                cnx.ping(reconnect=False)
+            except mysql.connector.Error:
+                self._discard(cnx)
+                with self._lock:
+                    self.reconnects += 1
+                return self._connect()
+
+        return cnx
+
+    def _free_slot(self):
+        """(Private) Gives back the slot of a connection that was closed, and wakes one waiter."""
+        with self._available:
+            self._open -= 1
+            self._available.notify()
+
+    def acquire(self):
+        """
+        Checks a connection out of the pool.
+        Blocks for up to `timeout` seconds when all connections are in use.
+        """
+        start = time.perf_counter()
+        deadline = None
+        entry = None
+
+        with self._available:
+            while True:
+                if self._idle:
+                    entry = self._idle.pop()
+                    break
+                if self._open < self.size:
+                    # a free slot, we open the connection outside the lock
+                    self._open += 1
+                    break
+
+                if deadline is None:
+                    self.waits += 1
+                    deadline = time.monotonic() + self.timeout
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise mysql.connector.errors.PoolError(
+                        msg=f"No free database connection after {self.timeout}s"
+                    )
+                # woken up by release() or by a slot being freed
+                self._available.wait(remaining)
+
+        try:
+            if entry is None:
+                cnx = self._connect()
+            else:
+                cnx = self._make_healthy(*entry)
+        except mysql.connector.Error:
+            # the connect or reconnect failed, so this slot is free again
+            self._free_slot()
+            raise
+
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.in_use += 1
+            self.checkouts += 1
+            self.total_checkout_time += elapsed
+            self.max_checkout_time = max(self.max_checkout_time, elapsed)
+
+        return cnx
+
+    def release(self, cnx):
+        """
+        Returns a connection to the pool.
+        Any transaction left open by the caller is rolled back first.
+        """
+        with self._lock:
+            self.in_use -= 1
+
+        try:
+            if getattr(cnx, 'unread_result', False):
+                # a streaming cursor was abandoned part way, this connection can't be reused
+                raise mysql.connector.errors.InternalError(msg="Unread result found")
+            if cnx.in_transaction:
+                cnx.rollback()
+        except mysql.connector.Error:
+            # broken connection, drop it and free the slot for a waiting caller
+            self._discard(cnx)
+            self._free_slot()
+            return
+
+        with self._available:
+            self._idle.append((cnx, time.monotonic()))
+            self._available.notify()
+
+    def close_all(self):
+        """Closes every idle connection (eg., on shutdown)."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for cnx, _ in idle:
+            self._discard(cnx)
+            self._free_slot()
+
+    def stats(self):
+        """Returns a snapshot of the pool metrics."""
+        with self._lock:
+            checkouts = self.checkouts
+            return {
+                'size': self.size,
+                'open': self._open,
+                'idle': len(self._idle),
+                'in_use': self.in_use,
+                'checkouts': checkouts,
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+                'reconnects': self.reconnects,
+                'avg_checkout_ms': (self.total_checkout_time / checkouts * 1000) if checkouts else 0.0,
+                'max_checkout_ms': self.max_checkout_time * 1000,
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Returns the shared connection pool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool()
+    return _pool
+
+class TimedCursor:
+    """Cursor wrapper that adds the time spent in execute and fetch to the 'sql' stage."""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, *args, **kwargs):
+        with metrics.timed('sql'):
+            return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        with metrics.timed('sql'):
+            return self._cursor.executemany(*args, **kwargs)
+
+    def fetchone(self):
+        with metrics.timed('sql'):
+            return self._cursor.fetchone()
+
+    def fetchmany(self, *args, **kwargs):
+        with metrics.timed('sql'):
+            return self._cursor.fetchmany(*args, **kwargs)
+
+    def fetchall(self):
+        with metrics.timed('sql'):
+            return self._cursor.fetchall()
+
+    def __iter__(self):
+        # row by row (eg., the weight index scan), only the fetching is timed
+        rows = iter(self._cursor)
+        spent = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    row = next(rows)
+                except StopIteration:
+                    return
+                finally:
+                    spent += time.perf_counter() - start
+                yield row
+        finally:
+            metrics.add_stage('sql', spent)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class TimedConnection:
+    """Connection wrapper whose cursors are TimedCursors. Everything else is passed through."""
+
+    def __init__(self, cnx):
+        self._cnx = cnx
+
+    def cursor(self, *args, **kwargs):
+        return TimedCursor(self._cnx.cursor(*args, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self._cnx, name)
+
+
+@contextmanager
+def db_connection():
+    """
+    Checks a pooled connection out for the duration of a `with` block and
+    hands it back afterwards. Yields None if no connection could be made,
+    the same way get_db_connection() returns None.
+    Time spent waiting for the connection and in SQL is added to the request metrics.
+    """
+    pool = get_pool()
+    try:
+        with metrics.timed('db_acquire'):
+            cnx = pool.acquire()
+    except mysql.connector.Error as err:
+        print(f"Error connecting to database: {err}")
+        cnx = None
+
+    try:
+        yield TimedConnection(cnx) if cnx else None
+    finally:
+        if cnx:
+            pool.release(cnx)
+
+def pool_stats():
+    """Returns the metrics of the shared connection pool."""
+    return get_pool().stats()
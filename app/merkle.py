@@ -0,0 +1,432 @@
+import hmac
+import hashlib
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import mysql.connector
+from app import app, database, crypto
+
+# Merkle tree over the rows
+#
+# Next to the hash chain, every row is a leaf of a Merkle tree in patient_id
+# order. The tree has the RFC 6962 shape, so it grows by appending. A leaf hashes
+# the row's patient_id, key_id, weight ciphertext, row MAC and chain_hash.
+#
+# merkle_state holds the root over the first leaf_count rows, signed with the
+# HMAC key, and the "frontier": the roots of the complete subtrees those rows
+# split into (one per set bit of leaf_count). Appending a row only needs the
+# frontier, so chain.append_patients() keeps the tree up to date in O(log n)
+# per row, under the same chain_tail lock.
+#
+# Every complete subtree is also stored in merkle_nodes as (level, idx, hash).
+# With those, any run of consecutive rows can be checked against the signed root
+# using the O(log n) subtrees around it:
+#   - chain.chain_hash_at() proves a single row this way, instead of replaying
+#     up to CHECKPOINT_INTERVAL row MACs from a checkpoint
+#   - the weight index (app/weight_index.py) checks the rows it reads against
+#     the root, which lets /query_by_weight prove its result is complete
+#   - subtrees don't depend on each other, so verify_tree() checks the whole
+#     table as independent subtree jobs on a process pool
+#
+# The database is never trusted with any of it. The hashes it returns are only
+# ever used to recompute the signed root.
+
+MERKLE_ENABLED = app.config.get('MERKLE_ENABLED', True)
+# leaves per verify_tree() job (rounded down to a power of two)
+MERKLE_VERIFY_CHUNK = app.config.get('MERKLE_VERIFY_CHUNK', 1024)
+# 0 verifies on the calling thread
+MERKLE_VERIFY_WORKERS = app.config.get('MERKLE_VERIFY_WORKERS', 0)
+
+CREATE_NODES_TABLE = """
+CREATE TABLE IF NOT EXISTS merkle_nodes (
+    level TINYINT NOT NULL,
+    idx INT NOT NULL,
+    hash VARBINARY(32) NOT NULL,
+    PRIMARY KEY (level, idx)
+)
+"""
+
+CREATE_STATE_TABLE = """
+CREATE TABLE IF NOT EXISTS merkle_state (
+    id TINYINT PRIMARY KEY,
+    leaf_count INT NOT NULL,
+    frontier VARBINARY(1024) NOT NULL,
+    root VARBINARY(32) NOT NULL,
+    signature VARBINARY(32) NOT NULL
+)
+"""
+
+# the columns a leaf is made from
+LEAF_COLUMNS = "patient_id, key_id, weight, row_mac, chain_hash"
+
+# root of the tree with no leaves
+EMPTY_ROOT = hashlib.sha256(b'').digest()
+
+
+class TreeBroken(Exception):
+    """The stored tree doesn't match its signed root."""
+
+
+class IncompleteResult(Exception):
+    """The rows don't match the signed Merkle root, so a result can't be proven complete."""
+
+
+def leaf_hash(patient_id, key_id, weight, row_mac, chain_hash):
+    """Returns: the leaf of one row. 0x00 and 0x01 prefixes keep leaves and nodes apart"""
+    data = f"{patient_id}|{key_id or 1}|{'' if weight is None else weight}|".encode('utf-8')
+    return hashlib.sha256(b'\x00' + data + bytes(row_mac) + bytes(chain_hash)).digest()
+
+def row_leaf(row):
+    """leaf_hash() of a 'patients' row, a dictionary or a tuple of LEAF_COLUMNS."""
+    if isinstance(row, dict):
+        return leaf_hash(row['patient_id'], row.get('key_id'), row['weight'], row['row_mac'], row['chain_hash'])
+    return leaf_hash(*row)
+
+def node_hash(left, right):
+    return hashlib.sha256(b'\x01' + left + right).digest()
+
+def _as_tuple(row):
+    # works for both plain and dictionary cursors
+    return tuple(row.values()) if isinstance(row, dict) else tuple(row)
+
+def _split(size):
+    # RFC 6962: the left subtree holds the largest power of two below size
+    return 1 << ((size - 1).bit_length() - 1)
+
+
+class Frontier:
+    """
+    The roots of the complete subtrees the first `count` leaves split into,
+    largest (leftmost) first. Enough to append leaves and to get the root.
+    """
+
+    def __init__(self, count=0, hashes=()):
+        self.count = count
+        self.hashes = list(hashes)
+
+    def copy(self):
+        return Frontier(self.count, self.hashes)
+
+    def append(self, leaf):
+        """Adds the next leaf. Returns: the complete subtrees it finishes as (level, idx, hash), the leaf included"""
+        nodes = [(0, self.count, leaf)]
+        self.count += 1
+        node = leaf
+        level = 0
+        # every trailing zero bit of the new count merges two subtrees of the same size
+        while self.count % (2 << level) == 0:
+            node = node_hash(self.hashes.pop(), node)
+            level += 1
+            nodes.append((level, (self.count >> level) - 1, node))
+        self.hashes.append(node)
+        return nodes
+
+    def root(self):
+        if not self.hashes:
+            return EMPTY_ROOT
+        root = self.hashes[-1]
+        for node in reversed(self.hashes[:-1]):
+            root = node_hash(node, root)
+        return root
+
+    def to_bytes(self):
+        return b''.join(self.hashes)
+
+    @classmethod
+    def from_bytes(cls, count, blob):
+        hashes = [blob[i:i + 32] for i in range(0, len(blob), 32)]
+        if len(hashes) != bin(count).count('1'):
+            raise TreeBroken("merkle frontier has the wrong size")
+        return cls(count, hashes)
+
+
+def subtree_hash(lo, hi, get):
+    """
+    Hash of the subtree over leaves [lo, hi) (as the RFC 6962 recursion splits it).
+    get(level, idx) returns the hash of a complete subtree if it is known, else None.
+    Raises: TreeBroken if a leaf is needed that get() doesn't know
+    """
+    size = hi - lo
+    if size & (size - 1) == 0:
+        level = size.bit_length() - 1
+        known = get(level, lo >> level)
+        if known is not None:
+            return known
+        if size == 1:
+            raise TreeBroken(f"leaf {lo} is missing")
+    k = _split(size)
+    return node_hash(subtree_hash(lo, lo + k, get), subtree_hash(lo + k, hi, get))
+
+def proof_nodes(count, start, end):
+    """
+    Returns: (level, idx) of the complete subtrees that, next to the leaves
+    [start, end), give the root of a tree of `count` leaves. O(log count) of them.
+    """
+    needed = []
+
+    def walk(lo, hi):
+        size = hi - lo
+        if (hi <= start or lo >= end) and size & (size - 1) == 0:
+            level = size.bit_length() - 1
+            needed.append((level, lo >> level))
+            return
+        if size == 1:
+            return
+        k = _split(size)
+        walk(lo, lo + k)
+        walk(lo + k, hi)
+
+    if count:
+        walk(0, count)
+    return needed
+
+def range_root(count, start, leaves, nodes):
+    """Returns: the root of a tree of `count` leaves from the leaves at `start` and proof_nodes() hashes"""
+    end = start + len(leaves)
+
+    def get(level, idx):
+        if level == 0 and start <= idx < end:
+            return leaves[idx - start]
+        return nodes.get((level, idx))
+    return subtree_hash(0, count, get)
+
+def subtree_ranges(count, max_size):
+    """Returns: [start, end) of complete subtrees of at most max_size leaves that together make up the tree"""
+    ranges = []
+
+    def walk(lo, hi):
+        size = hi - lo
+        if size <= max_size and size & (size - 1) == 0:
+            ranges.append((lo, hi))
+            return
+        k = _split(size)
+        walk(lo, lo + k)
+        walk(lo + k, hi)
+
+    if count:
+        walk(0, count)
+    return ranges
+
+
+# Stored tree
+
+def fetch_nodes(cursor, keys):
+    """Returns: {(level, idx): hash} for the keys merkle_nodes has (only those asked for)"""
+    found = {}
+    wanted = set(keys)
+    keys = list(keys)
+    for i in range(0, len(keys), 200):
+        chunk = keys[i:i + 200]
+        cursor.execute(
+            "SELECT level, idx, hash FROM merkle_nodes WHERE "
+            + " OR ".join(["(level = %s AND idx = %s)"] * len(chunk)),
+            tuple(value for key in chunk for value in key)
+        )
+        for row in cursor.fetchall():
+            level, idx, node = _as_tuple(row)
+            if (level, idx) in wanted:
+                found[(level, idx)] = bytes(node)
+    return found
+
+def store_nodes(cursor, nodes):
+    """Writes (level, idx, hash) nodes. Runs in the caller's transaction."""
+    if nodes:
+        cursor.executemany("REPLACE INTO merkle_nodes (level, idx, hash) VALUES (%s, %s, %s)", nodes)
+
+def load_state(cursor):
+    """
+    Returns: the Frontier of the signed tree, or None if there is no tree yet
+    Raises: TreeBroken if the signature or the frontier is wrong
+    """
+    cursor.execute("SELECT leaf_count, frontier, root, signature FROM merkle_state WHERE id = 1")
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    count, blob, root, signature = _as_tuple(row)
+    if not crypto.verify_merkle_root(count, bytes(root), bytes(signature)):
+        raise TreeBroken("merkle root has a bad signature")
+    frontier = Frontier.from_bytes(count, bytes(blob))
+    if not hmac.compare_digest(frontier.root(), bytes(root)):
+        raise TreeBroken("merkle frontier doesn't match its signed root")
+    return frontier
+
+def save_state(cursor, frontier):
+    """Signs and stores the root of `frontier`. Runs in the caller's transaction."""
+    root = frontier.root()
+    cursor.execute(
+        "REPLACE INTO merkle_state (id, leaf_count, frontier, root, signature) VALUES (1, %s, %s, %s, %s)",
+        (frontier.count, frontier.to_bytes(), root, crypto.merkle_root_signature(frontier.count, root))
+    )
+
+def frontier_at(cursor, count):
+    """
+    Returns: the Frontier of the first `count` leaves, read from merkle_nodes, or
+    None if a node is missing. Not trusted until a root made from it is checked.
+    """
+    keys = []
+    offset = 0
+    for level in reversed(range(count.bit_length())):
+        if count >> level & 1:
+            keys.append((level, offset >> level))
+            offset += 1 << level
+    nodes = fetch_nodes(cursor, keys)
+    if len(nodes) != len(keys):
+        return None
+    return Frontier(count, [nodes[key] for key in keys])
+
+_warned = set()
+
+def _warn_once(message):
+    if message not in _warned:
+        _warned.add(message)
+        print(message)
+
+def load_for_append(cursor, tail_id):
+    """
+    For chain.append_patients(), with the chain_tail lock held.
+    Returns: the Frontier to append the rows after tail_id to, or None if the
+    tree isn't kept (disabled, missing, behind the table or broken)
+    """
+    if not MERKLE_ENABLED:
+        return None
+    try:
+        frontier = load_state(cursor)
+    except TreeBroken as e:
+        _warn_once(f"WARNING: {e}, not updating the Merkle tree")
+        return None
+    if frontier is None and tail_id == 0:
+        return Frontier()
+    if frontier is None or frontier.count != tail_id:
+        _warn_once("WARNING: the Merkle tree doesn't cover the table, run scripts/build_merkle_tree.py")
+        return None
+    return frontier
+
+def check_tail(cursor, tail_id, row_count=None):
+    """
+    Checks the table still reaches the end of the signed tree. Rows cut off the
+    end of the table leave a shorter chain that verifies, this catches them.
+    tail_id is the highest patient_id the database returned, row_count its row count.
+    Raises: IncompleteResult if the table is shorter than the signed tree
+    """
+    if not MERKLE_ENABLED:
+        return
+    try:
+        signed = load_state(cursor)
+    except TreeBroken as e:
+        raise IncompleteResult(str(e))
+    if signed is None:
+        return
+    if tail_id < signed.count or (row_count is not None and row_count < signed.count):
+        raise IncompleteResult(f"the table ends at patient_id {tail_id}, the signed tree has {signed.count} rows")
+
+def verify_rows(cursor, rows, frontier=None):
+    """
+    Checks consecutive rows (dictionaries or tuples of LEAF_COLUMNS) against the signed root.
+    frontier is the signed state if the caller already loaded it.
+    Returns: True, False if they don't match, or None if the tree doesn't cover them
+    """
+    if not rows:
+        return None
+    try:
+        if frontier is None:
+            frontier = load_state(cursor)
+        if frontier is None:
+            return None
+        ids = [_as_tuple(row)[0] if not isinstance(row, dict) else row['patient_id'] for row in rows]
+        start, end = ids[0] - 1, ids[-1]
+        if end > frontier.count:
+            return None
+        if ids != list(range(start + 1, end + 1)):
+            return False
+        nodes = fetch_nodes(cursor, proof_nodes(frontier.count, start, end))
+        root = range_root(frontier.count, start, [row_leaf(row) for row in rows], nodes)
+    except TreeBroken as e:
+        print(f"WARNING: {e}")
+        return False
+    return hmac.compare_digest(root, frontier.root())
+
+
+# Parallel re-verification
+
+def _verify_subtree(rows, start, end):
+    """
+    (Private) Worker entry point: decrypts and verifies the rows of leaves [start, end).
+    Returns: (subtree hash, None) or (None, problem)
+    """
+    if [row['patient_id'] for row in rows] != list(range(start + 1, end + 1)):
+        return None, "rows are missing or out of order"
+    batch = crypto.process_rows(rows, parallel=False)
+    if batch.failures:
+        return None, f"{len(batch.failures)} rows failed verification"
+    leaves = [row_leaf(row) for row in rows]
+    return subtree_hash(0, len(leaves), lambda level, idx: leaves[idx] if level == 0 else None), None
+
+def verify_tree(workers=None, chunk_size=None):
+    """
+    Re-verifies every row in the signed tree: each complete subtree of up to
+    chunk_size rows is decrypted, checked and hashed on its own (on `workers`
+    processes), then the subtree hashes must give the signed root.
+    Returns: list of (start_id, end_id, problem) for every bad subtree (or the root)
+    """
+    workers = MERKLE_VERIFY_WORKERS if workers is None else workers
+    chunk_size = chunk_size or MERKLE_VERIFY_CHUNK
+    chunk_size = 1 << (chunk_size.bit_length() - 1)
+
+    problems = []
+    hashes = {}
+
+    def record(start, end, outcome):
+        subtree, problem = outcome
+        if problem:
+            problems.append((start, end, problem))
+        else:
+            level = (end - start).bit_length() - 1
+            hashes[(level, start >> level)] = subtree
+
+    with database.db_connection() as cnx:
+        if not cnx:
+            return [(None, None, "Database connection failed")]
+
+        cursor = cnx.cursor(dictionary=True)
+        # 'spawn' like the decrypt pool, so workers never inherit locks held by other threads
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) \
+            if workers else None
+        try:
+            try:
+                frontier = load_state(cursor)
+            except TreeBroken as e:
+                return [(None, None, str(e))]
+            if frontier is None:
+                return [(None, None, "there is no Merkle tree, run scripts/build_merkle_tree.py")]
+
+            # rows are read here, a few subtrees ahead of the workers
+            pending = deque()
+            for start, end in subtree_ranges(frontier.count, chunk_size):
+                cursor.execute(
+                    "SELECT * FROM patients WHERE patient_id > %s AND patient_id <= %s ORDER BY patient_id ASC",
+                    (start, end)
+                )
+                rows = cursor.fetchall()
+                if executor is None:
+                    record(start, end, _verify_subtree(rows, start, end))
+                    continue
+                pending.append((start, end, executor.submit(_verify_subtree, rows, start, end)))
+                while len(pending) > workers * 2:
+                    start, end, future = pending.popleft()
+                    record(start, end, future.result())
+            while pending:
+                start, end, future = pending.popleft()
+                record(start, end, future.result())
+
+        except mysql.connector.Error as err:
+            problems.append((None, None, f"Database query failed: {err}"))
+        finally:
+            cursor.close()
+            if executor is not None:
+                executor.shutdown()
+
+    if not problems:
+        root = subtree_hash(0, frontier.count, lambda level, idx: hashes.get((level, idx)))
+        if not hmac.compare_digest(root, frontier.root()):
+            problems.append((0, frontier.count, "the rows don't give the signed Merkle root"))
+    return problems
@@ -0,0 +1,237 @@
+import json
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from flask import g, request, has_request_context
+from app import app
+
+# Request metrics.
+#
+# Latency per endpoint is measured from the start of the request until the
+# response leaves the view (for streamed responses, until the first byte).
+# The last LATENCY_WINDOW requests of every endpoint are kept for percentiles,
+# and cumulative histogram buckets are kept for Prometheus.
+#
+# Inside a request the hot path is split into stages (see STAGES). Each stage's
+# time is added both to the current request (for the slow request log) and to
+# process-wide totals (for /metrics). Rows and integrity failures are counted too.
+
+LATENCY_WINDOW = app.config.get('LATENCY_WINDOW', 1000)
+# requests slower than this (ms) are logged with their stage breakdown, 0 turns it off
+SLOW_REQUEST_MS = app.config.get('SLOW_REQUEST_MS', 1000)
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+STAGES = (
+    'db_acquire',    # waiting for a pooled connection
+    'sql',           # execute and fetch
+    'aes_decrypt',   # gender and age
+    'ope_decrypt',   # weight
+    'hmac_verify',   # row MACs
+    'chain_verify',  # hash chain links
+    'json',          # building the response body
+)
+
+
+class LatencyTracker:
+    """Request counts, a sliding window of latencies and histogram buckets, per endpoint."""
+
+    def __init__(self, window=1000):
+        self.window = window
+        self._lock = threading.Lock()
+        self._samples = {}  # endpoint -> deque of seconds
+        self._counts = {}   # endpoint -> {'requests': n, '4xx': n, '5xx': n}
+        self._buckets = {}  # endpoint -> count per LATENCY_BUCKETS bound (not cumulative)
+        self._sums = {}     # endpoint -> total seconds
+
+    def record(self, endpoint, elapsed, status):
+        with self._lock:
+            samples = self._samples.get(endpoint)
+            if samples is None:
+                samples = self._samples[endpoint] = deque(maxlen=self.window)
+                self._counts[endpoint] = {'requests': 0, '4xx': 0, '5xx': 0}
+                self._buckets[endpoint] = [0] * (len(LATENCY_BUCKETS) + 1)
+                self._sums[endpoint] = 0.0
+            samples.append(elapsed)
+            counts = self._counts[endpoint]
+            counts['requests'] += 1
+            if 400 <= status < 500:
+                counts['4xx'] += 1
+            elif status >= 500:
+                counts['5xx'] += 1
+
+            buckets = self._buckets[endpoint]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if elapsed <= bound:
+                    buckets[i] += 1
+                    break
+            else:
+                buckets[-1] += 1
+            self._sums[endpoint] += elapsed
+
+    def stats(self):
+        with self._lock:
+            snapshot = {endpoint: (sorted(samples), dict(self._counts[endpoint]))
+                        for endpoint, samples in self._samples.items()}
+
+        result = {}
+        for endpoint, (samples, counts) in snapshot.items():
+            def percentile(p):
+                return samples[min(len(samples) - 1, int(len(samples) * p / 100))] * 1000
+            result[endpoint] = dict(counts,
+                                    p50_ms=percentile(50),
+                                    p95_ms=percentile(95),
+                                    p99_ms=percentile(99),
+                                    max_ms=samples[-1] * 1000)
+        return result
+
+    def histograms(self):
+        """Returns: endpoint -> (cumulative bucket counts, sum, count)"""
+        with self._lock:
+            result = {}
+            for endpoint, buckets in self._buckets.items():
+                cumulative = []
+                total = 0
+                for n in buckets:
+                    total += n
+                    cumulative.append(total)
+                result[endpoint] = (cumulative, self._sums[endpoint], total)
+            return result
+
+
+class Counters:
+    """Process-wide counters and stage totals."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.values = {}        # name -> count
+        self.stage_seconds = {stage: 0.0 for stage in STAGES}
+        self.stage_calls = {stage: 0 for stage in STAGES}
+
+    def inc(self, name, n=1):
+        with self._lock:
+            self.values[name] = self.values.get(name, 0) + n
+
+    def add_stage(self, stage, seconds, calls=1):
+        with self._lock:
+            self.stage_seconds[stage] += seconds
+            self.stage_calls[stage] += calls
+
+    def stats(self):
+        with self._lock:
+            return {
+                'counters': dict(self.values),
+                'stages': {stage: {'seconds': self.stage_seconds[stage], 'calls': self.stage_calls[stage]}
+                           for stage in STAGES},
+            }
+
+
+latency = LatencyTracker(window=LATENCY_WINDOW)
+counters = Counters()
+
+def add_stage(stage, seconds, calls=1):
+    """Adds time spent in a stage, to the current request (if any) and the totals."""
+    counters.add_stage(stage, seconds, calls)
+    if has_request_context():
+        stages = g.setdefault('stage_times', {})
+        stages[stage] = stages.get(stage, 0.0) + seconds
+
+@contextmanager
+def timed(stage):
+    """Times the body of a `with` block as one call of `stage`."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_stage(stage, time.perf_counter() - start)
+
+def count(name, n=1):
+    counters.inc(name, n)
+
+@app.before_request
+def _start_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def _record_latency(response):
+    started = g.get('request_started')
+    if started is None:
+        return response
+
+    elapsed = time.perf_counter() - started
+    endpoint = request.endpoint or 'not_found'
+    latency.record(endpoint, elapsed, response.status_code)
+
+    if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+        counters.inc('slow_requests')
+        # one JSON object per line, so log tools can parse it
+        print(json.dumps({
+            'event': 'slow_request',
+            'endpoint': endpoint,
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'ms': round(elapsed * 1000, 1),
+            'stages_ms': {stage: round(seconds * 1000, 1) for stage, seconds in g.get('stage_times', {}).items()},
+        }))
+    return response
+
+
+# Prometheus text format
+
+def _line(name, value, labels=None):
+    if labels:
+        label_text = ",".join(f'{key}="{label}"' for key, label in labels.items())
+        return f"{name}{{{label_text}}} {value}"
+    return f"{name} {value}"
+
+def prometheus_text(gauges):
+    """
+    Renders every metric in the Prometheus text exposition format.
+    `gauges` is a dict of extra name -> value (pool, caches, bcrypt queue),
+    names ending in _total are exported as counters.
+    """
+    lines = [
+        "# HELP dbaas_request_duration_seconds Request latency per endpoint.",
+        "# TYPE dbaas_request_duration_seconds histogram",
+    ]
+    for endpoint, (cumulative, total_seconds, total) in sorted(latency.histograms().items()):
+        for bound, n in zip(LATENCY_BUCKETS + ('+Inf',), cumulative):
+            lines.append(_line("dbaas_request_duration_seconds_bucket", n, {'endpoint': endpoint, 'le': bound}))
+        lines.append(_line("dbaas_request_duration_seconds_sum", total_seconds, {'endpoint': endpoint}))
+        lines.append(_line("dbaas_request_duration_seconds_count", total, {'endpoint': endpoint}))
+
+    lines += [
+        "# HELP dbaas_responses_total Responses per endpoint and status class.",
+        "# TYPE dbaas_responses_total counter",
+    ]
+    for endpoint, stats in sorted(latency.stats().items()):
+        ok = stats['requests'] - stats['4xx'] - stats['5xx']
+        for status, n in (('2xx', ok), ('4xx', stats['4xx']), ('5xx', stats['5xx'])):
+            lines.append(_line("dbaas_responses_total", n, {'endpoint': endpoint, 'status': status}))
+
+    stats = counters.stats()
+    lines += [
+        "# HELP dbaas_stage_seconds_total Time spent per hot path stage.",
+        "# TYPE dbaas_stage_seconds_total counter",
+    ]
+    for stage, values in stats['stages'].items():
+        lines.append(_line("dbaas_stage_seconds_total", values['seconds'], {'stage': stage}))
+    lines += [
+        "# HELP dbaas_stage_calls_total Timed calls per hot path stage.",
+        "# TYPE dbaas_stage_calls_total counter",
+    ]
+    for stage, values in stats['stages'].items():
+        lines.append(_line("dbaas_stage_calls_total", values['calls'], {'stage': stage}))
+
+    for name in ('rows_scanned', 'rows_dropped', 'chain_breaks', 'slow_requests'):
+        lines.append(f"# TYPE dbaas_{name}_total counter")
+        lines.append(_line(f"dbaas_{name}_total", stats['counters'].get(name, 0)))
+
+    for name, value in sorted(gauges.items()):
+        lines.append(f"# TYPE dbaas_{name} {'counter' if name.endswith('_total') else 'gauge'}")
+        lines.append(_line(f"dbaas_{name}", value))
+
+    return "\n".join(lines) + "\n"
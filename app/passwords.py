@@ -0,0 +1,115 @@
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from app import app, bcrypt
+
+# Password hashing for /register and /login.
+#
+# bcrypt is slow on purpose (BCRYPT_LOG_ROUNDS, Flask-Bcrypt's setting, default
+# 12), so it runs on a small pool of its own processes. That way a burst of
+# logins can use at most BCRYPT_WORKERS cores, and every other endpoint keeps
+# the rest. At most BCRYPT_MAX_QUEUE more hashes may wait for a worker; past
+# that, Overloaded is raised and the route answers 503 with a Retry-After
+# header right away instead of queueing forever.
+
+BCRYPT_WORKERS = app.config.get('BCRYPT_WORKERS', 2)
+BCRYPT_MAX_QUEUE = app.config.get('BCRYPT_MAX_QUEUE', 16)
+# seconds, sent back in the Retry-After header
+BCRYPT_RETRY_AFTER = app.config.get('BCRYPT_RETRY_AFTER', 2)
+
+
+class Overloaded(Exception):
+    """Raised when too many password hashes are already waiting."""
+
+
+def _hash(password):
+    return bcrypt.generate_password_hash(password).decode('utf-8')
+
+def _check(password_hash, password):
+    return bcrypt.check_password_hash(password_hash, password)
+
+
+class PasswordHasher:
+    """
+    Runs bcrypt on a size-limited process pool with a cap on waiting work.
+    With workers=0, bcrypt runs on the request thread (the cap still applies).
+    """
+
+    def __init__(self, workers=2, max_queue=16):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor = None
+        self._lock = threading.Lock()
+        self.in_flight = 0
+
+        # metrics
+        self.completed = 0
+        self.rejected = 0
+        self.total_time = 0.0
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # 'spawn' so workers never inherit locks held by request threads
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+            return self._executor
+
+    def _run(self, fn, *args):
+        with self._lock:
+            if self.in_flight >= self.workers + self.max_queue:
+                self.rejected += 1
+                raise Overloaded()
+            self.in_flight += 1
+
+        start = time.perf_counter()
+        try:
+            if not self.workers:
+                return fn(*args)
+            executor = self._get_executor()
+            try:
+                return executor.submit(fn, *args).result()
+            except BrokenProcessPool as e:
+                # a worker died. drop the pool (a new one is made next time) and do this one here
+                print(f"WARNING: bcrypt worker pool failed ({e}), hashing on the request thread")
+                with self._lock:
+                    # only the first thread to notice shuts it down, the others may already see a new pool
+                    broken = self._executor is executor
+                    if broken:
+                        self._executor = None
+                if broken:
+                    # reaps the remaining workers without waiting on them
+                    executor.shutdown(wait=False, cancel_futures=True)
+                return fn(*args)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self.completed += 1
+                self.total_time += time.perf_counter() - start
+
+    def hash_password(self, password):
+        """Returns: the bcrypt hash (str) of `password`. Raises: Overloaded"""
+        return self._run(_hash, password)
+
+    def check_password(self, password_hash, password):
+        """Returns: True if `password` matches. Raises: Overloaded"""
+        return self._run(_check, password_hash, password)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'max_queue': self.max_queue,
+                'in_flight': self.in_flight,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'avg_ms': (self.total_time / self.completed * 1000) if self.completed else 0.0,
+                'log_rounds': app.config.get('BCRYPT_LOG_ROUNDS', 12),
+            }
+
+
+hasher = PasswordHasher(workers=BCRYPT_WORKERS, max_queue=BCRYPT_MAX_QUEUE)
@@ -0,0 +1,164 @@
+import threading
+from collections import OrderedDict, namedtuple
+from app import app, crypto, merkle
+
+# Cache of decrypted and verified result sets for /query_all and /query_by_weight.
+#
+# Each entry remembers the chain tail (last patient_id and its chain_hash) the
+# rows were read at. A request first reads the current tail:
+#   - same tail: nothing was written since, the cached rows are returned as they are
+#   - the cached tail is still there but rows were added after it: only the new
+#     rows are fetched and verified (chained on from the cached tail hash)
+#   - the cached tail row is gone or changed: the result is rebuilt from scratch
+#
+# Plaintext only ever lives in this process's memory. Rows are cached before
+# redaction, so group R users still get theirs redacted at response time.
+# A hit skips the per-row integrity checks. Deleted rows are still noticed (the
+# row count must match the tail patient_id, and with a Merkle tree neither may be
+# below its signed row count, see merkle.check_tail), but rows changed in place behind
+# the tail are not noticed until the entry is rebuilt; the background segment
+# verifier (CHAIN_VERIFY_INTERVAL) covers that case.
+
+RESULT_CACHE_ENABLED = app.config.get('RESULT_CACHE_ENABLED', True)
+# memory cap, in cached rows over all entries
+RESULT_CACHE_MAX_ROWS = app.config.get('RESULT_CACHE_MAX_ROWS', 200000)
+
+CacheEntry = namedtuple('CacheEntry', ['tail_id', 'tail_hash', 'rows'])
+
+# what fetch() hands over to finish() once the connection is released
+PendingResult = namedtuple('PendingResult', ['key', 'entry', 'raw_rows', 'tail_id', 'tail_hash'])
+
+_TAIL_QUERY = """
+SELECT patient_id, chain_hash, (SELECT COUNT(*) FROM patients) AS row_count FROM patients
+WHERE patient_id = %s OR patient_id = (SELECT MAX(patient_id) FROM patients)
+"""
+
+
+class ResultCache:
+    """
+    LRU cache of CacheEntry objects. Entries are evicted, least recently used
+    first, once all entries together hold more than `max_rows` rows.
+    """
+
+    def __init__(self, max_rows=200000):
+        self.max_rows = max_rows
+        self._entries = OrderedDict()
+        self._rows = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.extends = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._rows -= len(old.rows)
+            if len(entry.rows) > self.max_rows:
+                return
+
+            self._entries[key] = entry
+            self._rows += len(entry.rows)
+            while self._rows > self.max_rows:
+                _, evicted = self._entries.popitem(last=False)
+                self._rows -= len(evicted.rows)
+
+    def invalidate(self, key):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._rows -= len(old.rows)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._rows = 0
+
+    def count(self, outcome):
+        """Adds one to the 'hits', 'extends' or 'misses' counter."""
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'rows': self._rows,
+                'hits': self.hits,
+                'extends': self.extends,
+                'misses': self.misses,
+            }
+
+
+result_cache = ResultCache(max_rows=RESULT_CACHE_MAX_ROWS)
+
+def fetch(cursor, key, select_rows):
+    """
+    Reads whatever the cached result for `key` is missing.
+    select_rows(cursor, after_id, upto_id) must return the raw 'patients' rows of
+    the result with after_id < patient_id <= upto_id, in patient_id order.
+    `cursor` must be a dictionary cursor.
+    Returns: PendingResult, pass it to finish() after releasing the connection
+    Raises: merkle.IncompleteResult if rows were cut off the end of the table
+    """
+    entry = result_cache.get(key) if RESULT_CACHE_ENABLED else None
+
+    cursor.execute(_TAIL_QUERY, (entry.tail_id if entry else 0,))
+    fetched = cursor.fetchall()
+    tail_rows = {row['patient_id']: bytes(row['chain_hash']) for row in fetched}
+    row_count = fetched[0]['row_count'] if fetched else 0
+    tail_id = max(tail_rows, default=0)
+    tail_hash = tail_rows.get(tail_id, crypto.GENESIS_HASH)
+    merkle.check_tail(cursor, tail_id, row_count)
+
+    if entry is not None and entry.tail_id and tail_rows.get(entry.tail_id) != entry.tail_hash:
+        # the table was changed behind the cached tail, start over
+        entry = None
+
+    if row_count != tail_id:
+        # patient_ids are handed out one by one from the chain tail, so a gap
+        # means rows went missing. don't trust the cache, verify everything again
+        entry = None
+
+    if entry is not None and tail_id == entry.tail_id:
+        return PendingResult(key, entry, [], tail_id, tail_hash)
+
+    after_id = entry.tail_id if entry else 0
+    return PendingResult(key, entry, select_rows(cursor, after_id, tail_id), tail_id, tail_hash)
+
+def finish(pending, verify_chain=False, known=None, fields=None):
+    """
+    Decrypts and verifies the rows fetch() read and combines them with the
+    cached ones. With verify_chain the new rows must chain on from the cached
+    tail (or from the genesis hash). `known` and `fields` are passed on to
+    crypto.process_rows, so a projected result needs a key of its own.
+    Results with failed rows or a broken chain are not cached, so their
+    warnings come up again on the next request.
+    Returns: RowBatch over the whole result
+    """
+    entry = pending.entry
+    if entry is not None and pending.tail_id == entry.tail_id:
+        result_cache.count('hits')
+        return crypto.RowBatch(entry.rows, [], entry.tail_hash, None)
+
+    if entry is not None:
+        result_cache.count('extends')
+        batch = crypto.process_rows(pending.raw_rows, verify_chain=verify_chain, previous_hash=entry.tail_hash,
+                                    known=known, fields=fields)
+        rows = entry.rows + batch.rows
+    else:
+        result_cache.count('misses')
+        batch = crypto.process_rows(pending.raw_rows, verify_chain=verify_chain, known=known, fields=fields)
+        rows = batch.rows
+
+    if RESULT_CACHE_ENABLED and not batch.failures and batch.chain_broken_at is None:
+        result_cache.put(pending.key, CacheEntry(pending.tail_id, pending.tail_hash, rows))
+
+    return crypto.RowBatch(rows, batch.failures, batch.last_hash, batch.chain_broken_at)
@@ -0,0 +1,265 @@
+import time
+import multiprocessing
+import mysql.connector
+from concurrent.futures import ProcessPoolExecutor
+from app import app, database, crypto, chain
+
+# Online key rotation
+#
+# Moves every row over to the keys of one key version (default: CURRENT_KEY_ID,
+# see "Key versions" in app/crypto.py) while the server keeps running:
+#
+# 1. stage(): the rows still sealed with another key are read in patient_id
+#    batches, decrypted and verified with their own keys and sealed again with
+#    the new ones (crypto.reseal_row), on a pool of worker processes. The new
+#    values go to the key_rotation table, one commit per batch. 'patients' is not
+#    touched, so nobody notices. This is the slow part, and it is throttled to
+#    KEY_ROTATION_MAX_ROWS_PER_SEC rows a second and a KEY_ROTATION_CPU_SHARE
+#    share of the time so it doesn't starve the requests.
+# 2. switch(): in one transaction the staged values are copied into 'patients'
+#    and the hash chain is rebuilt from the first rotated row (chain.rebuild_chain).
+#    Rows that changed since they were staged, or were written by a server still
+#    on the old key, are re-keyed right there. Nothing else is decrypted, but
+#    writers wait for it. Readers see the old rows until the commit.
+#
+# Reads work the whole time, every row is opened with the keys of its own key_id.
+# Both steps can be stopped and run again, and a row that fails verification is
+# never sealed with the new key.
+
+KEY_ROTATION_BATCH_SIZE = app.config.get('KEY_ROTATION_BATCH_SIZE', 500)
+# 0 re-encrypts on the calling thread
+KEY_ROTATION_WORKERS = app.config.get('KEY_ROTATION_WORKERS', 0)
+# 0 for no limit
+KEY_ROTATION_MAX_ROWS_PER_SEC = app.config.get('KEY_ROTATION_MAX_ROWS_PER_SEC', 0)
+# share of the wall time the job may spend working, it sleeps the rest
+KEY_ROTATION_CPU_SHARE = app.config.get('KEY_ROTATION_CPU_SHARE', 0.5)
+
+# the columns of a row that depend on the key
+REKEY_COLUMNS = (
+    'key_id',
+    'gender', 'gender_nonce',
+    'age', 'age_nonce', 'age_ope',
+    'weight',
+    'gender_bidx', 'first_name_bidx', 'last_name_bidx',
+    'field_macs', 'mac_version', 'row_mac'
+)
+
+# re-encrypted rows waiting for switch(). old_row_mac is the row MAC they were
+# made from, so a row that changed since is noticed
+CREATE_ROTATION_TABLE = """
+CREATE TABLE IF NOT EXISTS key_rotation (
+    patient_id INT PRIMARY KEY,
+    old_row_mac VARBINARY(32) NOT NULL,
+    key_id TINYINT NOT NULL,
+    gender VARBINARY(255),
+    gender_nonce VARBINARY(12),
+    age VARBINARY(255),
+    age_nonce VARBINARY(12),
+    age_ope BIGINT,
+    weight BIGINT,
+    gender_bidx VARBINARY(16),
+    first_name_bidx VARBINARY(16),
+    last_name_bidx VARBINARY(16),
+    field_macs VARBINARY(112),
+    mac_version TINYINT,
+    row_mac VARBINARY(32)
+)
+"""
+
+STAGE_QUERY = (
+    f"REPLACE INTO key_rotation (patient_id, old_row_mac, {', '.join(REKEY_COLUMNS)}) "
+    f"VALUES ({', '.join(['%s'] * (len(REKEY_COLUMNS) + 2))})"
+)
+
+
+class Throttle:
+    """
+    Keeps a batch job within a rows per second and a share of time budget.
+    pause() is called after every batch and sleeps for as long as needed.
+    """
+
+    def __init__(self, max_rows_per_sec=0, cpu_share=1.0):
+        if not 0 < cpu_share <= 1:
+            raise ValueError("cpu_share must be more than 0 and at most 1")
+        self.max_rows_per_sec = max_rows_per_sec
+        self.cpu_share = cpu_share
+        self.slept = 0.0
+
+    def pause(self, rows, busy_seconds):
+        """Sleeps after a batch of `rows` rows that took busy_seconds."""
+        wait = busy_seconds * (1 / self.cpu_share - 1)
+        if self.max_rows_per_sec:
+            wait = max(wait, rows / self.max_rows_per_sec - busy_seconds)
+        if wait > 0:
+            self.slept += wait
+            time.sleep(wait)
+
+
+def _rekey_chunk(rows, key_id):
+    """
+    (Private) Worker entry point, re-keys a chunk of rows.
+    Returns: list of (patient_id, sealed row or None, failure reason or None)
+    """
+    results = []
+    for row in rows:
+        sealed, reason = crypto.reseal_row(row, key_id)
+        results.append((row['patient_id'], sealed, reason))
+    return results
+
+def _rekey_rows(rows, key_id, executor, workers):
+    # (Private) _rekey_chunk() over a batch, split across the pool if there is one
+    if executor is None:
+        return _rekey_chunk(rows, key_id)
+    chunk_size = -(-len(rows) // workers)
+    chunks = [rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size)]
+    results = []
+    for chunk_results in executor.map(_rekey_chunk, chunks, [key_id] * len(chunks)):
+        results.extend(chunk_results)
+    return results
+
+def ensure_table():
+    """Creates the key_rotation table if it doesn't exist yet, on its own connection (CREATE TABLE commits)."""
+    with database.db_connection() as cnx:
+        if not cnx:
+            raise mysql.connector.errors.InterfaceError(msg="Database connection failed")
+        cursor = cnx.cursor()
+        try:
+            cursor.execute(CREATE_ROTATION_TABLE)
+            cnx.commit()
+        finally:
+            cursor.close()
+
+def key_counts(cnx):
+    """Returns: {key_id: number of rows sealed with it}"""
+    cursor = cnx.cursor()
+    try:
+        cursor.execute("SELECT COALESCE(key_id, 1), COUNT(*) FROM patients GROUP BY COALESCE(key_id, 1)")
+        counts = {key_id: count for key_id, count in cursor.fetchall()}
+    finally:
+        cursor.close()
+    cnx.commit()
+    return counts
+
+def stage(cnx, key_id=None, batch_size=None, workers=None, throttle=None):
+    """
+    Step 1: re-encrypts the rows of other keys into key_rotation, batch by batch.
+    Rows already staged (and unchanged since) are skipped.
+    Returns: (rows staged, rows that failed verification)
+    """
+    key_id = crypto.CURRENT_KEY_ID if key_id is None else key_id
+    crypto.get_keys(key_id)  # KeyError for a key that isn't in the keyring
+    batch_size = batch_size or KEY_ROTATION_BATCH_SIZE
+    workers = KEY_ROTATION_WORKERS if workers is None else workers
+    if throttle is None:
+        throttle = Throttle(KEY_ROTATION_MAX_ROWS_PER_SEC, KEY_ROTATION_CPU_SHARE)
+
+    select = (
+        "SELECT p.* FROM patients p LEFT JOIN key_rotation r "
+        "ON r.patient_id = p.patient_id AND r.key_id = %s AND r.old_row_mac = p.row_mac "
+        "WHERE p.patient_id > %s AND COALESCE(p.key_id, 1) != %s AND r.patient_id IS NULL "
+        "ORDER BY p.patient_id ASC LIMIT %s"
+    )
+
+    # 'spawn' like the decrypt pool, so workers never inherit the caller's locks
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) \
+        if workers else None
+    staged = failed = 0
+    last_id = 0
+    cursor = cnx.cursor(dictionary=True)
+    try:
+        while True:
+            start = time.perf_counter()
+            cursor.execute(select, (key_id, last_id, key_id, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1]['patient_id']
+            old_macs = {row['patient_id']: row['row_mac'] for row in rows}
+
+            values = []
+            for patient_id, sealed, reason in _rekey_rows(rows, key_id, executor, workers):
+                if reason:
+                    print(f"WARNING: {reason} for patient_id {patient_id}, not re-keyed")
+                    failed += 1
+                    continue
+                values.append((patient_id, old_macs[patient_id]) + tuple(sealed[column] for column in REKEY_COLUMNS))
+            if values:
+                cursor.executemany(STAGE_QUERY, values)
+            cnx.commit()
+            staged += len(values)
+            print(f"Staged up to patient_id {last_id} ({staged} rows so far).")
+            throttle.pause(len(rows), time.perf_counter() - start)
+    finally:
+        cursor.close()
+        if executor is not None:
+            executor.shutdown()
+    return staged, failed
+
+def switch(cnx, key_id=None, batch_size=None):
+    """
+    Step 2: writes the staged rows to 'patients' and rebuilds the chain from the
+    first row of another key, in one transaction.
+    Returns: number of rows rewritten
+    Raises: chain.ChainBroken if the chain is broken or a row that has to be
+            re-keyed here fails verification (nothing is switched then)
+    """
+    key_id = crypto.CURRENT_KEY_ID if key_id is None else key_id
+    crypto.get_keys(key_id)
+    batch_size = batch_size or KEY_ROTATION_BATCH_SIZE
+
+    cursor = cnx.cursor()
+    try:
+        cursor.execute("SELECT MIN(patient_id) FROM patients WHERE COALESCE(key_id, 1) != %s", (key_id,))
+        first_id = cursor.fetchone()[0]
+    finally:
+        cursor.close()
+    cnx.commit()
+    if first_id is None:
+        return 0
+
+    staged = {}
+    staged_upto = [first_id - 1]  # highest patient_id loaded into `staged`
+
+    def load_staged(patient_id):
+        # the staged rows of the next batch, read inside the rebuild transaction
+        staged.clear()
+        staged_cursor = cnx.cursor(dictionary=True)
+        try:
+            staged_cursor.execute(
+                "SELECT * FROM key_rotation WHERE patient_id >= %s AND patient_id < %s AND key_id = %s",
+                (patient_id, patient_id + batch_size, key_id)
+            )
+            for row in staged_cursor.fetchall():
+                staged[row['patient_id']] = row
+        finally:
+            staged_cursor.close()
+        staged_upto[0] = patient_id + batch_size - 1
+
+    def reseal(row):
+        if crypto.row_key_id(row) == key_id:
+            return tuple(row[column] for column in REKEY_COLUMNS)
+
+        patient_id = row['patient_id']
+        if patient_id > staged_upto[0]:
+            load_staged(patient_id)
+        new = staged.pop(patient_id, None)
+        if (new is not None and bytes(new['old_row_mac']) == bytes(row['row_mac'])
+                and new['mac_version'] == crypto.MAC_VERSION
+                and bytes(new['row_mac']) == crypto.generate_fields_row_mac(patient_id, bytes(new['field_macs']), key_id)):
+            return tuple(new[column] for column in REKEY_COLUMNS)
+
+        # not staged, or changed since
+        sealed, reason = crypto.reseal_row(row, key_id)
+        if reason:
+            raise chain.ChainBroken(f"patient_id {patient_id} failed verification ({reason})")
+        return tuple(sealed[column] for column in REKEY_COLUMNS)
+
+    rewritten = chain.rebuild_chain(cnx, REKEY_COLUMNS, reseal, after_id=first_id - 1, batch_size=batch_size)
+
+    cursor = cnx.cursor()
+    try:
+        cursor.execute("DELETE FROM key_rotation")
+        cnx.commit()
+    finally:
+        cursor.close()
+    return rewritten
@@ -1,11 +1,28 @@
-from flask import request, jsonify, redirect, url_for
-from app import app, bcrypt 
-from . import database, auth
-from . import crypto
+from flask import request, jsonify, redirect, url_for, Response
+from app import app 
+from . import database, auth, passwords, metrics
+from . import crypto, chain, merkle, weight_index, result_cache, stats, snapshot
 import mysql.connector
 import jwt
+import json
+import math
 import datetime
-import hmac
+
+def _redact_row(row, current_user):
+    """
+    Returns the row as the current user may see it.
+    Group R (researchers) never get patient names.
+    """
+    if current_user['user_group'] == 'R':
+        return {k: v for k, v in row.items() if k not in ('first_name', 'last_name')}
+    return row
+
+def _overloaded():
+    """503 for when the bcrypt queue is full, telling the client when to come back."""
+    response = jsonify({"error": "Server busy, please try again shortly."})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(passwords.BCRYPT_RETRY_AFTER)
+    return response
 
 @app.route('/')
 def index():
@@ -35,28 +52,88 @@ def register_user():
             "error": f"Invalid occupation: '{occupation}'. Must be Doctor, Nurse, Admin, or Researcher."
         }), 400
 
-    hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
-
-    cnx = None
-    cursor = None
     try:
-        cnx = database.get_db_connection()
+        hashed_password = passwords.hasher.hash_password(password)
+    except passwords.Overloaded:
+        return _overloaded()
+
+    with database.db_connection() as cnx:
         if not cnx: return jsonify({"error": "Database connection failed"}), 500
-        
+
         cursor = cnx.cursor()
-        query = "INSERT INTO users (username, password_hash, user_group) VALUES (%s, %s, %s)"
-        cursor.execute(query, (username, hashed_password, group))
-        cnx.commit()
-        
-        return jsonify({"message": "User registered successfully"}), 201
-        
-    except mysql.connector.Error as err:
-        if err.errno == 1062:
-             return jsonify({"error": "Username already exists"}), 409
-        return jsonify({"error": f"Database error: {err}"}), 500
-    finally:
-        if cursor: cursor.close()
-        if cnx: cnx.close()
+        try:
+            query = "INSERT INTO users (username, password_hash, user_group) VALUES (%s, %s, %s)"
+            cursor.execute(query, (username, hashed_password, group))
+            cnx.commit()
+            # a user_id handed out again (eg. after the users table was reset) must not inherit a cached group
+            auth.invalidate_principal(cursor.lastrowid)
+            
+            return jsonify({"message": "User registered successfully"}), 201
+            
+        except mysql.connector.Error as err:
+            if err.errno == 1062:
+                 return jsonify({"error": "Username already exists"}), 409
+            return jsonify({"error": f"Database error: {err}"}), 500
+        finally:
+            cursor.close()
+
+# Endpoint: server metrics (latency per endpoint, hot path stages, bcrypt queue, caches)
+# Prometheus text format by default, ?format=json for the same data (and more) as JSON
+#
+# The counters give the table size and query patterns away, so METRICS_ACCESS says
+# who may read them:
+#   'local'  (default) only requests from this host, eg. a Prometheus next to the server
+#   'token'  a login token, like every other endpoint
+#   'public' anyone
+METRICS_ACCESS = app.config.get('METRICS_ACCESS', 'local')
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    if METRICS_ACCESS == 'token':
+        return _get_metrics_with_token()
+    if METRICS_ACCESS != 'public' and request.remote_addr not in LOCAL_ADDRESSES:
+        return jsonify({"error": "Access Denied: metrics are only served to this host."}), 403
+    return _metrics_response()
+
+@auth.token_required
+def _get_metrics_with_token(current_user):
+    return _metrics_response()
+
+def _metrics_response():
+    bcrypt_stats = passwords.hasher.stats()
+    pool = database.pool_stats()
+    principals = auth.principal_cache.stats()
+    results = result_cache.result_cache.stats()
+    ope = crypto.ope_cache.stats()
+
+    if request.args.get('format') == 'json':
+        return jsonify({
+            'endpoints': metrics.latency.stats(),
+            'hot_path': metrics.counters.stats(),
+            'bcrypt': bcrypt_stats,
+            'db_pool': pool,
+            'principal_cache': principals,
+            'result_cache': results,
+            'ope_cache': ope,
+            'ope_table': crypto.ope_table_stats(),
+        })
+
+    gauges = {
+        'bcrypt_in_flight': bcrypt_stats['in_flight'],
+        'bcrypt_rejected_total': bcrypt_stats['rejected'],
+        'result_cache_rows': results['rows'],
+        'result_cache_hits_total': results['hits'],
+        'result_cache_misses_total': results['misses'],
+        'ope_cache_size': ope['size'],
+        'ope_cache_hits_total': ope['hits'],
+        'ope_cache_misses_total': ope['misses'],
+        'db_pool_open': pool['open'],
+        'db_pool_in_use': pool['in_use'],
+        'db_pool_waits_total': pool['waits'],
+        'db_pool_timeouts_total': pool['timeouts'],
+    }
+    return Response(metrics.prometheus_text(gauges), mimetype='text/plain; version=0.0.4')
 
 # Endpoint: user login
 @app.route('/login', methods=['POST'])
@@ -68,34 +145,58 @@ def login_user():
     except KeyError:
         return jsonify({"error": "Missing 'username' or 'password'"}), 400
 
-    cnx = None
-    cursor = None
-    try:
-        cnx = database.get_db_connection()
+    with database.db_connection() as cnx:
         if not cnx: return jsonify({"error": "Database connection failed"}), 500
-            
-        cursor = cnx.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM users WHERE username = %s", (username,))
-        user = cursor.fetchone()
 
-        if not user or not bcrypt.check_password_hash(user['password_hash'], password):
+        cursor = cnx.cursor(dictionary=True)
+        try:
+            cursor.execute("SELECT * FROM users WHERE username = %s", (username,))
+            user = cursor.fetchone()
+        except mysql.connector.Error as err:
+            return jsonify({"error": f"Database error: {err}"}), 500
+        finally:
+            cursor.close()
+
+    # the connection is already back in the pool while bcrypt runs
+    try:
+        if not user or not passwords.hasher.check_password(user['password_hash'], password):
             return jsonify({"error": "Invalid username or password"}), 401
-            
-        token_payload = {
-            'user_id': user['user_id'],
-            'username': user['username'],
-            'group': user['user_group'],
-            'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=24)
-        }
-        token = jwt.encode(token_payload, app.config['JWT_SECRET_KEY'], algorithm="HS256")
+    except passwords.Overloaded:
+        return _overloaded()
         
-        return jsonify({"message": "Login successful", "token": token, "group": user['user_group']})
+    token_payload = {
+        'user_id': user['user_id'],
+        'username': user['username'],
+        'group': user['user_group'],
+        'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=24)
+    }
+    token = jwt.encode(token_payload, app.config['JWT_SECRET_KEY'], algorithm="HS256")
+    
+    return jsonify({"message": "Login successful", "token": token, "group": user['user_group']})
 
-    except mysql.connector.Error as err:
-        return jsonify({"error": f"Database error: {err}"}), 500
-    finally:
-        if cursor: cursor.close()
-        if cnx: cnx.close()
+#
+# Projection
+#
+# /query_all, /query_by_weight and /query take ?fields=weight,height to return
+# only patient_id and those fields. On rows with per-field MACs (mac_version 2)
+# only the requested fields are decrypted and verified, so eg. leaving out
+# weight skips OPE decryption. The hash chain is verified as usual.
+#
+def _projection():
+    """Returns: (tuple of fields in crypto.MAC_FIELDS order, or None for whole rows, None), or (None, error response)"""
+    value = request.args.get('fields')
+    if value is None:
+        return None, None
+
+    names = {name.strip() for name in value.split(',') if name.strip()}
+    # patient_id always comes back
+    names.discard('patient_id')
+    unknown = names - set(crypto.MAC_FIELDS)
+    if unknown or not value.strip():
+        return None, (jsonify({
+            "error": f"'fields' must be a comma separated list of {', '.join(('patient_id',) + crypto.MAC_FIELDS)}"
+        }), 400)
+    return tuple(field for field in crypto.MAC_FIELDS if field in names), None
 
 #
 # Endpoint: Getting All Patient Data (OPE Enabled)
@@ -103,100 +204,286 @@ def login_user():
 @app.route('/query_all', methods=['GET'])
 @auth.token_required
 def get_all_patients(current_user):
-    cnx = None
-    cursor = None
-    try:
-        cnx = database.get_db_connection()
-        if not cnx: return jsonify({"error": "Database connection failed"}), 500
-            
+    fields, error = _projection()
+    if error:
+        return error
+
+    # ?stream=ndjson or ?stream=json sends rows as they are verified
+    stream_format = request.args.get('stream')
+    if stream_format:
+        if stream_format not in STREAM_MIMETYPES:
+            return jsonify({"error": "'stream' must be 'ndjson' or 'json'"}), 400
+        return Response(
+            _stream_patients(current_user, stream_format, fields),
+            mimetype=STREAM_MIMETYPES[stream_format]
+        )
+
+    # ?limit=N returns one page at a time
+    if 'limit' in request.args:
+        return _get_patient_page(current_user, fields)
+
+    batch, error = _load_all_patients(fields)
+    if error:
+        return error
+    with metrics.timed('json'):
+        return jsonify([_redact_row(row, current_user) for row in batch.rows])
+
+def _load_all_patients(fields=None):
+    """
+    fields is a projection from _projection(), None for whole rows.
+    Returns: (RowBatch of the whole verified table, None), or (None, error response)
+    """
+    with database.db_connection() as cnx:
+        if not cnx: return None, (jsonify({"error": "Database connection failed"}), 500)
+
         cursor = cnx.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM patients ORDER BY patient_id ASC")
-        results = cursor.fetchall()
+        try:
+            # only the rows added since the cached result are read
+            pending = result_cache.fetch(cursor, ('all', fields), _select_all_rows)
+        except mysql.connector.Error as err:
+            return None, (jsonify({"error": f"Database query failed: {err}"}), 500)
+        except merkle.IncompleteResult as err:
+            print(f"FATAL: Query Completeness FAILED! {err}.")
+            return None, (jsonify({"error": "Query Failed: Data is missing or out of order."}), 500)
+        finally:
+            cursor.close()
+
+    # the connection is back in the pool before we start decrypting.
+    # rows in the snapshot skip decryption, their MACs are still checked
+    batch = result_cache.finish(pending, verify_chain=True, known=snapshot.known_values(), fields=fields)
+
+    for patient_id, reason in batch.failures:
+        print(f"WARNING: {reason} for patient_id {patient_id}")
+
+    if batch.chain_broken_at is not None:
+        print(f"FATAL: Query Completeness FAILED! Chain broken at patient_id {batch.chain_broken_at}.")
+        return None, (jsonify({"error": "Query Failed: Data is missing or out of order."}), 500)
+
+    if not batch.failures and fields is None:
+        snapshot.record(batch.rows, batch.last_hash)
+    return batch, None
+
+def _select_all_rows(cursor, after_id, upto_id):
+    cursor.execute(
+        "SELECT * FROM patients WHERE patient_id > %s AND patient_id <= %s ORDER BY patient_id ASC",
+        (after_id, upto_id)
+    )
+    return cursor.fetchall()
 
-        plaintext_results = []
-        last_known_hash = crypto.GENESIS_HASH
+#
+# Paginated version of /query_all
+#
+# /query_all?limit=N                      first page, verified from the genesis hash
+# /query_all?limit=N&cursor=<next_cursor> next page, verified from the signed cursor
+# /query_all?limit=N&after_id=X           page after patient X, verified from the
+#                                         nearest signed checkpoint before X
+#
+# Pages are read by primary key (patient_id > X LIMIT N), so a page costs the same
+# no matter how deep into the table it is. The page is complete if its first row
+# chains from the anchor hash and every row chains from the one before it.
+# For after_id the anchor is found by replaying at most CHECKPOINT_INTERVAL
+# stored row MACs from the checkpoint (see chain.chain_hash_at). An after_id at
+# or past the tail gets an empty page without a next_cursor.
+# A key switch or the row MAC migration rewrites every chain_hash, so a cursor
+# from before it no longer chains to its page. Its patient_id is still signed,
+# so such a page is anchored like an after_id one instead ("anchor": "checkpoint").
+#
+PAGE_SIZE_MAX = app.config.get('PAGE_SIZE_MAX', 1000)
+
+def _get_patient_page(current_user, fields=None):
+    limit = request.args.get('limit', type=int)
+    if not limit or limit < 1 or limit > PAGE_SIZE_MAX:
+        return jsonify({"error": f"'limit' must be between 1 and {PAGE_SIZE_MAX}"}), 400
+
+    token = request.args.get('cursor')
+    after_id = request.args.get('after_id', type=int)
+    if after_id is not None and after_id < 0:
+        return jsonify({"error": "'after_id' can't be negative"}), 400
+    anchor_hash = None
+
+    if token:
+        opened = crypto.open_cursor(token)
+        if not opened:
+            return jsonify({"error": "Invalid cursor"}), 400
+        after_id, anchor_hash = opened
+        anchor = 'cursor'
+    elif not after_id:
+        after_id, anchor_hash = 0, crypto.GENESIS_HASH
+        anchor = 'genesis'
+    else:
+        anchor = 'checkpoint'
+
+    with database.db_connection() as cnx:
+        if not cnx: return jsonify({"error": "Database connection failed"}), 500
 
-        for row in results:
-            try:
-                # 1. Decrypt (Confidentiality)
-                decrypted_gender = crypto.decrypt_field(row['gender'], row['gender_nonce'], bool)
-                decrypted_age = crypto.decrypt_field(row['age'], row['age_nonce'], int)
-                
-                raw_weight = crypto.ope_decrypt(row['weight'])
-                if raw_weight is not None:
-                    decrypted_weight = round(raw_weight, 2)
-                else:
-                    decrypted_weight = None
-
-                if decrypted_gender is None or decrypted_age is None or decrypted_weight is None:
-                    print(f"WARNING: Decryption FAILED for patient_id {row['patient_id']}")
-                    continue 
-
-                row_height = row['height']
-                if row_height is not None:
-                    row_height = round(float(row_height), 2)
-
-                # 2. Verify Integrity
-                is_valid = crypto.verify_row_mac(
-                    row['first_name'],
-                    row['last_name'],
-                    decrypted_gender, 
-                    decrypted_age,
-                    decrypted_weight, 
-                    row_height,
-                    row['health_history'],
-                    row['row_mac']
-                )
-
-                if not is_valid:
-                    print(f"WARNING: Integrity check FAILED for patient_id {row['patient_id']}")
-                    continue
-                    
-                # 3. Verify Completeness
-                current_data_hash = crypto.generate_row_mac(
-                    row['first_name'], row['last_name'],
-                    decrypted_gender, decrypted_age,
-                    decrypted_weight,
-                    row_height,
-                    row['health_history']
-                )
-                
-                expected_chain_hash = crypto.generate_chain_hash(current_data_hash, last_known_hash)
-                
-                if not hmac.compare_digest(expected_chain_hash, row['chain_hash']):
-                    print(f"FATAL: Query Completeness FAILED! Chain broken at patient_id {row['patient_id']}.")
+        cursor = cnx.cursor(dictionary=True)
+        try:
+            if anchor_hash is None:
+                tail_id, _ = chain.read_tail(cursor)
+                if after_id >= tail_id:
+                    # nothing after it. still make sure the table wasn't cut short
+                    merkle.check_tail(cursor, tail_id)
+                    return jsonify({"rows": [], "next_cursor": None, "next_after_id": after_id,
+                                    "has_more": False, "anchor": anchor})
+                anchor_hash = chain.chain_hash_at(cursor, after_id)
+                if anchor_hash is None:
+                    print(f"FATAL: Query Completeness FAILED! Chain does not reach patient_id {after_id} from its checkpoint.")
                     return jsonify({"error": "Query Failed: Data is missing or out of order."}), 500
 
-                last_known_hash = row['chain_hash']
-
-                # 4. Build Plaintext Row
-                row['gender'] = decrypted_gender
-                row['age'] = decrypted_age
-                row['weight'] = decrypted_weight
-                row['height'] = row_height
-                
-                if current_user['user_group'] == 'R':
-                    del row['first_name']
-                    del row['last_name']
-
-                del row['gender_nonce']
-                del row['age_nonce']
-                del row['row_mac']
-                del row['chain_hash']
-                
-                plaintext_results.append(row)
-                
-            except Exception as e:
-                print(f"Error processing row {row.get('patient_id')}: {e}")
-                continue
-
-        return jsonify(plaintext_results)
+            cursor.execute(
+                "SELECT * FROM patients WHERE patient_id > %s ORDER BY patient_id ASC LIMIT %s",
+                (after_id, limit)
+            )
+            results = cursor.fetchall()
+            if anchor == 'cursor' and results and (
+                    crypto.generate_chain_hash(results[0]['row_mac'], anchor_hash) != bytes(results[0]['chain_hash'] or b'')):
+                # the chain was rebuilt after the cursor was handed out (key switch or
+                # row MAC migration). the position is still good, so we anchor on the
+                # trusted chain_hash of that row instead. a broken chain still fails below
+                trusted_hash = chain.chain_hash_at(cursor, after_id)
+                if trusted_hash is not None:
+                    anchor_hash, anchor = trusted_hash, 'checkpoint'
+            if len(results) < limit:
+                # the last page, it must reach the end of the signed tree
+                merkle.check_tail(cursor, results[-1]['patient_id'] if results else after_id)
+        except mysql.connector.Error as err:
+            return jsonify({"error": f"Database query failed: {err}"}), 500
+        except merkle.IncompleteResult as err:
+            print(f"FATAL: Query Completeness FAILED! {err}.")
+            return jsonify({"error": "Query Failed: Data is missing or out of order."}), 500
+        finally:
+            cursor.close()
+
+    batch = crypto.process_rows(results, verify_chain=True, previous_hash=anchor_hash, fields=fields)
+
+    for patient_id, reason in batch.failures:
+        print(f"WARNING: {reason} for patient_id {patient_id}")
+
+    if batch.chain_broken_at is not None:
+        print(f"FATAL: Query Completeness FAILED! Chain broken at patient_id {batch.chain_broken_at}.")
+        return jsonify({"error": "Query Failed: Data is missing or out of order."}), 500
+
+    # the next page starts after the last row we verified
+    last_id = batch.rows[-1]['patient_id'] if batch.rows else after_id
+    next_cursor = crypto.sign_cursor(last_id, batch.last_hash)
+
+    with metrics.timed('json'):
+        return jsonify({
+            "rows": [_redact_row(row, current_user) for row in batch.rows],
+            "next_cursor": next_cursor,
+            "next_after_id": last_id,
+            "has_more": len(results) == limit,
+            "anchor": anchor
+        })
 
-    except mysql.connector.Error as err:
-        return jsonify({"error": f"Database query failed: {err}"}), 500
-    finally:
-        if cursor: cursor.close()
-        if cnx: cnx.close()
+#
+# Streaming version of /query_all
+#
+# Rows are read from an unbuffered cursor STREAM_BATCH_SIZE at a time, verified
+# against the hash chain batch by batch and written out straight away, so the
+# whole table is never held in memory.
+#
+# ndjson: one record per line,
+#   {"type": "row", "data": {...}}
+#   ...
+#   {"type": "trailer", "status": "ok", "rows": 120, "dropped": 0, "last_patient_id": 120}
+# json: {"rows": [{...}, ...], "trailer": {...}}
+#
+# The trailer is always the last record. If the hash chain breaks mid-stream the
+# rows already sent are followed by a trailer with "status": "chain_broken" and
+# the patient_id where it broke, so the client must discard the result. Rows cut
+# off the end of the table (see merkle.check_tail) are reported the same way,
+# with the first missing patient_id.
+#
+STREAM_BATCH_SIZE = app.config.get('STREAM_BATCH_SIZE', 500)
+STREAM_MIMETYPES = {'ndjson': 'application/x-ndjson', 'json': 'application/json'}
+
+def _stream_patients(current_user, stream_format, fields=None):
+    dumps = app.json.dumps
+    ndjson = stream_format == 'ndjson'
+    sent = 0
+    dropped = 0
+    last_patient_id = None
+
+    def row_record(row):
+        if ndjson:
+            return dumps({"type": "row", "data": row}) + "\n"
+        return ('' if sent == 0 else ',') + dumps(row)
+
+    def trailer_record(trailer):
+        if ndjson:
+            return dumps({"type": "trailer", **trailer}) + "\n"
+        return '],"trailer":' + dumps(trailer) + '}'
+
+    if not ndjson:
+        yield '{"rows":['
+
+    with database.db_connection() as cnx:
+        if not cnx:
+            yield trailer_record({"status": "error", "error": "Database connection failed", "rows": 0})
+            return
+
+        cursor = cnx.cursor(dictionary=True, buffered=False)
+        try:
+            cursor.execute("SELECT * FROM patients ORDER BY patient_id ASC")
+            last_known_hash = crypto.GENESIS_HASH
+            last_read_id = 0
+
+            while True:
+                rows = cursor.fetchmany(STREAM_BATCH_SIZE)
+                if not rows:
+                    break
+                last_read_id = rows[-1]['patient_id']
+
+                batch = crypto.process_rows(rows, verify_chain=True, previous_hash=last_known_hash, fields=fields)
+                for patient_id, reason in batch.failures:
+                    print(f"WARNING: {reason} for patient_id {patient_id}")
+                dropped += len(batch.failures)
+
+                for row in batch.rows:
+                    yield row_record(_redact_row(row, current_user))
+                    sent += 1
+                    last_patient_id = row['patient_id']
+
+                if batch.chain_broken_at is not None:
+                    print(f"FATAL: Query Completeness FAILED! Chain broken at patient_id {batch.chain_broken_at}.")
+                    yield trailer_record({
+                        "status": "chain_broken",
+                        "error": "Query Failed: Data is missing or out of order.",
+                        "patient_id": batch.chain_broken_at,
+                        "rows": sent
+                    })
+                    return
+
+                last_known_hash = batch.last_hash
+
+            tail_cursor = cnx.cursor()
+            try:
+                merkle.check_tail(tail_cursor, last_read_id)
+            except merkle.IncompleteResult as err:
+                print(f"FATAL: Query Completeness FAILED! {err}.")
+                yield trailer_record({
+                    "status": "chain_broken",
+                    "error": "Query Failed: Data is missing or out of order.",
+                    "patient_id": last_read_id + 1,
+                    "rows": sent
+                })
+                return
+            finally:
+                tail_cursor.close()
+
+            yield trailer_record({
+                "status": "ok", "rows": sent, "dropped": dropped, "last_patient_id": last_patient_id
+            })
+
+        except mysql.connector.Error as err:
+            yield trailer_record({"status": "error", "error": f"Database query failed: {err}", "rows": sent})
+        finally:
+            try:
+                cursor.close()
+            except mysql.connector.Error:
+                # rows left unread after an early stop, the pool drops this connection
+                pass
 
 #
 # Endpoint: Adding a New Patient (OPE Enabled)
@@ -207,83 +494,161 @@ def add_patient(current_user):
     if current_user['user_group'] != 'H':
         return jsonify({"error": "Access Denied: Only users from Group H can add new data."}), 403
 
-    data = request.json
-    
-    INSERT_PATIENT_QUERY = """
-    INSERT INTO patients (
-        first_name, last_name, 
-        gender, gender_nonce,
-        age, age_nonce,
-        weight, height, health_history,
-        row_mac, chain_hash
-    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-    """
-    
-    cnx = None
-    cursor = None
     try:
+        patient = _parse_patient(request.json)
+    except KeyError:
+        return jsonify({"error": "Missing data in request JSON."}), 400
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": f"Invalid data in request JSON: {e}"}), 400
+
+    # 1-3. Encrypt and Generate Integrity Seal
+    sealed = crypto.seal_patient(*patient)
+    if sealed is None:
+         return jsonify({"error": "Encryption failed for weight"}), 500
+
+    # 4-6. Chain onto the previous row and Insert Data
+    with database.db_connection() as cnx:
+        if not cnx: return jsonify({"error": "Database connection failed"}), 500
         try:
-            first_name, last_name, gender, age, weight, height, health_history = (
-                data['first_name'], data['last_name'], data['gender'],
-                data['age'], data['weight'], data['height'], data['health_history']
-            )
-            # Rounding BEFORE encryption ensures consistency
-            weight = round(float(weight), 2)
-            height = round(float(height), 2)
-            
-        except KeyError:
-            return jsonify({"error": "Missing data in request JSON."}), 400
-        
-        # 1. Encrypt Standard Fields
-        gender_ct, gender_nonce = crypto.encrypt_field(gender)
-        age_ct, age_nonce = crypto.encrypt_field(age)
-
-        # 2. Encrypt Weight (OPE)
-        encrypted_weight = crypto.ope_encrypt(weight)
-        if encrypted_weight is None:
-             return jsonify({"error": "Encryption failed for weight"}), 500
-
-        # 3. Generate Integrity Seal
-        row_mac = crypto.generate_row_mac(
-            first_name, last_name, gender, age, weight, height, health_history
-        )
+            patient_id, = chain.append_patients(cnx, [sealed])
+        except mysql.connector.Error as err:
+            return jsonify({"error": f"Database insert failed: {err}"}), 500
+
+    return jsonify({
+        "message": "Patient added successfully", 
+        "patient_id": patient_id
+    }), 201
+
+#
+# Endpoint: Adding Many Patients at Once
+#
+# Accepts a JSON array of patients, or NDJSON (one patient per line) with
+# Content-Type: application/x-ndjson. Every valid row is encrypted, the hash
+# chain is extended in memory from a single tail read, and all rows are written
+# with one executemany() in one transaction. Invalid rows are skipped and
+# reported by their position in the input.
+#
+BULK_MAX_ROWS = app.config.get('BULK_MAX_ROWS', 10000)
+
+@app.route('/add_data/bulk', methods=['POST'])
+@auth.token_required
+def add_patients_bulk(current_user):
+    if current_user['user_group'] != 'H':
+        return jsonify({"error": "Access Denied: Only users from Group H can add new data."}), 403
 
-        # 4. Get Previous Hash
-        cnx = database.get_db_connection()
+    errors = []
+    if request.mimetype == 'application/x-ndjson':
+        items = []
+        for index, line in enumerate(request.get_data(as_text=True).splitlines()):
+            if not line.strip():
+                continue
+            try:
+                items.append((index, json.loads(line)))
+            except ValueError as e:
+                errors.append({"index": index, "error": f"Invalid JSON: {e}"})
+    else:
+        data = request.get_json(silent=True)
+        if not isinstance(data, list):
+            return jsonify({"error": "Expected a JSON array of patients or NDJSON."}), 400
+        items = list(enumerate(data))
+
+    if len(items) > BULK_MAX_ROWS:
+        return jsonify({"error": f"Too many rows, the limit is {BULK_MAX_ROWS} per request."}), 413
+
+    # validating and encrypting everything before we touch the database
+    sealed_rows = []
+    for index, item in items:
+        try:
+            sealed = crypto.seal_patient(*_parse_patient(item))
+        except KeyError as e:
+            errors.append({"index": index, "error": f"Missing field {e}"})
+            continue
+        except (TypeError, ValueError) as e:
+            errors.append({"index": index, "error": f"Invalid data: {e}"})
+            continue
+        if sealed is None:
+            errors.append({"index": index, "error": "Encryption failed for weight"})
+            continue
+        sealed_rows.append(sealed)
+
+    errors.sort(key=lambda e: e["index"])
+    if not sealed_rows:
+        return jsonify({"error": "No valid rows to insert.", "inserted": 0, "errors": errors}), 400
+
+    with database.db_connection() as cnx:
         if not cnx: return jsonify({"error": "Database connection failed"}), 500
-        cursor = cnx.cursor()
+        try:
+            patient_ids = chain.append_patients(cnx, sealed_rows)
+        except mysql.connector.Error as err:
+            return jsonify({"error": f"Database insert failed: {err}"}), 500
+
+    return jsonify({
+        "message": f"{len(patient_ids)} patients added successfully",
+        "inserted": len(patient_ids),
+        "patient_ids": patient_ids,
+        "errors": errors
+    }), 201
+
+def _finite_float(value):
+    """float() that refuses nan and the infinities, which OPE can't encrypt. Raises ValueError"""
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError(f"{value} is not a finite number")
+    return value
+
+def _parse_patient(data):
+    """
+    Pulls the 7 patient fields out of a request object.
+    Raises KeyError for a missing field and TypeError/ValueError for a bad one.
+    """
+    if not isinstance(data, dict):
+        raise TypeError("expected a JSON object")
 
-        cursor.execute("SELECT chain_hash FROM patients WHERE patient_id = (SELECT MAX(patient_id) FROM patients)")
-        result = cursor.fetchone()
-        previous_hash = result[0] if result else crypto.GENESIS_HASH
-            
-        # 5. Generate New Chain Hash
-        new_chain_hash = crypto.generate_chain_hash(row_mac, previous_hash)
-
-        # 6. Insert Data
-        patient_data_tuple = (
-            first_name, last_name,
-            gender_ct, gender_nonce,
-            age_ct, age_nonce,
-            encrypted_weight, 
-            height, health_history,
-            row_mac, new_chain_hash
-        )
+    first_name, last_name, gender, age, weight, height, health_history = (
+        data['first_name'], data['last_name'], data['gender'],
+        data['age'], data['weight'], data['height'], data['health_history']
+    )
+    # Rounding BEFORE encryption ensures consistency
+    weight = round(_finite_float(weight), 2)
+    height = round(_finite_float(height), 2)
 
-        cursor.execute(INSERT_PATIENT_QUERY, patient_data_tuple)
-        cnx.commit()
-        
-        return jsonify({
-            "message": "Patient added successfully", 
-            "patient_id": cursor.lastrowid
-        }), 201
+    return first_name, last_name, gender, age, weight, height, health_history
 
-    except mysql.connector.Error as err:
-        if cnx: cnx.rollback()
-        return jsonify({"error": f"Database insert failed: {err}"}), 500
-    finally:
-        if cursor: cursor.close()
-        if cnx: cnx.close()
+#
+# Searching with more than one key version
+#
+# OPE ciphertexts and blind index tokens depend on the key, so while a key
+# rotation is under way (app/rotation.py) every search value is made once per
+# key in the keyring and matched only against rows of that key_id. With a
+# single key the SQL is the same as it always was.
+#
+def _keyed_where(build):
+    """
+    build(key_id) returns (list of SQL conditions, list of their params) for the keys of key_id.
+    Returns: (WHERE clause, params) matching rows of any key version
+    """
+    if len(crypto.KEY_IDS) == 1:
+        conditions, params = build(crypto.KEY_IDS[0])
+        return ' AND '.join(conditions), list(params)
+
+    parts = []
+    params = []
+    for key_id in crypto.KEY_IDS:
+        conditions, key_params = build(key_id)
+        parts.append(f"(COALESCE(key_id, 1) = %s AND {' AND '.join(conditions)})")
+        params += [key_id] + list(key_params)
+    return '(' + ' OR '.join(parts) + ')', params
+
+def _weight_bounds(min_weight, max_weight):
+    """Returns: {key_id: (encrypted min, encrypted max)} for every key, or None if encryption failed"""
+    bounds = {}
+    for key_id in crypto.KEY_IDS:
+        encrypted_min = crypto.ope_encrypt(min_weight, key_id)
+        encrypted_max = crypto.ope_encrypt(max_weight, key_id)
+        if encrypted_min is None or encrypted_max is None:
+            return None
+        bounds[key_id] = (encrypted_min, encrypted_max)
+    return bounds
 
 #
 # Endpoint: Search by Weight (OPE Range Query)
@@ -291,78 +656,250 @@ def add_patient(current_user):
 @app.route('/query_by_weight', methods=['GET'])
 @auth.token_required
 def query_by_weight(current_user):
+    if request.args.get('min') is None or request.args.get('max') is None:
+        return jsonify({"error": "Missing 'min' or 'max' parameters"}), 400
     try:
-        min_weight = request.args.get('min', type=float)
-        max_weight = request.args.get('max', type=float)
-        if min_weight is None or max_weight is None:
-            return jsonify({"error": "Missing 'min' or 'max' parameters"}), 400
+        min_weight = _finite_float(request.args['min'])
+        max_weight = _finite_float(request.args['max'])
     except ValueError:
         return jsonify({"error": "Invalid numbers"}), 400
+    fields, error = _projection()
+    if error:
+        return error
 
-    encrypted_min = crypto.ope_encrypt(min_weight)
-    encrypted_max = crypto.ope_encrypt(max_weight)
-    
-    query = "SELECT * FROM patients WHERE weight BETWEEN %s AND %s ORDER BY patient_id ASC"
+    bounds = _weight_bounds(min_weight, max_weight)
+    where, params = _keyed_where(lambda key_id: (
+        ["weight BETWEEN %s AND %s"], bounds[key_id] if bounds else (None, None)))
+
+    query = f"""SELECT * FROM patients WHERE {where}
+               AND patient_id > %s AND patient_id <= %s ORDER BY patient_id ASC"""
     
-    cnx = None
-    cursor = None
-    try:
-        cnx = database.get_db_connection()
+    with database.db_connection() as cnx:
         if not cnx: return jsonify({"error": "DB failed"}), 500
+
+        def select_rows(cursor, after_id, upto_id):
+            if weight_index.WEIGHT_INDEX_ENABLED and bounds is not None:
+                # resolve the range in memory, then fetch only those rows by primary key.
+                # with a Merkle tree the index is proven, so nothing can be left out
+                for attempt in range(2):
+                    index_cursor = cnx.cursor()
+                    try:
+                        patient_ids, leaves = weight_index.weight_index.lookup_ranges(index_cursor, bounds)
+                    finally:
+                        index_cursor.close()
+                    wanted = [n for n, i in enumerate(patient_ids) if after_id < i <= upto_id]
+                    try:
+                        return weight_index.fetch_rows(
+                            cursor, [patient_ids[n] for n in wanted], None, None, key_bounds=bounds,
+                            leaves=[leaves[n] for n in wanted] if leaves is not None else None)
+                    except weight_index.IncompleteResult:
+                        # the rows may have been rewritten since the lookup (eg. a key rotation)
+                        if attempt:
+                            raise
+
+            cursor.execute(query, tuple(params) + (after_id, upto_id))
+            return cursor.fetchall()
+
         cursor = cnx.cursor(dictionary=True)
-        cursor.execute(query, (encrypted_min, encrypted_max))
-        results = cursor.fetchall()
-        
-        plaintext_results = []
-        for row in results:
-            try:
-                decrypted_gender = crypto.decrypt_field(row['gender'], row['gender_nonce'], bool)
-                decrypted_age = crypto.decrypt_field(row['age'], row['age_nonce'], int)
-                
-                # --- SAFETY FIX: Check None ---
-                raw_weight = crypto.ope_decrypt(row['weight'])
-                if raw_weight is not None:
-                    decrypted_weight = round(raw_weight, 2)
-                else:
-                    decrypted_weight = None
-
-                if decrypted_gender is None or decrypted_age is None or decrypted_weight is None:
-                    continue
-
-                # --- SAFETY FIX: Check None for height ---
-                row_height = row['height']
-                if row_height is not None:
-                    row_height = round(float(row_height), 2)
-
-                is_valid = crypto.verify_row_mac(
-                    row['first_name'], row['last_name'],
-                    decrypted_gender, decrypted_age, decrypted_weight,
-                    row_height,
-                    row['health_history'], row['row_mac']
-                )
-                if not is_valid: continue
-
-                row['gender'] = decrypted_gender
-                row['age'] = decrypted_age
-                row['weight'] = decrypted_weight
-                row['height'] = row_height
-
-                if current_user['user_group'] == 'R':
-                    del row['first_name']
-                    del row['last_name']
-                
-                del row['gender_nonce']
-                del row['age_nonce']
-                del row['row_mac']
-                del row['chain_hash']
-                
-                plaintext_results.append(row)
-            except:
-                continue
+        try:
+            pending = result_cache.fetch(cursor, ('weight', tuple(params), fields), select_rows)
+        except mysql.connector.Error as err:
+            return jsonify({"error": str(err)}), 500
+        except merkle.IncompleteResult as err:
+            print(f"FATAL: Query Completeness FAILED! Weight search can't be proven complete: {err}.")
+            return jsonify({"error": "Query Failed: Data is missing or out of order."}), 500
+        finally:
+            cursor.close()
+
+    # the connection is back in the pool before we start decrypting
+    batch = result_cache.finish(pending, fields=fields)
+    with metrics.timed('json'):
+        return jsonify([_redact_row(row, current_user) for row in batch.rows])
+
+#
+# Endpoint: Search by age, weight, gender and name
+#
+# /query?age_min=30&age_max=40                        patients aged 30 to 40
+# /query?age_min=30&weight_min=60&weight_max=80       combined, any bound may be left out
+# /query?last_name=Smith&first_name=Jane              exact match (case and spacing don't matter)
+# /query?gender=female&age_min=65                     gender is male or female
+#
+# Range bounds are OPE encrypted and equality values turned into blind index
+# tokens, and MySQL filters on the indexed age_ope, weight and *_bidx columns,
+# so only the matching rows are ever decrypted. Each row is checked against
+# the plaintext filters again once decrypted, since those columns are not
+# covered by the row MAC.
+#
+QUERY_BOUNDS = (('age_min', int), ('age_max', int), ('weight_min', _finite_float), ('weight_max', _finite_float))
+QUERY_GENDERS = {'male': True, 'true': True, 'female': False, 'false': False}
+# the largest weight OPE can encrypt (327.67 with pyope's default domain)
+WEIGHT_OPE_MAX = crypto.ope_cipher.in_range.end / crypto.OPE_PRECISION
+# patient_id is a MySQL INT
+PATIENT_ID_MAX = 2**31 - 1
+
+def _query_filters():
+    """Returns: ({parameter: value}, None), or (None, error response)"""
+    filters = {}
+    for name, convert in QUERY_BOUNDS:
+        value = request.args.get(name)
+        if value is None:
+            continue
+        try:
+            filters[name] = convert(value)
+        except ValueError:
+            return None, (jsonify({"error": f"'{name}' must be a number"}), 400)
+
+    gender = request.args.get('gender')
+    if gender is not None:
+        if gender.lower() not in QUERY_GENDERS:
+            return None, (jsonify({"error": "'gender' must be 'male' or 'female'"}), 400)
+        filters['gender'] = QUERY_GENDERS[gender.lower()]
+
+    for name in ('first_name', 'last_name'):
+        value = request.args.get(name)
+        if value is not None and crypto.normalize_name(value):
+            filters[name] = value
+
+    if not filters:
+        names = ", ".join([name for name, _ in QUERY_BOUNDS] + ['gender', 'first_name', 'last_name'])
+        return None, (jsonify({"error": f"Give at least one of {names}"}), 400)
+    return filters, None
+
+@app.route('/query', methods=['GET'])
+@auth.token_required
+def query_patients(current_user):
+    filters, error = _query_filters()
+    if error:
+        return error
+    fields, error = _projection()
+    if error:
+        return error
+    # researchers never see names, so they can't search by them either
+    if current_user['user_group'] == 'R' and ('first_name' in filters or 'last_name' in filters):
+        return jsonify({"error": "Access Denied: Only users from Group H can search by name."}), 403
+
+    conditions = []  # (SQL, function of key_id returning its params)
+    checks = []  # functions the decrypted rows must pass
+    checked = set()  # fields those need, decrypted even if not asked for
+
+    if 'age_min' in filters or 'age_max' in filters:
+        age_min = max(filters.get('age_min', 0), 0)
+        age_max = min(filters.get('age_max', crypto.AGE_OPE_MAX), crypto.AGE_OPE_MAX)
+        if age_min > age_max:
+            return jsonify([])
+        conditions.append(("age_ope BETWEEN %s AND %s", lambda key_id: [
+            crypto.age_ope_encrypt(age_min, key_id), crypto.age_ope_encrypt(age_max, key_id)]))
+        checks.append(lambda row: age_min <= row['age'] <= age_max)
+        checked.add('age')
+
+    if 'weight_min' in filters or 'weight_max' in filters:
+        weight_min = round(max(filters.get('weight_min', 0.0), 0.0), 2)
+        weight_max = round(min(filters.get('weight_max', WEIGHT_OPE_MAX), WEIGHT_OPE_MAX), 2)
+        if weight_min > weight_max:
+            return jsonify([])
+        bounds = _weight_bounds(weight_min, weight_max)
+        if bounds is None:
+            return jsonify({"error": "Encryption failed for weight"}), 500
+        conditions.append(("weight BETWEEN %s AND %s", lambda key_id: list(bounds[key_id])))
+        checks.append(lambda row: weight_min <= row['weight'] <= weight_max)
+        checked.add('weight')
+
+    if 'gender' in filters:
+        gender = filters['gender']
+        conditions.append(("gender_bidx = %s", lambda key_id: [crypto.blind_index('gender', gender, key_id)]))
+        checks.append(lambda row: row['gender'] == gender)
+        checked.add('gender')
+
+    for name in ('first_name', 'last_name'):
+        if name in filters:
+            wanted = crypto.normalize_name(filters[name])
+            conditions.append((f"{name}_bidx = %s", lambda key_id, name=name, wanted=wanted:
+                               [crypto.blind_index(name, wanted, key_id)]))
+            checks.append(lambda row, name=name, wanted=wanted:
+                          row[name] is not None and crypto.normalize_name(row[name]) == wanted)
+            checked.add(name)
+
+    where, params = _keyed_where(lambda key_id: (
+        [sql for sql, _ in conditions], [param for _, key_params in conditions for param in key_params(key_id)]))
+    query = (f"SELECT * FROM patients WHERE {where} "
+             f"AND patient_id > %s AND patient_id <= %s ORDER BY patient_id ASC")
+
+    def select_rows(cursor, after_id, upto_id):
+        cursor.execute(query, tuple(params) + (after_id, upto_id))
+        return cursor.fetchall()
+
+    opened_fields = None if fields is None else tuple(
+        field for field in crypto.MAC_FIELDS if field in fields or field in checked)
+
+    # name lookups return a row or two, the result cache's tail check would cost more than it saves
+    cacheable = 'first_name' not in filters and 'last_name' not in filters
+
+    with database.db_connection() as cnx:
+        if not cnx: return jsonify({"error": "Database connection failed"}), 500
+
+        cursor = cnx.cursor(dictionary=True)
+        try:
+            if cacheable:
+                pending = result_cache.fetch(cursor, ('query', opened_fields, where) + tuple(params), select_rows)
+            else:
+                raw_rows = select_rows(cursor, 0, PATIENT_ID_MAX)
+        except mysql.connector.Error as err:
+            return jsonify({"error": f"Database query failed: {err}"}), 500
+        except merkle.IncompleteResult as err:
+            print(f"FATAL: Query Completeness FAILED! {err}.")
+            return jsonify({"error": "Query Failed: Data is missing or out of order."}), 500
+        finally:
+            cursor.close()
+
+    # the connection is back in the pool before we start decrypting
+    if cacheable:
+        batch = result_cache.finish(pending, fields=opened_fields)
+    else:
+        batch = crypto.process_rows(raw_rows, fields=opened_fields)
+    for patient_id, reason in batch.failures:
+        print(f"WARNING: {reason} for patient_id {patient_id}")
+
+    rows = []
+    for row in batch.rows:
+        if not all(check(row) for check in checks):
+            print(f"WARNING: search columns don't match the row for patient_id {row['patient_id']}")
+        elif fields is None:
+            rows.append(row)
+        else:
+            rows.append({'patient_id': row['patient_id'], **{field: row[field] for field in fields}})
+
+    with metrics.timed('json'):
+        return jsonify([_redact_row(row, current_user) for row in rows])
+
+#
+# Aggregates for researchers
+#
+# /stats                      count, mean, min, max, percentiles and histograms of
+#                             age, weight and height, overall and per gender
+# /stats?min=60&max=80        only patients in that weight range
+# /stats?bins=20              histogram bins (default STATS_DEFAULT_BINS)
+#
+# The whole table is verified (chain included) exactly like /query_all, but only
+# the aggregates leave the server, never a single row.
+#
+@app.route('/stats', methods=['GET'])
+@auth.token_required
+def get_stats(current_user):
+    try:
+        # both bounds are optional, but a bound that's given must be a number
+        min_weight = _finite_float(request.args['min']) if 'min' in request.args else None
+        max_weight = _finite_float(request.args['max']) if 'max' in request.args else None
+        bins = int(request.args.get('bins', stats.STATS_DEFAULT_BINS))
+    except ValueError:
+        return jsonify({"error": "Invalid numbers"}), 400
+    if bins < 1 or bins > stats.STATS_MAX_BINS:
+        return jsonify({"error": f"'bins' must be between 1 and {stats.STATS_MAX_BINS}"}), 400
+
+    batch, error = _load_all_patients()
+    if error:
+        return error
 
-        return jsonify(plaintext_results)
-    except mysql.connector.Error as err:
-        return jsonify({"error": str(err)}), 500
-    finally:
-        if cursor: cursor.close()
-        if cnx: cnx.close()
\ No newline at end of file
+    columns = stats.columns_for(batch.rows, batch.last_hash)
+    summary = stats.summarize(columns, min_weight, max_weight, bins)
+    with metrics.timed('json'):
+        return jsonify(summary)
@@ -0,0 +1,216 @@
+import os
+import json
+import mmap
+import atexit
+import struct
+import threading
+import numpy as np
+from app import app, database, crypto
+
+# Columnar snapshot of the decrypted numeric columns, for fast warm restarts.
+#
+# After /query_all (or /stats) has verified the whole table, the decrypted
+# gender, age, weight and height of every row are kept as NumPy columns next to
+# patient_id and the verified chain tail hash. With SNAPSHOT_FILE set they are
+# also written to disk, AES-GCM encrypted one column at a time, and read back
+# (memory-mapped) on startup.
+#
+# The snapshot is only ever a shortcut for decryption: every row still has its
+# MAC checked against the snapshot values (see crypto.process_rows(known=...))
+# and the chain is verified as usual. A stale or foreign snapshot just means the
+# affected rows are decrypted for real.
+
+SNAPSHOT_FILE = app.config.get('SNAPSHOT_FILE')
+# new rows to collect before the file is written again
+SNAPSHOT_SAVE_EVERY = app.config.get('SNAPSHOT_SAVE_EVERY', 1000)
+
+_MAGIC = b'DSPSNAP1'
+_COLUMNS = (
+    ('patient_id', np.int64),
+    ('gender', np.int8),
+    ('age', np.int32),
+    ('weight', np.float64),
+    ('height', np.float64),  # NaN when missing
+)
+
+
+class Snapshot:
+    """
+    Immutable set of columns, sorted by patient_id. New rows make a new Snapshot.
+    """
+
+    def __init__(self, columns, tail_hash):
+        self.columns = columns
+        self.tail_hash = tail_hash
+
+    @classmethod
+    def from_rows(cls, rows, tail_hash):
+        """Builds a snapshot from verified plaintext rows (in patient_id order)."""
+        def column(name, dtype, convert):
+            return np.fromiter((convert(row[name]) for row in rows), dtype=dtype, count=len(rows))
+
+        columns = {
+            'patient_id': column('patient_id', np.int64, int),
+            'gender': column('gender', np.int8, int),
+            'age': column('age', np.int32, int),
+            'weight': column('weight', np.float64, float),
+            'height': column('height', np.float64, lambda h: np.nan if h is None else h),
+        }
+        return cls(columns, tail_hash)
+
+    def __len__(self):
+        return len(self.columns['patient_id'])
+
+    @property
+    def tail_id(self):
+        return int(self.columns['patient_id'][-1]) if len(self) else 0
+
+    def extend(self, rows, tail_hash):
+        """Returns a new snapshot with `rows` (all after tail_id) appended."""
+        added = Snapshot.from_rows(rows, tail_hash)
+        columns = {name: np.concatenate((self.columns[name], added.columns[name])) for name, _ in _COLUMNS}
+        return Snapshot(columns, tail_hash)
+
+    def values(self, patient_id):
+        """Returns: (gender, age, weight) of the row, or None if it is not in the snapshot"""
+        ids = self.columns['patient_id']
+        i = int(np.searchsorted(ids, patient_id))
+        if i == len(ids) or ids[i] != patient_id:
+            return None
+        return (
+            bool(self.columns['gender'][i]),
+            int(self.columns['age'][i]),
+            float(self.columns['weight'][i]),
+        )
+
+    def _aad(self, name, rows):
+        # binds every column to the row count and tail, so columns can't be swapped between files
+        return b'snapshot|' + name.encode('utf-8') + b'|' + str(rows).encode('utf-8') + b'|' + self.tail_hash
+
+    def save(self, path):
+        """Writes the snapshot to `path`: header, then one encrypted block per column."""
+        rows = len(self)
+        blocks = []
+        header = {'rows': rows, 'tail_hash': self.tail_hash.hex(), 'columns': {}}
+        offset = 0
+        for name, dtype in _COLUMNS:
+            nonce = os.urandom(12)
+            block = crypto._aesgcm.encrypt(nonce, self.columns[name].astype(dtype).tobytes(), self._aad(name, rows))
+            header['columns'][name] = [offset, len(block), nonce.hex()]
+            blocks.append(block)
+            offset += len(block)
+
+        header_bytes = json.dumps(header).encode('utf-8')
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(_MAGIC + struct.pack('>I', len(header_bytes)) + header_bytes)
+            for block in blocks:
+                f.write(block)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Reads a snapshot written by save(). Raises on a wrong key or a damaged file."""
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(_MAGIC)] != _MAGIC:
+                raise ValueError("not a snapshot file")
+            (header_len,) = struct.unpack('>I', data[len(_MAGIC):len(_MAGIC) + 4])
+            start = len(_MAGIC) + 4
+            header = json.loads(data[start:start + header_len].decode('utf-8'))
+            start += header_len
+
+            snapshot = cls({}, bytes.fromhex(header['tail_hash']))
+            rows = header['rows']
+            for name, dtype in _COLUMNS:
+                offset, length, nonce = header['columns'][name]
+                block = data[start + offset:start + offset + length]
+                plain = crypto._aesgcm.decrypt(bytes.fromhex(nonce), block, snapshot._aad(name, rows))
+                snapshot.columns[name] = np.frombuffer(plain, dtype=dtype)
+        return snapshot
+
+
+_lock = threading.Lock()
+_current = None
+_saved_rows = 0
+
+def known_values():
+    """Returns: a lookup for crypto.process_rows(known=...), or None if there is no snapshot"""
+    current = _current
+    return current.values if current is not None and len(current) else None
+
+def record(rows, tail_hash):
+    """
+    Takes in the verified rows of the whole table (from /query_all or /stats).
+    The snapshot is topped up with the rows after its tail, or rebuilt if the
+    table no longer starts with what the snapshot has.
+    """
+    global _current
+    if not rows:
+        return
+    with _lock:
+        current = _current
+        n = len(current) if current is not None else 0
+        if n and n <= len(rows) and rows[n - 1]['patient_id'] == current.tail_id \
+                and current.values(current.tail_id) == (rows[n - 1]['gender'], rows[n - 1]['age'], rows[n - 1]['weight']):
+            if n == len(rows):
+                return
+            _current = current.extend(rows[n:], tail_hash)
+        else:
+            _current = Snapshot.from_rows(rows, tail_hash)
+            n = 0
+
+    if n == 0 or len(_current) - _saved_rows >= SNAPSHOT_SAVE_EVERY:
+        save_snapshot()
+
+def save_snapshot():
+    """Writes the snapshot to SNAPSHOT_FILE, if one is configured."""
+    global _saved_rows
+    current = _current
+    if not SNAPSHOT_FILE or current is None or not crypto._is_main_process():
+        return
+    try:
+        current.save(SNAPSHOT_FILE)
+        _saved_rows = len(current)
+    except OSError as e:
+        print(f"WARNING: could not save snapshot: {e}")
+
+def load_snapshot():
+    """
+    Loads SNAPSHOT_FILE on startup. It is dropped if its tail row is no longer
+    in the table with the same chain hash (eg., populate_db reloaded the data).
+    """
+    global _current, _saved_rows
+    if not SNAPSHOT_FILE or not os.path.exists(SNAPSHOT_FILE):
+        return
+    try:
+        snapshot = Snapshot.load(SNAPSHOT_FILE)
+    except Exception as e:
+        # wrong key or a damaged file, the first /query_all rebuilds it
+        print(f"WARNING: could not load snapshot from {SNAPSHOT_FILE}: {e}")
+        return
+
+    with database.db_connection() as cnx:
+        if not cnx:
+            print("WARNING: snapshot not checked (no database connection), ignoring it")
+            return
+        cursor = cnx.cursor()
+        try:
+            cursor.execute("SELECT chain_hash FROM patients WHERE patient_id = %s", (snapshot.tail_id,))
+            row = cursor.fetchone()
+        finally:
+            cursor.close()
+
+    if snapshot.tail_id and (row is None or bytes(row[0]) != snapshot.tail_hash):
+        print("WARNING: snapshot doesn't match the patients table, ignoring it")
+        return
+
+    with _lock:
+        _current = snapshot
+        _saved_rows = len(snapshot)
+    print(f"Loaded snapshot of {len(snapshot)} rows (up to patient_id {snapshot.tail_id}).")
+
+def _save_on_exit():
+    if _current is not None and len(_current) != _saved_rows:
+        save_snapshot()
+
+atexit.register(_save_on_exit)
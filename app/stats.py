@@ -0,0 +1,104 @@
+import threading
+import numpy as np
+from app import app
+
+# Aggregates for /stats.
+#
+# The verified rows are turned into one NumPy array per column (NaN where a value
+# is missing) and every statistic is a vectorized pass over those arrays, so
+# researchers get a few kilobytes back instead of the whole table.
+# The arrays are kept for the chain tail they were built at and reused until
+# the tail moves.
+
+STATS_COLUMNS = ('age', 'weight', 'height')
+STATS_PERCENTILES = (5, 25, 50, 75, 95)
+STATS_DEFAULT_BINS = app.config.get('STATS_DEFAULT_BINS', 10)
+STATS_MAX_BINS = app.config.get('STATS_MAX_BINS', 100)
+
+GENDER_GROUPS = (('male', 1.0), ('female', 0.0))
+
+_columns_lock = threading.Lock()
+_columns_cache = (None, None)  # (tail chain_hash, columns)
+
+
+def build_columns(rows):
+    """
+    Returns: dict of column name -> float64 array, for the given plaintext rows
+    (gender is 1.0 / 0.0, missing values are NaN)
+    """
+    def column(name, convert=float):
+        return np.fromiter(
+            (np.nan if row[name] is None else convert(row[name]) for row in rows),
+            dtype=np.float64, count=len(rows)
+        )
+
+    columns = {name: column(name) for name in STATS_COLUMNS}
+    columns['gender'] = column('gender', lambda g: 1.0 if g else 0.0)
+    return columns
+
+def columns_for(rows, tail_hash):
+    """Same as build_columns(), but reuses the arrays while the chain tail is unchanged."""
+    global _columns_cache
+    with _columns_lock:
+        cached_hash, columns = _columns_cache
+        if cached_hash is not None and cached_hash == tail_hash and len(columns['age']) == len(rows):
+            return columns
+
+    columns = build_columns(rows)
+    with _columns_lock:
+        _columns_cache = (tail_hash, columns)
+    return columns
+
+def _describe(values, edges):
+    values = values[~np.isnan(values)]
+    if not len(values):
+        return {'count': 0}
+
+    counts, _ = np.histogram(values, bins=edges)
+    percentiles = np.percentile(values, STATS_PERCENTILES)
+    return {
+        'count': int(len(values)),
+        'mean': round(float(values.mean()), 2),
+        'min': round(float(values.min()), 2),
+        'max': round(float(values.max()), 2),
+        'percentiles': {f"p{p}": round(float(v), 2) for p, v in zip(STATS_PERCENTILES, percentiles)},
+        'histogram': counts.tolist(),
+    }
+
+def summarize(columns, min_weight=None, max_weight=None, bins=STATS_DEFAULT_BINS):
+    """
+    Computes count, mean, min, max, percentiles and a histogram of every numeric
+    column, for all rows and per gender. The histogram edges are shared by all
+    groups so their counts can be compared.
+    """
+    mask = np.ones(len(columns['age']), dtype=bool)
+    with np.errstate(invalid='ignore'):
+        if min_weight is not None:
+            mask &= columns['weight'] >= min_weight
+        if max_weight is not None:
+            mask &= columns['weight'] <= max_weight
+
+    edges = {}
+    for name in STATS_COLUMNS:
+        values = columns[name][mask]
+        values = values[~np.isnan(values)]
+        if len(values):
+            edges[name] = np.histogram_bin_edges(values, bins=bins)
+
+    groups = {'all': mask}
+    for group, code in GENDER_GROUPS:
+        groups[group] = mask & (columns['gender'] == code)
+
+    result = {
+        'count': int(mask.sum()),
+        'histogram_edges': {name: [round(float(edge), 2) for edge in bin_edges] for name, bin_edges in edges.items()},
+        'groups': {},
+    }
+    for group, group_mask in groups.items():
+        result['groups'][group] = {'count': int(group_mask.sum())}
+        for name in STATS_COLUMNS:
+            if name in edges:
+                result['groups'][group][name] = _describe(columns[name][group_mask], edges[name])
+            else:
+                result['groups'][group][name] = {'count': 0}
+    return result
@@ -0,0 +1,242 @@
+import bisect
+import hmac
+import threading
+from array import array
+from app import app, crypto, merkle
+
+# In-process index on the OPE encrypted weight.
+#
+# OPE ciphertexts sort in the same order as the weights, so a sorted array of
+# (ciphertext, patient_id) answers a range search by bisection, without the
+# server ever seeing a plaintext weight. /query_by_weight then fetches only the
+# matching rows by primary key instead of scanning 'patients'.
+#
+# The index follows the table by patient_id: rows are only ever appended, in
+# patient_id order (see chain.append_patients), so every lookup first pulls in
+# the rows after the last one it has seen. Inserts made by other server
+# processes are picked up the same way.
+#
+# The index also keeps the Merkle leaf and key_id of every row, and a Frontier
+# over the leaves (see app/merkle.py). After each refresh its root must be the
+# signed root, so the index holds exactly the rows of the signed table: none
+# dropped, none with another weight. If it doesn't match (eg. a key rotation
+# rewrote the rows) the index is rebuilt, and if it still doesn't the lookup
+# raises IncompleteResult. fetch_rows() then checks that the database returned
+# exactly the rows the index found, with the same leaves, so the result of a
+# range search is proven complete. Without a Merkle tree the index works as
+# before, unproven, and a changed last row (eg. populate_db reloaded the table)
+# triggers the rebuild.
+#
+# While rows of more than one key version are in the table (see app/rotation.py)
+# their ciphertexts sit in the same arrays. A search looks up the range of every
+# key and keeps the rows of that key only.
+
+WEIGHT_INDEX_ENABLED = app.config.get('WEIGHT_INDEX_ENABLED', True)
+
+# ids per "WHERE patient_id IN (...)" query
+FETCH_CHUNK_SIZE = app.config.get('WEIGHT_INDEX_FETCH_CHUNK', 1000)
+
+
+# raised when a range result can't be proven complete
+IncompleteResult = merkle.IncompleteResult
+
+
+class WeightIndex:
+    """
+    Sorted (weight ciphertext, patient_id) pairs kept in two parallel arrays,
+    plus the key_id and Merkle leaf of every row by patient_id.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+        self.rebuilds = 0
+        self.lookups = 0
+
+    def _reset(self):
+        self._keys = array('q')         # OPE ciphertexts, sorted
+        self._ids = array('q')          # patient_id of each key
+        self._key_ids = array('b')      # key_id of every row, at patient_id - 1 (crypto.KEY_ID_MAX fits)
+        self._leaves = bytearray()      # Merkle leaf of every row, 32 bytes at (patient_id - 1) * 32
+        self._tree = merkle.Frontier()  # over the leaves read so far
+        self.last_id = 0                # highest patient_id indexed
+        self.last_hash = None           # its chain_hash, to notice a reloaded table
+        self.verified = False           # the index matches the signed Merkle root
+
+    def _add(self, ciphertext, patient_id):
+        # rows with no weight can never match a range
+        if ciphertext is None:
+            return
+        # (ciphertext, patient_id) order, so equal weights stay in id order
+        i = bisect.bisect_right(self._keys, ciphertext)
+        while i > 0 and self._keys[i - 1] == ciphertext and self._ids[i - 1] > patient_id:
+            i -= 1
+        self._keys.insert(i, ciphertext)
+        self._ids.insert(i, patient_id)
+
+    def _read(self, cursor):
+        """
+        (Private) Reads the rows after last_id into the per row arrays and the tree.
+        Returns: their (weight ciphertext, patient_id) pairs
+        """
+        cursor.execute(
+            f"SELECT {merkle.LEAF_COLUMNS} FROM patients WHERE patient_id > %s ORDER BY patient_id",
+            (self.last_id,)
+        )
+        pairs = []
+        for row in cursor.fetchall():
+            patient_id, key_id, ciphertext, row_mac, chain_hash = row
+            gap = patient_id - self.last_id - 1
+            if gap > 0:
+                # only without a Merkle tree, a missing row never matches it
+                self._key_ids.extend([0] * gap)
+                self._leaves.extend(bytes(32 * gap))
+            leaf = merkle.leaf_hash(*row)
+            self._tree.append(leaf)
+            self._key_ids.append(key_id or 1)
+            self._leaves += leaf
+            if ciphertext is not None:
+                pairs.append((ciphertext, patient_id))
+            self.last_id, self.last_hash = patient_id, bytes(chain_hash)
+        return pairs
+
+    def _rebuild(self, cursor):
+        self._reset()
+        self.rebuilds += 1
+        for ciphertext, patient_id in sorted(self._read(cursor)):
+            self._keys.append(ciphertext)
+            self._ids.append(patient_id)
+
+    def _matches(self, signed):
+        return self._tree.count == signed.count and hmac.compare_digest(self._tree.root(), signed.root())
+
+    def _refresh(self, cursor):
+        """
+        (Private) Brings the index up to date with the table. Caller holds the lock.
+        Raises: IncompleteResult if the table doesn't match the signed Merkle root
+        """
+        signed = None
+        if merkle.MERKLE_ENABLED:
+            try:
+                signed = merkle.load_state(cursor)
+            except merkle.TreeBroken as e:
+                self.verified = False
+                raise IncompleteResult(str(e))
+
+        if signed is None:
+            # no tree to check against, follow the table unproven
+            self.verified = False
+            if self.last_id:
+                cursor.execute("SELECT chain_hash FROM patients WHERE patient_id = %s", (self.last_id,))
+                row = cursor.fetchone()
+                if row is None or bytes(row[0]) != self.last_hash:
+                    self._rebuild(cursor)
+                    return
+            elif not self.rebuilds:
+                self._rebuild(cursor)
+                return
+            for ciphertext, patient_id in self._read(cursor):
+                self._add(ciphertext, patient_id)
+            return
+
+        if not self.rebuilds or self.last_id > signed.count:
+            self._rebuild(cursor)
+        else:
+            for ciphertext, patient_id in self._read(cursor):
+                self._add(ciphertext, patient_id)
+        if self._tree.count > signed.count:
+            # rows the tree doesn't cover, see merkle.load_for_append()
+            self.verified = False
+            return
+        if not self._matches(signed):
+            # rows were rewritten (or tampered with), read them all again
+            self._rebuild(cursor)
+        self.verified = self._matches(signed)
+        if not self.verified:
+            raise IncompleteResult("the weight index doesn't match the signed Merkle root")
+
+    def lookup(self, cursor, min_ciphertext, max_ciphertext):
+        """
+        Returns: sorted list of the patient_ids whose weight ciphertext is
+        between min_ciphertext and max_ciphertext (inclusive), of any key_id
+        `cursor` must be a plain (not dictionary) cursor.
+        """
+        with self._lock:
+            self._refresh(cursor)
+            self.lookups += 1
+            lo = bisect.bisect_left(self._keys, min_ciphertext)
+            hi = bisect.bisect_right(self._keys, max_ciphertext)
+            return sorted(self._ids[lo:hi])
+
+    def lookup_ranges(self, cursor, key_bounds):
+        """
+        lookup() with a range per key version. key_bounds is
+        {key_id: (min_ciphertext, max_ciphertext)}, a row is found if its weight
+        is in the range of its own key_id.
+        Returns: (sorted patient_ids, their Merkle leaves or None if the index isn't proven)
+        Raises: IncompleteResult
+        """
+        with self._lock:
+            self._refresh(cursor)
+            self.lookups += 1
+            ids = []
+            for key_id, (min_ciphertext, max_ciphertext) in key_bounds.items():
+                lo = bisect.bisect_left(self._keys, min_ciphertext)
+                hi = bisect.bisect_right(self._keys, max_ciphertext)
+                ids.extend(i for i in self._ids[lo:hi] if self._key_ids[i - 1] == key_id)
+            ids.sort()
+            if not self.verified:
+                return ids, None
+            return ids, [bytes(self._leaves[(i - 1) * 32:i * 32]) for i in ids]
+
+    def clear(self):
+        with self._lock:
+            self._reset()
+            self.rebuilds = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._keys),
+                'last_id': self.last_id,
+                'verified': self.verified,
+                'rebuilds': self.rebuilds,
+                'lookups': self.lookups,
+            }
+
+
+weight_index = WeightIndex()
+
+def fetch_rows(cursor, patient_ids, min_ciphertext, max_ciphertext, key_bounds=None, leaves=None):
+    """
+    Fetches the given patients by primary key, in patient_id order.
+    The weight is checked against the range again, so a stale index entry can
+    never put a row in the result that doesn't belong there.
+    key_bounds, if given, is {key_id: (min_ciphertext, max_ciphertext)} and
+    every row is checked against the range of its own key_id instead.
+    leaves, if given (from lookup_ranges), are the proven Merkle leaves of
+    patient_ids: every one of the rows must come back, unchanged.
+    Raises: IncompleteResult if a row is missing or different
+    """
+    rows = []
+    for i in range(0, len(patient_ids), FETCH_CHUNK_SIZE):
+        chunk = patient_ids[i:i + FETCH_CHUNK_SIZE]
+        placeholders = ", ".join(["%s"] * len(chunk))
+        cursor.execute(
+            f"SELECT * FROM patients WHERE patient_id IN ({placeholders}) ORDER BY patient_id ASC",
+            tuple(chunk)
+        )
+        rows.extend(cursor.fetchall())
+
+    if leaves is not None:
+        if [row['patient_id'] for row in rows] != list(patient_ids) or any(
+                not hmac.compare_digest(merkle.row_leaf(row), leaf) for row, leaf in zip(rows, leaves)):
+            raise IncompleteResult("rows are missing or don't match the weight index")
+
+    def in_range(row):
+        if key_bounds is None:
+            bounds = (min_ciphertext, max_ciphertext)
+        else:
+            bounds = key_bounds.get(crypto.row_key_id(row))
+        return row['weight'] is not None and bounds is not None and bounds[0] <= row['weight'] <= bounds[1]
+    return [row for row in rows if in_range(row)]
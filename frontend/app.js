@@ -15,6 +15,11 @@ document.addEventListener("DOMContentLoaded", () => {
 
     console.log("API_URL =", API_URL);
 
+    // patient list paging
+    const PAGE_SIZE = 100;
+    let loadedRows = [];
+    let nextCursor = null;
+
     let authToken = null;
     let authUser = {
         username: null,
@@ -247,21 +252,46 @@ document.addEventListener("DOMContentLoaded", () => {
         }
     }
 
-    async function handleViewAll() {
-        appContent.innerHTML = "<p>Loading...</p>";
+    /**
+     * fetching one page of patients and adding it to the rows already shown.
+     * the server verifies every page against the hash chain, starting from the
+     * signed cursor it gave us with the previous page.
+     * @param {boolean} reset true to start again from the first page
+     */
+    async function loadPatientPage(reset) {
+        if (reset) {
+            loadedRows = [];
+            nextCursor = null;
+            appContent.innerHTML = "<p>Loading...</p>";
+        }
+
+        let url = `${API_URL}/query_all?limit=${PAGE_SIZE}`;
+        if (nextCursor) url += `&cursor=${encodeURIComponent(nextCursor)}`;
+
         try {
-            const response = await fetch(`${API_URL}/query_all`, {
+            const response = await fetch(url, {
                 headers: { "Authorization": `Bearer ${authToken}` }
             });
             const data = await response.json();
             if (!response.ok) throw new Error(data.error || "Query failed");
 
-            renderTable(data);
+            loadedRows = loadedRows.concat(data.rows);
+            nextCursor = data.next_cursor;
+
+            renderTable(loadedRows);
+            if (data.has_more) {
+                appContent.insertAdjacentHTML("beforeend", '<button id="btn-load-more">Load More</button>');
+                document.getElementById("btn-load-more").addEventListener("click", () => loadPatientPage(false));
+            }
         } catch (err) {
             appContent.innerHTML = `<p style="color:red; font-weight:bold;">Error: ${err.message}</p>`;
         }
     }
 
+    async function handleViewAll() {
+        await loadPatientPage(true);
+    }
+
     async function handleSearchWeight() {
         const min = searchMin.value;
         const max = searchMax.value;
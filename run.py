@@ -1,5 +1,24 @@
 # main entry point to run the application.
-from app import app
+import os
+import argparse
+from app import app, start_background_tasks
 
 if __name__ == '__main__':
-    app.run(debug=True, host="0.0.0.0", port=5000)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--asgi', action='store_true',
+                        help="serve with uvicorn (see app/asgi.py) instead of the Flask dev server")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="uvicorn worker processes (only with --asgi)")
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args()
+
+    if args.asgi:
+        import uvicorn
+        # the background jobs start inside each worker, when it imports app.asgi
+        uvicorn.run("app.asgi:asgi_app", host="0.0.0.0", port=args.port, workers=args.workers)
+    else:
+        # debug mode runs this file twice: in the reloader, which only watches the
+        # files, and in the child it starts to serve. only the child runs the jobs
+        if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            start_background_tasks()
+        app.run(debug=True, host="0.0.0.0", port=args.port)
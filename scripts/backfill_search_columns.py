@@ -0,0 +1,105 @@
+import sys
+import os
+import time
+import argparse
+import mysql.connector
+
+# adds the root folder of the project to the
+# list of places Python looks for code.
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(project_root)
+
+from app import app, database, crypto, chain
+
+# Fills in the searchable columns for the rows written before they existed. The
+# columns themselves are added by the server at startup (chain.ensure_tables).
+#
+#   python scripts/backfill_search_columns.py                # missing values only
+#   python scripts/backfill_search_columns.py --rebuild      # every row, eg. after a key change
+#
+# The columns are age_ope (see /query) and the blind indexes of gender, first_name
+# and last_name.
+#
+# Rows are read in patient_id batches. Each batch is decrypted and its row MACs
+# checked (crypto.process_rows) before anything is derived from it, so a
+# tampered row never gets search values. Every batch is its own commit, so the
+# script can be stopped and run again at any time, also while the server is up.
+
+SEARCH_COLUMNS = {
+    # column: value from the verified plaintext row and its key_id
+    'age_ope': lambda row, key_id: crypto.age_ope_encrypt(row['age'], key_id),
+    'gender_bidx': lambda row, key_id: crypto.blind_index('gender', row['gender'], key_id),
+    'first_name_bidx': lambda row, key_id: crypto.blind_index('first_name', row['first_name'], key_id),
+    'last_name_bidx': lambda row, key_id: crypto.blind_index('last_name', row['last_name'], key_id),
+}
+
+def backfill(cnx, batch_size, rebuild=False):
+    """
+    Fills in the search columns, batch by batch.
+    Returns: (rows updated, rows skipped because they failed verification)
+    """
+    columns = list(SEARCH_COLUMNS)
+    where = "" if rebuild else " AND (" + " OR ".join(f"{column} IS NULL" for column in columns) + ")"
+    select = f"SELECT * FROM patients WHERE patient_id > %s{where} ORDER BY patient_id ASC LIMIT %s"
+    update = f"UPDATE patients SET {', '.join(f'{column} = %s' for column in columns)} WHERE patient_id = %s"
+
+    updated = skipped = 0
+    last_id = 0
+    cursor = cnx.cursor(dictionary=True)
+    try:
+        while True:
+            cursor.execute(select, (last_id, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1]['patient_id']
+
+            batch = crypto.process_rows(rows)
+            for patient_id, reason in batch.failures:
+                print(f"WARNING: {reason} for patient_id {patient_id}, not backfilled")
+
+            # the search values are made with the keys each row was sealed with
+            key_ids = {row['patient_id']: crypto.row_key_id(row) for row in rows}
+            values = [
+                tuple(SEARCH_COLUMNS[column](row, key_ids[row['patient_id']]) for column in columns)
+                + (row['patient_id'],)
+                for row in batch.rows
+            ]
+            if values:
+                cursor.executemany(update, values)
+            cnx.commit()
+            updated += len(values)
+            skipped += len(batch.failures)
+            print(f"Backfilled up to patient_id {last_id} ({updated} rows so far).")
+    finally:
+        cursor.close()
+    return updated, skipped
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--rebuild', action='store_true', help="recompute every row, not only missing values")
+    args = parser.parse_args()
+
+    with database.db_connection() as cnx:
+        if not cnx:
+            print("Connection failed. Check your config.py and certs/ca.pem file.")
+            return
+
+        try:
+            # adds the columns if the server hasn't been started since the upgrade
+            chain.ensure_tables()
+
+            start = time.perf_counter()
+            updated, skipped = backfill(cnx, args.batch_size, args.rebuild)
+            print(f"Done: {updated} rows backfilled in {time.perf_counter() - start:.1f}s"
+                  + (f", {skipped} skipped." if skipped else "."))
+        except mysql.connector.Error as err:
+            print(f"Error: {err}")
+            cnx.rollback()
+            print("Batches committed before the error are kept, run again to continue.")
+
+    database.get_pool().close_all()
+
+if __name__ == "__main__":
+    main()
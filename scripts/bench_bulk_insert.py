@@ -0,0 +1,74 @@
+import sys
+import os
+import time
+import random
+import argparse
+
+# adds the root folder of the project to the
+# list of places Python looks for code.
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(project_root)
+
+from faker import Faker
+from app import app
+
+# Throughput of /add_data (one request per patient) against /add_data/bulk.
+# It goes through the Flask test client and the database in config.py, and it
+# REALLY INSERTS the generated patients, so point it at a test database.
+#
+#   python scripts/bench_bulk_insert.py --rows 500 --batch 250
+
+fake = Faker()
+
+def make_patient():
+    return {
+        'first_name': fake.first_name(),
+        'last_name': fake.last_name(),
+        'gender': random.random() < 0.5,
+        'age': random.randint(1, 99),
+        'weight': round(random.uniform(40, 150), 1),
+        'height': round(random.uniform(140, 200), 1),
+        'health_history': fake.sentence(),
+    }
+
+def login(client):
+    """Registers a throwaway Group H user and returns the auth header."""
+    username = f"bench_{os.urandom(4).hex()}"
+    client.post('/register', json={'username': username, 'password': 'bench', 'occupation': 'doctor'})
+    response = client.post('/login', json={'username': username, 'password': 'bench'})
+    return {'Authorization': f"Bearer {response.json['token']}"}
+
+def bench_single(client, headers, patients):
+    start = time.perf_counter()
+    for patient in patients:
+        response = client.post('/add_data', headers=headers, json=patient)
+        if response.status_code != 201:
+            raise RuntimeError(f"/add_data failed: {response.json}")
+    return len(patients) / (time.perf_counter() - start)
+
+def bench_bulk(client, headers, patients, batch_size):
+    start = time.perf_counter()
+    for i in range(0, len(patients), batch_size):
+        response = client.post('/add_data/bulk', headers=headers, json=patients[i:i + batch_size])
+        if response.status_code != 201 or response.json['errors']:
+            raise RuntimeError(f"/add_data/bulk failed: {response.json}")
+    return len(patients) / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=500)
+    parser.add_argument('--batch', type=int, default=250)
+    args = parser.parse_args()
+
+    client = app.test_client()
+    headers = login(client)
+
+    single = bench_single(client, headers, [make_patient() for _ in range(args.rows)])
+    bulk = bench_bulk(client, headers, [make_patient() for _ in range(args.rows)], args.batch)
+
+    print(f"{args.rows} rows, bulk batches of {args.batch}")
+    print(f"/add_data       {single:>10.1f} rows/s")
+    print(f"/add_data/bulk  {bulk:>10.1f} rows/s  ({bulk / single:.1f}x)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import sys
+import os
+import time
+import hmac
+import argparse
+
+# adds the root folder of the project to the
+# list of places Python looks for code.
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(project_root)
+
+from app import app, crypto
+
+# Benchmark of completeness verification for a window at the end of the table,
+# with and without signed checkpoints. The chain is built in memory from random
+# row MACs, so only config.py keys are needed (no database).
+#
+#   python scripts/bench_checkpoints.py --rows 10000 100000 1000000 --window 100
+
+
+def build_chain(count, interval):
+    row_macs = [os.urandom(32) for _ in range(count)]
+    chain_hashes = []
+    checkpoints = {}
+    last_hash = crypto.GENESIS_HASH
+    for patient_id, row_mac in enumerate(row_macs, start=1):
+        last_hash = crypto.generate_chain_hash(row_mac, last_hash)
+        chain_hashes.append(last_hash)
+        if patient_id % interval == 0:
+            checkpoints[patient_id] = (last_hash, crypto.checkpoint_signature(patient_id, last_hash))
+    return row_macs, chain_hashes, checkpoints
+
+def verify_from(row_macs, chain_hashes, start_id, start_hash, end_id):
+    """Replays the chain for rows (start_id, end_id]."""
+    last_hash = start_hash
+    for i in range(start_id, end_id):
+        expected = crypto.generate_chain_hash(row_macs[i], last_hash)
+        if not hmac.compare_digest(expected, chain_hashes[i]):
+            raise RuntimeError(f"chain broken at patient_id {i + 1}")
+        last_hash = chain_hashes[i]
+
+def verify_window_genesis(row_macs, chain_hashes, checkpoints, interval, first_id, last_id):
+    verify_from(row_macs, chain_hashes, 0, crypto.GENESIS_HASH, last_id)
+
+def verify_window_checkpoint(row_macs, chain_hashes, checkpoints, interval, first_id, last_id):
+    cp_id = ((first_id - 1) // interval) * interval
+    if cp_id:
+        cp_hash, signature = checkpoints[cp_id]
+        if not crypto.verify_checkpoint(cp_id, cp_hash, signature):
+            raise RuntimeError("bad checkpoint")
+    else:
+        cp_hash = crypto.GENESIS_HASH
+    verify_from(row_macs, chain_hashes, cp_id, cp_hash, last_id)
+
+def timed_ms(fn, *args, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--window', type=int, default=100)
+    parser.add_argument('--interval', type=int, default=1000)
+    args = parser.parse_args()
+
+    print(f"window of {args.window} rows at the end of the table, checkpoint every {args.interval} rows")
+    print(f"{'rows':>10} {'from genesis ms':>16} {'from checkpoint ms':>19}")
+    for count in args.rows:
+        chain_data = build_chain(count, args.interval)
+        window = (count - args.window + 1, count)
+        genesis = timed_ms(verify_window_genesis, *chain_data, args.interval, *window)
+        checkpoint = timed_ms(verify_window_checkpoint, *chain_data, args.interval, *window)
+        print(f"{count:>10} {genesis:>16.2f} {checkpoint:>19.3f}")
+
+if __name__ == "__main__":
+    with app.app_context():
+        main()
@@ -0,0 +1,99 @@
+import sys
+import os
+import time
+import hmac
+import random
+import argparse
+
+# adds the root folder of the project to the
+# list of places Python looks for code.
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(project_root)
+
+from app import app, crypto, merkle
+
+# Benchmark of proving one row (a page cursor's after_id, see chain.chain_hash_at)
+# from the Merkle tree against replaying the chain from the last checkpoint
+# before it. The tree is built in memory from random rows, so only config.py
+# keys are needed (no database).
+#
+#   python scripts/bench_merkle.py --rows 10000 100000 1000000
+#
+# With --verify-workers it also times merkle.verify_tree() over the configured
+# database, once per worker count:
+#
+#   python scripts/bench_merkle.py --rows --verify-workers 0 2 4
+
+
+def build(count, interval):
+    rows = []
+    nodes = {}
+    checkpoints = {}
+    tree = merkle.Frontier()
+    last_hash = crypto.GENESIS_HASH
+    for patient_id in range(1, count + 1):
+        row_mac = os.urandom(32)
+        last_hash = crypto.generate_chain_hash(row_mac, last_hash)
+        row = (patient_id, 1, random.randint(0, 2 ** 40), row_mac, last_hash)
+        rows.append(row)
+        for level, idx, node in tree.append(merkle.row_leaf(row)):
+            nodes[(level, idx)] = node
+        if patient_id % interval == 0:
+            checkpoints[patient_id] = (last_hash, crypto.checkpoint_signature(patient_id, last_hash))
+    signature = crypto.merkle_root_signature(tree.count, tree.root())
+    return rows, nodes, checkpoints, (tree.count, tree.root(), signature)
+
+def prove_replay(rows, checkpoints, interval, patient_id):
+    cp_id = (patient_id // interval) * interval
+    if cp_id:
+        last_hash, signature = checkpoints[cp_id]
+        if not crypto.verify_checkpoint(cp_id, last_hash, signature):
+            raise RuntimeError("bad checkpoint")
+    else:
+        last_hash = crypto.GENESIS_HASH
+    for _, _, _, row_mac, chain_hash in rows[cp_id:patient_id]:
+        if not hmac.compare_digest(crypto.generate_chain_hash(row_mac, last_hash), chain_hash):
+            raise RuntimeError("chain broken")
+        last_hash = chain_hash
+
+def prove_merkle(rows, nodes, state, patient_id):
+    count, root, signature = state
+    if not crypto.verify_merkle_root(count, root, signature):
+        raise RuntimeError("bad root")
+    proof = {key: nodes[key] for key in merkle.proof_nodes(count, patient_id - 1, patient_id)}
+    if merkle.range_root(count, patient_id - 1, [merkle.row_leaf(rows[patient_id - 1])], proof) != root:
+        raise RuntimeError("bad proof")
+
+def timed_ms(fn, *args, repeat=200):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(*args)
+    return (time.perf_counter() - start) * 1000 / repeat
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='*', default=[10000, 100000, 1000000])
+    parser.add_argument('--interval', type=int, default=1000)
+    parser.add_argument('--verify-workers', type=int, nargs='*', default=[])
+    parser.add_argument('--chunk', type=int, default=merkle.MERKLE_VERIFY_CHUNK)
+    args = parser.parse_args()
+
+    if args.rows:
+        print(f"proving one row, checkpoint every {args.interval} rows (averaged over random rows)")
+        print(f"{'rows':>10} {'proof nodes':>12} {'merkle ms':>10} {'checkpoint ms':>14}")
+    for count in args.rows:
+        rows, nodes, checkpoints, state = build(count, args.interval)
+        ids = [random.randint(1, count) for _ in range(200)]
+        merkle_ms = sum(timed_ms(prove_merkle, rows, nodes, state, i, repeat=1) for i in ids) / len(ids)
+        replay_ms = sum(timed_ms(prove_replay, rows, checkpoints, args.interval, i, repeat=1) for i in ids) / len(ids)
+        proof = len(merkle.proof_nodes(count, ids[0] - 1, ids[0]))
+        print(f"{count:>10} {proof:>12} {merkle_ms:>10.3f} {replay_ms:>14.3f}")
+
+    for workers in args.verify_workers:
+        start = time.perf_counter()
+        problems = merkle.verify_tree(workers, args.chunk)
+        print(f"verify_tree, {workers} workers: {time.perf_counter() - start:.2f}s, {len(problems)} problems")
+
+if __name__ == "__main__":
+    with app.app_context():
+        main()
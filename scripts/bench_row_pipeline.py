@@ -0,0 +1,146 @@
+import sys
+import os
+import time
+import hmac
+import hashlib
+import random
+import argparse
+
+# adds the root folder of the project to the
+# list of places Python looks for code.
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(project_root)
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from app import app, crypto
+
+# Benchmark of the row decrypt/verify stage used by /query_all and /query_by_weight.
+# Rows are generated in memory, so only config.py keys are needed (no database).
+#
+#   python scripts/bench_row_pipeline.py --rows 10000 100000 1000000
+#
+# pyope decryption costs milliseconds per row and hides everything else, so
+# --no-ope swaps it for a lookup of the generated weights to time the rest.
+
+
+# OPE ciphertext -> weight of every generated row
+known_weights = {}
+
+def make_rows(count, distinct_weights):
+    """Builds `count` sealed, chained patient rows like the ones in the patients table."""
+    # OPE encryption is slow, so we only encrypt a small set of weights once
+    weights = [round(random.uniform(40, 150), 2) for _ in range(distinct_weights)]
+    ope_weights = {w: crypto.ope_encrypt(w) for w in weights}
+    known_weights.update({ct: w for w, ct in ope_weights.items()})
+
+    rows = []
+    last_hash = crypto.GENESIS_HASH
+    for patient_id in range(1, count + 1):
+        gender = random.random() < 0.5
+        age = random.randint(1, 99)
+        weight = random.choice(weights)
+        height = round(random.uniform(140, 200), 2)
+
+        gender_ct, gender_nonce = crypto.encrypt_field(gender)
+        age_ct, age_nonce = crypto.encrypt_field(age)
+        row_mac = crypto.generate_row_mac('First', 'Last', gender, age, weight, height, 'none')
+        last_hash = crypto.generate_chain_hash(row_mac, last_hash)
+
+        rows.append({
+            'patient_id': patient_id,
+            'first_name': 'First', 'last_name': 'Last',
+            'gender': gender_ct, 'gender_nonce': gender_nonce,
+            'age': age_ct, 'age_nonce': age_nonce,
+            'weight': ope_weights[weight], 'height': height,
+            'health_history': 'none',
+            'row_mac': row_mac, 'chain_hash': last_hash,
+        })
+    return rows
+
+def legacy_ope_decrypt(ciphertext):
+    """The old, uncached ope_decrypt."""
+    return float(crypto.ope_cipher.decrypt(ciphertext)) / crypto.OPE_PRECISION
+
+def legacy_process(rows):
+    """The old per-row loop: new AESGCM objects per field and the row MAC computed twice."""
+    def decrypt(ct, nonce, typ):
+        s = AESGCM(crypto.AES_KEY).decrypt(nonce, ct, None).decode('utf-8')
+        return s.lower() == 'true' if typ == bool else typ(s)
+
+    def row_mac(*fields):
+        msg = crypto._get_row_string(*fields).encode('utf-8')
+        return hmac.new(crypto.HMAC_KEY, msg=msg, digestmod=hashlib.sha256).digest()
+
+    out = []
+    last_hash = crypto.GENESIS_HASH
+    for row in rows:
+        gender = decrypt(row['gender'], row['gender_nonce'], bool)
+        age = decrypt(row['age'], row['age_nonce'], int)
+        weight = round(legacy_ope_decrypt(row['weight']), 2)
+        height = round(float(row['height']), 2)
+        fields = (row['first_name'], row['last_name'], gender, age, weight, height, row['health_history'])
+
+        if not hmac.compare_digest(row_mac(*fields), row['row_mac']):
+            continue
+        expected = crypto.generate_chain_hash(row_mac(*fields), last_hash)
+        if not hmac.compare_digest(expected, row['chain_hash']):
+            raise RuntimeError("chain broken")
+        last_hash = row['chain_hash']
+        out.append(row)
+    return out
+
+def pipeline(rows, parallel):
+    """The current stage. Returns: the number of rows that came through verified"""
+    batch = crypto.process_rows(rows, verify_chain=True, parallel=parallel)
+    for patient_id, reason in batch.failures[:3]:
+        print(f"WARNING: {reason} for patient_id {patient_id}")
+    return len(batch.rows) if batch.chain_broken_at is None else 0
+
+def timed(fn, rows, label):
+    """Rows per second of fn(rows). Exits if fn dropped any row, its speed would mean nothing."""
+    start = time.perf_counter()
+    verified = fn(rows)
+    elapsed = time.perf_counter() - start
+    if verified != len(rows):
+        sys.exit(f"ERROR: {label} verified {verified} of {len(rows)} rows, not reporting a speed")
+    return len(rows) / elapsed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000])
+    parser.add_argument('--distinct-weights', type=int, default=500)
+    parser.add_argument('--no-ope', action='store_true')
+    parser.add_argument('--workers', type=int, default=0,
+                        help="also time the process pool mode with this many workers")
+    args = parser.parse_args()
+
+    if args.no_ope and args.workers:
+        # the workers are separate processes and would still run real OPE decryption
+        parser.error("--no-ope can't be combined with --workers")
+    if args.no_ope:
+        global legacy_ope_decrypt
+        crypto.ope_decrypt = legacy_ope_decrypt = lambda ct, key_id=None: known_weights.get(ct)
+
+    if args.workers:
+        crypto.DECRYPT_WORKERS = args.workers
+
+    print(f"{'rows':>10} {'before rows/s':>15} {'after rows/s':>15} {'speedup':>8}"
+          + (f" {'parallel rows/s':>16} {'speedup':>8}" if args.workers else ""))
+    for count in args.rows:
+        rows = make_rows(count, args.distinct_weights)
+        # start from a cold OPE cache, generating the rows filled it
+        crypto.ope_cache = crypto.OPECache(crypto.ope_cache.max_size)
+        before = timed(lambda r: len(legacy_process(r)), rows, "the old loop")
+        after = timed(lambda r: pipeline(r, False), rows, "process_rows")
+        line = f"{count:>10} {before:>15.0f} {after:>15.0f} {after / before:>7.2f}x"
+        if args.workers:
+            parallel = timed(lambda r: pipeline(r, True), rows, "process_rows on the pool")
+            line += f" {parallel:>16.0f} {parallel / before:>7.2f}x"
+        print(line)
+
+    if not args.no_ope:
+        print(f"OPE cache: {crypto.ope_cache.stats()}")
+
+if __name__ == "__main__":
+    with app.app_context():
+        main()
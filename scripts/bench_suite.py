@@ -0,0 +1,292 @@
+import sys
+import os
+import json
+import time
+import random
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+from urllib.parse import urlencode
+
+# adds the root folder of the project to the
+# list of places Python looks for code.
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(project_root)
+
+from faker import Faker
+import sqlite_standin
+
+# Benchmark suite for the crypto primitives and the query endpoints.
+#
+# Synthetic patients are generated with Faker and loaded into a SQLite stand-in
+# for MySQL (scripts/sqlite_standin.py). No database server is needed, only the
+# keys in config.py. Results are written as JSON and can be compared against a
+# stored baseline:
+#
+#   python scripts/bench_suite.py --rows 2000 --save-baseline   # before a change
+#   python scripts/bench_suite.py --rows 2000                   # after it
+#
+# Micro benchmarks time single calls of the crypto functions (microseconds per
+# call). Macro benchmarks time whole requests through the Flask test client
+# (milliseconds per request). "cold" runs start with an empty result cache and
+# no snapshot, "warm" runs repeat the request right after.
+# Each number is the median of --repeat runs. A benchmark more than --threshold
+# percent slower than the baseline is flagged, and the exit code is then 1.
+
+# results go to bench/ in the project root, which git ignores
+BENCH_DIR = os.path.join(project_root, 'bench')
+RESULTS_FILE = os.path.join(BENCH_DIR, 'bench_results.json')
+BASELINE_FILE = os.path.join(BENCH_DIR, 'bench_baseline.json')
+
+fake = Faker()
+
+
+def make_patient():
+    return {
+        'first_name': fake.first_name(),
+        'last_name': fake.last_name(),
+        'gender': random.random() < 0.5,
+        'age': random.randint(1, 99),
+        'weight': round(random.uniform(40, 150), 1),
+        'height': round(random.uniform(140, 200), 1),
+        'health_history': fake.sentence(),
+    }
+
+def load_patients(count, batch_size=1000):
+    """Seals `count` generated patients and appends them to the chain, like populate_db.py does."""
+    from app import database, crypto, chain
+    start = time.perf_counter()
+    with database.db_connection() as cnx:
+        for i in range(0, count, batch_size):
+            sealed = []
+            for _ in range(min(batch_size, count - i)):
+                p = make_patient()
+                sealed.append(crypto.seal_patient(p['first_name'], p['last_name'], p['gender'], p['age'],
+                                                  p['weight'], p['height'], p['health_history']))
+            chain.append_patients(cnx, sealed)
+    return time.perf_counter() - start
+
+def login(client):
+    """Registers a throwaway Group H user and returns the auth header."""
+    username = f"bench_{os.urandom(4).hex()}"
+    client.post('/register', json={'username': username, 'password': 'bench', 'occupation': 'doctor'})
+    response = client.post('/login', json={'username': username, 'password': 'bench'})
+    return {'Authorization': f"Bearer {response.json['token']}"}
+
+def median_time(fn, repeat, before=None):
+    """Runs fn() `repeat` times (calling before() untimed ahead of each run). Returns the median seconds."""
+    times = []
+    for _ in range(repeat):
+        if before:
+            before()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+# Micro benchmarks
+
+def run_micro(calls, ope_calls, repeat):
+    from app import crypto
+
+    def per_call(fn, args_list, before=None):
+        def run():
+            for args in args_list:
+                fn(*args)
+        return {'value': median_time(run, repeat, before) / len(args_list) * 1e6, 'unit': 'us'}
+
+    def cold_ope_cache():
+        crypto.ope_cache = crypto.OPECache(crypto.ope_cache.max_size)
+
+    values = [random.randint(1, 99) for _ in range(calls)]
+    encrypted = [crypto.encrypt_field(v) + (int,) for v in values]
+    # distinct weights, so the uncached runs really call pyope every time
+    weights = [w / 100 for w in random.sample(range(4000, 15000), ope_calls)]
+    ope_ciphertexts = [(crypto.ope_encrypt(w),) for w in weights]
+    rows = [(fake.first_name(), fake.last_name(), random.random() < 0.5, random.randint(1, 99),
+             round(random.uniform(40, 150), 2), round(random.uniform(140, 200), 2), fake.sentence())
+            for _ in range(calls)]
+    macs = [(crypto.generate_row_mac(*row), crypto.GENESIS_HASH) for row in rows]
+
+    results = {
+        'encrypt_field': per_call(crypto.encrypt_field, [(v,) for v in values]),
+        'decrypt_field': per_call(crypto.decrypt_field, encrypted),
+        'ope_encrypt': per_call(crypto.ope_encrypt, [(w,) for w in weights], before=cold_ope_cache),
+        'ope_decrypt': per_call(crypto.ope_decrypt, ope_ciphertexts, before=cold_ope_cache),
+        'generate_row_mac': per_call(crypto.generate_row_mac, rows),
+        'generate_field_macs': per_call(crypto.generate_field_macs, list(enumerate(rows, start=1))),
+        'generate_chain_hash': per_call(crypto.generate_chain_hash, macs),
+    }
+    # the same weights again, now every call is an OPE cache hit
+    results['ope_encrypt_cached'] = per_call(crypto.ope_encrypt, [(w,) for w in weights])
+    results['ope_decrypt_cached'] = per_call(crypto.ope_decrypt, ope_ciphertexts)
+
+    # lookups in a small precomputed OPE table (see scripts/build_ope_table.py)
+    table = crypto.build_ope_table(6000, 6000 + ope_calls - 1)
+    data_ints = [(data_int,) for data_int in range(table.start, table.start + len(table))]
+    results['ope_table_encrypt'] = per_call(table.encrypt, data_ints)
+    results['ope_table_decrypt'] = per_call(table.decrypt, [(c,) for c in table.ciphertexts])
+    return {f"micro.{name}": result for name, result in results.items()}
+
+
+# Macro benchmarks
+
+def run_macro(client, headers, inserts, repeat):
+    from app import result_cache, snapshot
+
+    def cold():
+        result_cache.result_cache.clear()
+        snapshot._current = None
+
+    def request(method, path, **kwargs):
+        response = client.open(path, method=method, headers=headers, **kwargs)
+        if response.status_code not in (200, 201):
+            raise RuntimeError(f"{method} {path} failed: {response.status_code} {response.get_data(as_text=True)[:200]}")
+        return response
+
+    def per_request(method, path, before=None):
+        rows = len(request(method, path).json)
+        seconds = median_time(lambda: request(method, path), repeat, before)
+        return {'value': seconds * 1000, 'unit': 'ms', 'rows': rows}
+
+    results = {
+        'query_all_cold': per_request('GET', '/query_all', before=cold),
+        'query_all_warm': per_request('GET', '/query_all'),
+        # projected, no gender or weight to decrypt
+        'query_all_fields_cold': per_request('GET', '/query_all?fields=age,height', before=cold),
+        'query_by_weight_cold': per_request('GET', '/query_by_weight?min=60&max=62', before=cold),
+        'query_by_weight_warm': per_request('GET', '/query_by_weight?min=60&max=62'),
+        'query_age_cold': per_request('GET', '/query?age_min=30&age_max=32', before=cold),
+        'query_age_warm': per_request('GET', '/query?age_min=30&age_max=32'),
+    }
+    # one patient by name (blind index lookup)
+    everyone = request('GET', '/query_all').json
+    patient = everyone[len(everyone) // 2]
+    name = urlencode({'first_name': patient['first_name'], 'last_name': patient['last_name']})
+    results['query_name'] = per_request('GET', f"/query?{name}")
+
+    # last, since it changes the table
+    patients = [make_patient() for _ in range(inserts)]
+    times = []
+    for patient in patients:
+        start = time.perf_counter()
+        request('POST', '/add_data', json=patient)
+        times.append(time.perf_counter() - start)
+    results['add_data'] = {'value': statistics.median(times) * 1000, 'unit': 'ms'}
+    return {f"macro.{name}": result for name, result in results.items()}
+
+
+# Results
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=project_root,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline, threshold):
+    """Prints every benchmark next to its baseline. Returns: names that got slower than `threshold` percent"""
+    if baseline['meta'].get('rows') != results['meta']['rows']:
+        print(f"WARNING: the baseline was run with {baseline['meta'].get('rows')} rows, this run with {results['meta']['rows']}")
+
+    regressions = []
+    print(f"{'benchmark':<34} {'baseline':>12} {'now':>12} {'change':>8}")
+    for name, result in results['results'].items():
+        before = baseline['results'].get(name)
+        now = f"{result['value']:.1f} {result['unit']}"
+        if before is None:
+            print(f"{name:<34} {'-':>12} {now:>12} {'new':>8}")
+            continue
+        change = (result['value'] - before['value']) / before['value'] * 100
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  SLOWER'
+        print(f"{name:<34} {before['value']:>9.1f} {before['unit']:<2} {now:>12} {change:>+7.1f}%{flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=2000, help="patients to generate")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--calls', type=int, default=5000, help="calls per micro benchmark")
+    parser.add_argument('--ope-calls', type=int, default=100, help="calls per uncached OPE benchmark")
+    parser.add_argument('--inserts', type=int, default=50, help="/add_data requests")
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--latency-ms', type=float, default=0.0,
+                        help="sleep per SQL statement, to stand in for a remote database")
+    parser.add_argument('--skip-micro', action='store_true')
+    parser.add_argument('--skip-macro', action='store_true')
+    parser.add_argument('--output', default=RESULTS_FILE)
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true', help="write the results to --baseline too")
+    parser.add_argument('--threshold', type=float, default=10.0, help="percent slower that counts as a regression")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    Faker.seed(args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        sqlite_standin.install(os.path.join(tmp, 'bench.db'), latency=args.latency_ms / 1000)
+        from app import app, crypto, metrics, snapshot
+        # keep the benchmark away from the files of a real deployment
+        crypto.OPE_CACHE_FILE = None
+        snapshot.SNAPSHOT_FILE = None
+        # no OPE table either, so the uncached OPE benchmarks really time pyope
+        crypto._ope_table, crypto._ope_table_loaded = None, True
+        metrics.SLOW_REQUEST_MS = 0
+
+        results = {}
+        if not args.skip_micro:
+            results.update(run_micro(args.calls, args.ope_calls, args.repeat))
+
+        if not args.skip_macro:
+            load_seconds = load_patients(args.rows)
+            print(f"Loaded {args.rows} patients in {load_seconds:.1f}s")
+            client = app.test_client()
+            results.update(run_macro(client, login(client), args.inserts, args.repeat))
+
+    output = {
+        'meta': {
+            'rows': args.rows,
+            'repeat': args.repeat,
+            'latency_ms': args.latency_ms,
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'machine': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+    print(f"Wrote {args.output}")
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump(output, f, indent=2)
+        print(f"Saved the baseline to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        for name, result in results.items():
+            print(f"{name:<34} {result['value']:>9.1f} {result['unit']}")
+        print(f"No baseline at {args.baseline} (run with --save-baseline to store one)")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(output, baseline, args.threshold)
+    if regressions:
+        print(f"{len(regressions)} benchmark(s) more than {args.threshold:.0f}% slower than the baseline")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
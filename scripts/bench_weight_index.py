@@ -0,0 +1,123 @@
+import sys
+import os
+import time
+import random
+import bisect
+import argparse
+
+# adds the root folder of the project to the
+# list of places Python looks for code.
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(project_root)
+
+from app import app, database, weight_index
+
+# Benchmark of weight range lookups at different selectivities, full scan vs the
+# in-process weight index. Only the lookup is timed, decrypting the matches costs
+# the same either way.
+#
+#   python scripts/bench_weight_index.py --rows 100000 1000000
+#
+# By default the table is simulated in memory (random integers sort like OPE
+# ciphertexts). With --db the queries run against the real 'patients' table.
+
+SELECTIVITIES = [0.0001, 0.001, 0.01, 0.1, 0.5]
+
+
+def range_for(sorted_keys, selectivity):
+    """Picks a (min, max) ciphertext range matching about `selectivity` of the rows."""
+    count = max(1, int(len(sorted_keys) * selectivity))
+    start = random.randint(0, len(sorted_keys) - count)
+    return sorted_keys[start], sorted_keys[start + count - 1]
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - start) / repeat * 1000, len(result)
+
+def print_header():
+    print(f"{'rows':>10} {'selectivity':>12} {'matches':>9} {'scan ms':>10} {'index ms':>10} {'speedup':>8}")
+
+def print_line(rows, selectivity, matches, scan_ms, index_ms):
+    print(f"{rows:>10} {selectivity:>12.4%} {matches:>9} {scan_ms:>10.3f} {index_ms:>10.3f} {scan_ms / index_ms:>7.1f}x")
+
+def bench_memory(count, repeat):
+    rows = [{'patient_id': i, 'weight': random.randint(0, 2 ** 40)} for i in range(1, count + 1)]
+    by_id = {row['patient_id']: row for row in rows}
+
+    index = weight_index.WeightIndex()
+    for row in sorted(rows, key=lambda r: (r['weight'], r['patient_id'])):
+        index._keys.append(row['weight'])
+        index._ids.append(row['patient_id'])
+    sorted_keys = list(index._keys)
+
+    for selectivity in SELECTIVITIES:
+        lo, hi = range_for(sorted_keys, selectivity)
+
+        def scan():
+            return [row for row in rows if lo <= row['weight'] <= hi]
+
+        def lookup():
+            keys, ids = index._keys, index._ids
+            matched = sorted(ids[bisect.bisect_left(keys, lo):bisect.bisect_right(keys, hi)])
+            return [by_id[patient_id] for patient_id in matched]
+
+        scan_ms, matches = timed(scan, repeat)
+        index_ms, _ = timed(lookup, repeat)
+        print_line(count, selectivity, matches, scan_ms, index_ms)
+
+def bench_db(repeat):
+    with database.db_connection() as cnx:
+        if not cnx:
+            print("Connection failed. Check your config.py and certs/ca.pem file.")
+            return
+        cursor = cnx.cursor(dictionary=True)
+        plain_cursor = cnx.cursor()
+        try:
+            # first lookup builds the index
+            weight_index.weight_index.lookup(plain_cursor, 0, 0)
+            sorted_keys = list(weight_index.weight_index._keys)
+            if not sorted_keys:
+                print("'patients' is empty, run scripts/populate_db.py first.")
+                return
+
+            for selectivity in SELECTIVITIES:
+                lo, hi = range_for(sorted_keys, selectivity)
+
+                def scan():
+                    cursor.execute(
+                        "SELECT * FROM patients WHERE weight BETWEEN %s AND %s ORDER BY patient_id ASC",
+                        (lo, hi)
+                    )
+                    return cursor.fetchall()
+
+                def lookup():
+                    ids = weight_index.weight_index.lookup(plain_cursor, lo, hi)
+                    return weight_index.fetch_rows(cursor, ids, lo, hi)
+
+                scan_ms, matches = timed(scan, repeat)
+                index_ms, _ = timed(lookup, repeat)
+                print_line(len(sorted_keys), selectivity, matches, scan_ms, index_ms)
+        finally:
+            plain_cursor.close()
+            cursor.close()
+    database.get_pool().close_all()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[100000])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--db', action='store_true', help="use the real 'patients' table")
+    args = parser.parse_args()
+
+    print_header()
+    if args.db:
+        bench_db(args.repeat)
+    else:
+        for count in args.rows:
+            bench_memory(count, args.repeat)
+
+if __name__ == "__main__":
+    with app.app_context():
+        main()
@@ -0,0 +1,73 @@
+import sys
+import os
+import time
+import argparse
+import mysql.connector
+
+# adds the root folder of the project to the
+# list of places Python looks for code.
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(project_root)
+
+from app import app, database, chain, merkle
+
+# Builds the Merkle tree (see app/merkle.py) over a table that doesn't have
+# one yet, or whose tree fell behind or broke.
+#
+#   python scripts/build_merkle_tree.py
+#
+# New tables get their tree from the first insert, this is only needed for
+# tables written before it, or by a server with MERKLE_ENABLED off.
+#
+# The whole table is decrypted and verified first (chain.verify_segments), so a
+# tampered row is never signed into the tree. Then the old tree is dropped and
+# the new one built under the chain_tail lock (chain.rebuild_chain), so writers
+# wait for it. Only hashing happens there.
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    if not merkle.MERKLE_ENABLED:
+        print("MERKLE_ENABLED is off in config.py, nothing to build.")
+        return
+
+    start = time.perf_counter()
+    problems = chain.verify_segments()
+    for start_id, end_id, problem in problems:
+        print(f"FAILED: segment ({start_id}, {end_id}]: {problem}")
+    if problems:
+        print("ERROR: the table doesn't verify, look into it before building the tree. Nothing was built.")
+        return
+    print(f"Step 1: table verified in {time.perf_counter() - start:.1f}s.")
+
+    with database.db_connection() as cnx:
+        if not cnx:
+            print("Connection failed. Check your config.py and certs/ca.pem file.")
+            return
+
+        try:
+            chain.ensure_tables()
+            cursor = cnx.cursor()
+            try:
+                cursor.execute("DELETE FROM merkle_state")
+                cnx.commit()
+            finally:
+                cursor.close()
+
+            start = time.perf_counter()
+            chain.rebuild_chain(cnx, (), None, after_id=0, batch_size=args.batch_size)
+            print(f"Step 2: tree built in {time.perf_counter() - start:.1f}s.")
+        except chain.ChainBroken as err:
+            print(f"ERROR: {err}. Run it again, nothing was built.")
+        except chain.IdGaps as err:
+            print(f"ERROR: {err}. This table can't have a tree, keep MERKLE_ENABLED off. Nothing was built.")
+        except mysql.connector.Error as err:
+            print(f"Error: {err}")
+            cnx.rollback()
+
+    database.get_pool().close_all()
+
+if __name__ == "__main__":
+    main()
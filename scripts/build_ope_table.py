@@ -0,0 +1,69 @@
+import sys
+import os
+import time
+import random
+import argparse
+
+# adds the root folder of the project to the
+# list of places Python looks for code.
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(project_root)
+
+from app import app, crypto
+
+# Builds the precomputed OPE table (see OPE_TABLE_FILE in config.py).
+#
+#   python scripts/build_ope_table.py --workers 4                 # whole OPE domain (0.00 to 327.67)
+#   python scripts/build_ope_table.py --min 30 --max 250          # only this weight range
+#
+# Every value costs one pyope encryption, so this takes a while. It only has to
+# be run again if OPE_KEY or OPE_PRECISION changes. Afterwards a few lookups
+# are timed against pyope.
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--min', type=float, help="lowest weight (default: the whole OPE domain)")
+    parser.add_argument('--max', type=float, help="highest weight")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--output', default=crypto.OPE_TABLE_FILE)
+    args = parser.parse_args()
+
+    if not args.output:
+        parser.error("set OPE_TABLE_FILE in config.py or pass --output")
+
+    start = int(round(args.min * crypto.OPE_PRECISION)) if args.min is not None else None
+    end = int(round(args.max * crypto.OPE_PRECISION)) if args.max is not None else None
+
+    began = time.perf_counter()
+    table = crypto.build_ope_table(start, end, workers=args.workers)
+    build_seconds = time.perf_counter() - began
+    table.save(args.output)
+
+    print(f"Built {len(table)} values (weights {table.start / crypto.OPE_PRECISION:.2f} to "
+          f"{(table.start + len(table) - 1) / crypto.OPE_PRECISION:.2f}) in {build_seconds:.1f}s "
+          f"with {args.workers} worker(s)")
+    print(f"Table: {len(table) * table.ciphertexts.itemsize / 1024:.0f} KiB in memory, "
+          f"{os.path.getsize(args.output) / 1024:.0f} KiB on disk ({args.output})")
+
+    # check a sample against pyope and compare the cost
+    sample = random.sample(range(table.start, table.start + len(table)), min(200, len(table)))
+    began = time.perf_counter()
+    expected = [crypto.ope_cipher.encrypt(data_int) for data_int in sample]
+    pyope_us = (time.perf_counter() - began) / len(sample) * 1e6
+
+    began = time.perf_counter()
+    found = [table.encrypt(data_int) for data_int in sample]
+    encrypt_us = (time.perf_counter() - began) / len(sample) * 1e6
+
+    began = time.perf_counter()
+    decrypted = [table.decrypt(ciphertext) for ciphertext in expected]
+    decrypt_us = (time.perf_counter() - began) / len(sample) * 1e6
+
+    if found != expected or decrypted != sample:
+        raise SystemExit("ERROR: the table doesn't match pyope")
+    print(f"pyope encrypt: {pyope_us:.0f} us, table encrypt: {encrypt_us:.2f} us, "
+          f"table decrypt: {decrypt_us:.2f} us")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import os
+import time
+import argparse
+import threading
+
+import requests
+
+# Load test for a running server, to compare the serving modes:
+#
+#   python run.py                    # Flask development server
+#   python run.py --asgi             # uvicorn (app/asgi.py)
+#
+#   python scripts/load_test.py --url http://localhost:5000 --concurrency 32 --duration 15
+#
+# Every client thread sends requests back to back for `duration` seconds and the
+# script prints the throughput and latency percentiles of each endpoint.
+# It registers a throwaway Group H user, so point it at a test database.
+#
+# --login-storm N adds N threads that keep calling /login at the same time, to
+# check that the read endpoints stay responsive while bcrypt is saturated:
+#
+#   python scripts/load_test.py --concurrency 8 --login-storm 64
+
+DEFAULT_ENDPOINTS = ['/query_all?limit=100', '/query_by_weight?min=60&max=80', '/stats']
+
+
+def login(url):
+    """Registers a throwaway Group H user and returns (credentials, auth header)."""
+    credentials = {'username': f"load_{os.urandom(4).hex()}", 'password': 'load'}
+    requests.post(f"{url}/register", json=dict(credentials, occupation='doctor'))
+    response = requests.post(f"{url}/login", json=credentials)
+    response.raise_for_status()
+    return credentials, {'Authorization': f"Bearer {response.json()['token']}"}
+
+def login_storm(url, credentials, stop, outcomes, lock):
+    session = requests.Session()
+    while not stop.is_set():
+        try:
+            status = session.post(f"{url}/login", json=credentials, timeout=60).status_code
+        except requests.RequestException:
+            status = 'error'
+        with lock:
+            outcomes[status] = outcomes.get(status, 0) + 1
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+def client(url, endpoint, headers, deadline, latencies, errors, lock):
+    session = requests.Session()
+    mine = []
+    failed = 0
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            response = session.get(f"{url}{endpoint}", headers=headers, timeout=60)
+            ok = response.status_code == 200
+        except requests.RequestException:
+            ok = False
+        if ok:
+            mine.append(time.perf_counter() - start)
+        else:
+            failed += 1
+    with lock:
+        latencies.extend(mine)
+        errors[0] += failed
+
+def run(url, endpoint, headers, concurrency, duration, credentials, storm):
+    # one request first, so caches are warm before the clock starts
+    requests.get(f"{url}{endpoint}", headers=headers, timeout=600)
+
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    stop = threading.Event()
+    outcomes = {}
+    storm_threads = [
+        threading.Thread(target=login_storm, args=(url, credentials, stop, outcomes, lock))
+        for _ in range(storm)
+    ]
+    for t in storm_threads:
+        t.start()
+
+    deadline = time.perf_counter() + duration
+    threads = [
+        threading.Thread(target=client, args=(url, endpoint, headers, deadline, latencies, errors, lock))
+        for _ in range(concurrency)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    stop.set()
+    for t in storm_threads:
+        t.join()
+
+    latencies.sort()
+    ms = [l * 1000 for l in latencies]
+    line = (f"{endpoint:<36} {len(latencies) / duration:>9.1f} {percentile(ms, 50):>9.1f} "
+            f"{percentile(ms, 95):>9.1f} {percentile(ms, 99):>9.1f} {errors[0]:>7}")
+    if storm:
+        line += "   logins: " + ", ".join(f"{status}={n}" for status, n in sorted(outcomes.items(), key=str))
+    print(line)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--endpoints', nargs='+', default=DEFAULT_ENDPOINTS)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=15)
+    parser.add_argument('--login-storm', type=int, default=0,
+                        help="threads calling /login in the background")
+    args = parser.parse_args()
+
+    credentials, headers = login(args.url)
+    print(f"{args.concurrency} clients, {args.duration:.0f}s per endpoint"
+          + (f", {args.login_storm} login threads" if args.login_storm else ""))
+    print(f"{'endpoint':<36} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for endpoint in args.endpoints:
+        run(args.url, endpoint, headers, args.concurrency, args.duration, credentials, args.login_storm)
+
+    # the server's own view, including the bcrypt queue
+    response = requests.get(f"{args.url}/metrics", params={"format": "json"}, headers=headers, timeout=60)
+    if response.status_code != 200:
+        print(f"bcrypt: /metrics answered {response.status_code}, see METRICS_ACCESS in config.py")
+        return
+    print(f"bcrypt: {response.json()['bcrypt']}")
+
+if __name__ == "__main__":
+    main()
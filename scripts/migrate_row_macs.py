@@ -0,0 +1,142 @@
+import sys
+import os
+import time
+import argparse
+import mysql.connector
+
+# adds the root folder of the project to the
+# list of places Python looks for code.
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(project_root)
+
+from app import app, database, crypto, chain
+
+# Moves rows sealed with a single row MAC (mac_version NULL or 1) over to
+# per-field MACs (mac_version 2, see crypto.MAC_FIELDS), so projected queries
+# (?fields=) can skip decrypting them in full.
+#
+#   python scripts/migrate_row_macs.py
+#
+# 1. Makes sure the field_macs and mac_version columns exist (the server adds
+#    them at startup, see chain.ensure_tables).
+# 2. Decrypts and verifies the old rows batch by batch (crypto.process_rows)
+#    and stores their field MACs. Each batch is its own commit and the rows keep
+#    mac_version 1, so readers don't see any difference yet. This is the slow
+#    part and it runs without blocking anyone.
+# 3. Switches the rows to mac_version 2 in one transaction: their row MACs are
+#    made from the stored field MACs and the hash chain is rebuilt from the first
+#    old row to the tail (chain.rebuild_chain). Nothing is decrypted here, but
+#    writers wait for it. Readers see the old chain until the commit.
+#
+# Rows that fail verification are never migrated, and step 3 refuses to run
+# while there are any (or if the chain is broken), so a tampered row can't be
+# sealed again. It is safe to stop the script and run it again.
+
+OLD_ROWS = "(mac_version IS NULL OR mac_version < 2)"
+
+
+def field_macs_of(plain_row, key_id):
+    """Returns: the field MACs of a verified plaintext row, with the keys it was sealed with"""
+    return crypto.generate_field_macs(plain_row['patient_id'], [plain_row[field] for field in crypto.MAC_FIELDS],
+                                      key_id)
+
+def store_field_macs(cnx, batch_size):
+    """
+    Step 2: verifies the old rows and stores their field MACs, batch by batch.
+    Returns: (rows done, rows that failed verification)
+    """
+    select = (f"SELECT * FROM patients WHERE patient_id > %s AND {OLD_ROWS} AND field_macs IS NULL "
+              f"ORDER BY patient_id ASC LIMIT %s")
+    done = failed = 0
+    last_id = 0
+    cursor = cnx.cursor(dictionary=True)
+    try:
+        while True:
+            cursor.execute(select, (last_id, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1]['patient_id']
+
+            batch = crypto.process_rows(rows)
+            for patient_id, reason in batch.failures:
+                print(f"WARNING: {reason} for patient_id {patient_id}, not migrated")
+
+            key_ids = {row['patient_id']: crypto.row_key_id(row) for row in rows}
+            values = [(field_macs_of(row, key_ids[row['patient_id']]), row['patient_id']) for row in batch.rows]
+            if values:
+                cursor.executemany("UPDATE patients SET field_macs = %s WHERE patient_id = %s", values)
+            cnx.commit()
+            done += len(values)
+            failed += len(batch.failures)
+            print(f"Field MACs stored up to patient_id {last_id} ({done} rows so far).")
+    finally:
+        cursor.close()
+    return done, failed
+
+def reseal(row):
+    """Step 3, for chain.rebuild_chain(): the new (field_macs, mac_version, row_mac) of a row."""
+    if (row['mac_version'] or 1) >= 2:
+        return row['field_macs'], row['mac_version'], row['row_mac']
+
+    field_macs = row['field_macs']
+    if field_macs is None:
+        # written by an old server after step 2, there are only a few of these
+        batch = crypto.process_rows([row])
+        if batch.failures:
+            raise chain.ChainBroken(f"patient_id {row['patient_id']} failed verification ({batch.failures[0][1]})")
+        field_macs = field_macs_of(batch.rows[0], crypto.row_key_id(row))
+
+    field_macs = bytes(field_macs)
+    return field_macs, crypto.MAC_VERSION, crypto.generate_fields_row_mac(row['patient_id'], field_macs,
+                                                                           crypto.row_key_id(row))
+
+def switch_over(cnx, batch_size):
+    """Step 3: rebuilds the chain from the first old row. Returns: rows rewritten"""
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(f"SELECT MIN(patient_id) FROM patients WHERE {OLD_ROWS}")
+        first_id = cursor.fetchone()[0]
+    finally:
+        cursor.close()
+    cnx.commit()
+    if first_id is None:
+        return 0
+    return chain.rebuild_chain(cnx, ('field_macs', 'mac_version', 'row_mac'), reseal,
+                               after_id=first_id - 1, batch_size=batch_size)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    with database.db_connection() as cnx:
+        if not cnx:
+            print("Connection failed. Check your config.py and certs/ca.pem file.")
+            return
+
+        try:
+            chain.ensure_tables()
+
+            start = time.perf_counter()
+            done, failed = store_field_macs(cnx, args.batch_size)
+            print(f"Step 2: {done} rows verified in {time.perf_counter() - start:.1f}s.")
+            if failed:
+                print(f"ERROR: {failed} rows failed verification. Look into them (scripts/verify_chain.py) "
+                      "before switching over, nothing was switched.")
+                return
+
+            start = time.perf_counter()
+            rewritten = switch_over(cnx, args.batch_size)
+            print(f"Step 3: chain rebuilt over {rewritten} rows in {time.perf_counter() - start:.1f}s.")
+        except chain.ChainBroken as err:
+            print(f"ERROR: {err}. Nothing was switched over.")
+        except mysql.connector.Error as err:
+            print(f"Error: {err}")
+            cnx.rollback()
+            print("Field MACs committed before the error are kept, run again to continue.")
+
+    database.get_pool().close_all()
+
+if __name__ == "__main__":
+    main()
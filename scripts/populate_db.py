@@ -1,14 +1,18 @@
 import sys
 import os
+import time
+import argparse
+import multiprocessing
 import mysql.connector
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 
 # adds the root folder of the project to the 
 # list of places Python looks for code.
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.append(project_root)
 
-from app.database import get_db_connection
-from app import app, database, crypto
+from app import app, database, crypto, chain, merkle
 
 CREATE_USERS_TABLE = """
 CREATE TABLE IF NOT EXISTS users (
@@ -22,136 +26,233 @@ CREATE TABLE IF NOT EXISTS users (
 CREATE_PATIENTS_TABLE = """
 CREATE TABLE IF NOT EXISTS patients (
     patient_id INT AUTO_INCREMENT PRIMARY KEY,
+    key_id TINYINT,
     first_name VARCHAR(100),
     last_name VARCHAR(100),
     gender VARBINARY(255),
     gender_nonce VARBINARY(12),
     age VARBINARY(255),
     age_nonce VARBINARY(12),
+    age_ope BIGINT,
     weight BIGINT,
     height FLOAT,
     health_history TEXT,
+    gender_bidx VARBINARY(16),
+    first_name_bidx VARBINARY(16),
+    last_name_bidx VARBINARY(16),
+    field_macs VARBINARY(112),
+    mac_version TINYINT,
     row_mac VARBINARY(32),
-    chain_hash VARBINARY(32)
+    chain_hash VARBINARY(32),
+    INDEX idx_patients_weight (weight),
+    INDEX idx_patients_age (age_ope),
+    INDEX idx_patients_gender (gender_bidx),
+    INDEX idx_patients_first_name (first_name_bidx),
+    INDEX idx_patients_last_name (last_name_bidx)
 )
 """
-# SQL query to insert a new patient
-INSERT_PATIENT_QUERY = """
-INSERT INTO patients (
-    first_name, last_name, 
-    gender, gender_nonce,
-    age, age_nonce,
-    weight, height, health_history,
-    row_mac,
-    chain_hash
-) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+CREATE_PROGRESS_TABLE = """
+CREATE TABLE IF NOT EXISTS load_progress (
+    id TINYINT PRIMARY KEY,
+    last_import_id INT NOT NULL,
+    tail_patient_id INT NOT NULL,
+    tail_hash VARBINARY(32) NOT NULL
+)
+"""
+
+# patients_import is read in keyset batches, so no batch holds the whole table
+SELECT_IMPORT_BATCH = """
+SELECT patient_id, first_name, last_name, gender, age, weight, height, health_history
+FROM patients_import
+WHERE patient_id > %s
+ORDER BY patient_id ASC
+LIMIT %s
 """
 
 
-def setup_database():
-    cnx = None
-    cursor = None
+def seal_import_rows(rows):
+    """
+    Encrypts and seals a batch of patients_import rows, in order. Runs in the
+    worker processes. Rows whose weight can't be OPE encrypted come back as None.
+    """
+    sealed = []
+    for first_name, last_name, gender, age, weight, height, health_history in rows:
+        if gender is None:
+            gender_bool = None
+        else:
+            gender_bool = bool(gender) # Converts 1/0 to True/False
+
+        # We MUST round before encrypting to avoid floating point mismatches
+        if weight is not None:
+            weight = round(float(weight), 2)
+
+        if height is not None:
+            height = round(float(height), 2)
+
+        sealed.append(crypto.seal_patient(
+            first_name, last_name, gender_bool, age, weight, height, health_history
+        ))
+    return sealed
+
+def _seal_later(executor, rows):
+    """(Private) Starts sealing a batch. Without an executor it is done right away."""
+    if executor is None:
+        future = Future()
+        future.set_result(seal_import_rows(rows))
+        return future
+    return executor.submit(seal_import_rows, rows)
+
+def read_progress(cursor):
+    """Returns: (last_import_id, tail_patient_id, tail_hash) of the last committed batch, or None"""
+    cursor.execute("SELECT last_import_id, tail_patient_id, tail_hash FROM load_progress WHERE id = 1")
+    row = cursor.fetchone()
+    return (row[0], row[1], bytes(row[2])) if row else None
+
+def save_progress(cursor, last_import_id, tail_id, tail_hash):
+    cursor.execute(
+        "REPLACE INTO load_progress (id, last_import_id, tail_patient_id, tail_hash) VALUES (1, %s, %s, %s)",
+        (last_import_id, tail_id, tail_hash)
+    )
+
+def load_patients(cnx, cursor, last_import_id, batch_size, workers):
+    """
+    Streams patients_import into 'patients' starting after `last_import_id`.
+    While one batch is written, the next ones are already being sealed by the
+    worker processes. Every batch is its own commit, together with the chain
+    tail, checkpoints and load_progress, so a crash loses at most one batch.
+    Returns: (rows inserted, rows skipped)
+    """
+    executor = None
+    if workers:
+        # spawn, so the workers don't inherit the open database connection
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    # enough batches in flight to keep every worker busy
+    in_flight = max(workers, 1) * 2
+
+    inserted = skipped = 0
+    pending = deque()  # (last import id of the batch, future)
+    done_reading = False
     try:
-        print("Connecting to Aiven database...")
-        cnx = get_db_connection()
+        while pending or not done_reading:
+            while not done_reading and len(pending) < in_flight:
+                cursor.execute(SELECT_IMPORT_BATCH, (last_import_id, batch_size))
+                rows = cursor.fetchall()
+                if not rows:
+                    done_reading = True
+                    break
+                last_import_id = rows[-1][0]
+                pending.append((last_import_id, _seal_later(executor, [row[1:] for row in rows])))
+
+            if not pending:
+                break
+
+            # batches are written in the order they were read, so the chain stays in import order
+            batch_last_id, future = pending.popleft()
+            sealed = future.result()
+            rows = [row for row in sealed if row is not None]
+            if len(rows) != len(sealed):
+                print(f"WARNING: {len(sealed) - len(rows)} rows up to import id {batch_last_id} could not be encrypted, skipped.")
+
+            chain.append_patients(
+                cnx, rows,
+                before_commit=lambda cur, tail_id, tail_hash: save_progress(cur, batch_last_id, tail_id, tail_hash)
+            )
+            inserted += len(rows)
+            skipped += len(sealed) - len(rows)
+            print(f"Committed up to import id {batch_last_id} ({inserted} rows so far).")
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+
+    return inserted, skipped
+
+
+def setup_database(resume=False, batch_size=1000, workers=None):
+    print("Connecting to Aiven database...")
+    with database.db_connection() as cnx:
         if not cnx:
             print("Connection failed. Check your config.py and certs/ca.pem file.")
             return
 
         cursor = cnx.cursor()
         print("Connection successful.")
+        try:
+            # Create Tables
+            print("Creating 'users' table (if not exists)...")
+            cursor.execute(CREATE_USERS_TABLE)
+            print("Creating 'patients' table (if not exists)...")
+            cursor.execute(CREATE_PATIENTS_TABLE)
+            print("Creating 'chain_checkpoints' table (if not exists)...")
+            cursor.execute(chain.CREATE_CHECKPOINTS_TABLE)
+            print("Creating 'chain_tail' table (if not exists)...")
+            cursor.execute(chain.CREATE_TAIL_TABLE)
+            print("Creating 'merkle_nodes' and 'merkle_state' tables (if not exist)...")
+            cursor.execute(merkle.CREATE_NODES_TABLE)
+            cursor.execute(merkle.CREATE_STATE_TABLE)
+            # an existing 'patients' table may be older than CREATE_PATIENTS_TABLE
+            chain.upgrade_patients_table(cursor)
+            print("Creating 'load_progress' table (if not exists)...")
+            cursor.execute(CREATE_PROGRESS_TABLE)
+            print("Tables created successfully.")
 
-        # Create Tables
-        print("Creating 'users' table (if not exists)...")
-        cursor.execute(CREATE_USERS_TABLE)
-        print("Creating 'patients' table (if not exists)...")
-        cursor.execute(CREATE_PATIENTS_TABLE)
-        print("Tables created successfully.")
-
-        # CLEAR OLD DATA
-        print("Clearing all old data from 'patients' table...")
-        cursor.execute("TRUNCATE TABLE patients")
-        print("Old data cleared.")
-
-        print("Loading imported patient data from patients_import...")
-        cursor.execute("""
-            SELECT first_name, last_name, gender, age, weight, height, health_history
-            FROM patients_import
-            ORDER BY patient_id ASC
-        """)
-        imported_rows = cursor.fetchall()
-        print(f"Loaded {len(imported_rows)} rows from patients_import.")      
- 
-        # Populating with our custom, encrypted data
-        print(f"Populating 'patients' table with {len(imported_rows)}, all chained custom encrypted records...")
-        
-        print(f"Encrypting and inserting {len(imported_rows)} imported rows...")
-
-        # initializing chain with Genesis Hash
-        last_known_hash = crypto.GENESIS_HASH
-        
-        # Loop over custom list
-        for row_data in imported_rows:
-            # Get the 7 plaintext fields from the tuple
-            first_name, last_name, gender, age, weight, height, health_history = row_data
-
-            if gender is None:
-                gender_bool = None
+            progress = read_progress(cursor) if resume else None
+            if progress:
+                last_import_id, tail_id, tail_hash = progress
+                # the tail must still be where the last batch left it, otherwise
+                # something else wrote to 'patients' and resuming would fork the chain
+                if chain.read_tail(cursor) != (tail_id, tail_hash):
+                    print("ERROR: 'patients' has changed since the last load, can't resume. Run without --resume.")
+                    return
+                print(f"Resuming after import id {last_import_id} (patient {tail_id}).")
             else:
-                gender_bool = bool(gender) # Converts 1/0 to True/False
-            
-            # We MUST round before encrypting to avoid floating point mismatches
-            if weight is not None:
-                weight = round(float(weight), 2)
-
-            if height is not None:
-                height = round(float(height), 2)
-
-            gender_ct, gender_nonce = crypto.encrypt_field(gender_bool) # Use gender_bool!
-            age_ct, age_nonce = crypto.encrypt_field(age)
-            
-            # Encrypt Weight
-            encrypted_weight = crypto.ope_encrypt(weight) if weight is not None else None
-            
-            # generating the integrity seal using the CORRECT boolean and rounded weight/height
-            row_mac = crypto.generate_row_mac(
-                first_name, last_name, gender_bool, age, weight, height, health_history
-            )
+                if resume:
+                    print("No progress recorded, starting from scratch.")
+                # CLEAR OLD DATA
+                print("Clearing all old data from 'patients' table...")
+                cursor.execute("TRUNCATE TABLE patients")
+                cursor.execute("TRUNCATE TABLE chain_checkpoints")
+                # the tail row is rebuilt from 'patients' on the first insert
+                cursor.execute("TRUNCATE TABLE chain_tail")
+                # the tree starts again with the first insert
+                cursor.execute("TRUNCATE TABLE merkle_nodes")
+                cursor.execute("TRUNCATE TABLE merkle_state")
+                cursor.execute("TRUNCATE TABLE load_progress")
+                print("Old data cleared.")
+                last_import_id = 0
 
-            # generating the chain hash
-            new_chain_hash = crypto.generate_chain_hash(row_mac, last_known_hash)
-
-            # building the 10-value tuple for the SQL query
-            patient_data_tuple = (
-                first_name, last_name,
-                gender_ct, gender_nonce,
-                age_ct, age_nonce,
-                encrypted_weight, height, health_history,
-                row_mac,
-                new_chain_hash
-            )
-            
-            cursor.execute(INSERT_PATIENT_QUERY, patient_data_tuple)
-
-            # updating hash for next loop
-            last_known_hash = new_chain_hash
-
-        cnx.commit()
-        
-        print("\n Database Setup Complete! --->")
-        print(f"{len(imported_rows)} custom, chained records added to 'patients'.")
-    
-    except mysql.connector.Error as err:
-        print(f"\nAn Error Occurred --->")
-        print(f"Error: {err}")
-        if cnx:
+            if workers is None:
+                workers = os.cpu_count() or 1
+            print(f"Encrypting and inserting patients_import in batches of {batch_size} with {workers} workers...")
+            start = time.perf_counter()
+            inserted, skipped = load_patients(cnx, cursor, last_import_id, batch_size, workers)
+            elapsed = time.perf_counter() - start
+
+            print("\n Database Setup Complete! --->")
+            print(f"{inserted} custom, chained records added to 'patients' in {elapsed:.1f}s"
+                  + (f" ({skipped} skipped)." if skipped else "."))
+
+        except mysql.connector.Error as err:
+            print(f"\nAn Error Occurred --->")
+            print(f"Error: {err}")
             print("Rolling back changes...")
             cnx.rollback()
-    finally:
-        if cursor: cursor.close()
-        if cnx: cnx.close()
-        print("Database connection closed.")
+            print("Batches committed before the error are kept, run again with --resume to continue.")
+        finally:
+            cursor.close()
+
+    # the connection goes back to the pool when the 'with' block ends
+    database.get_pool().close_all()
+    print("Database connection closed.")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Encrypts patients_import into the 'patients' table.")
+    parser.add_argument('--resume', action='store_true',
+                        help="continue an interrupted load instead of clearing 'patients'")
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help="rows per batch and per commit")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="encryption processes (default: one per CPU, 0 encrypts in this process)")
+    args = parser.parse_args()
+
     with app.app_context():
-        setup_database()
\ No newline at end of file
+        setup_database(resume=args.resume, batch_size=args.batch_size, workers=args.workers)
\ No newline at end of file
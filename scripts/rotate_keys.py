@@ -0,0 +1,96 @@
+import sys
+import os
+import time
+import argparse
+import mysql.connector
+
+# adds the root folder of the project to the
+# list of places Python looks for code.
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(project_root)
+
+from app import app, database, crypto, chain, rotation
+
+# Re-encrypts every patient with a new key version (see app/rotation.py).
+#
+#   python scripts/rotate_keys.py --status                   # rows per key_id
+#   python scripts/rotate_keys.py                            # to CURRENT_KEY_ID
+#   python scripts/rotate_keys.py --workers 4 --max-rows-per-sec 2000 --cpu-share 0.25
+#
+# Before running it, add the new key to KEYRING and set CURRENT_KEY_ID in the
+# config.py of every server and restart them, so no new rows are written with
+# the old key. Once it reports no rows left on the old key, that key can be
+# removed from KEYRING.
+#
+# It is safe to stop the script and run it again, staged rows are kept.
+
+
+def print_status(cnx):
+    counts = rotation.key_counts(cnx)
+    for key_id in sorted(counts):
+        known = "" if key_id in crypto.keyring else "  (not in KEYRING, these rows can't be read)"
+        print(f"key_id {key_id}: {counts[key_id]} rows{known}")
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--to', type=int, default=crypto.CURRENT_KEY_ID, help="key_id to move to (default: CURRENT_KEY_ID)")
+    parser.add_argument('--batch-size', type=int, default=rotation.KEY_ROTATION_BATCH_SIZE)
+    parser.add_argument('--workers', type=int, default=rotation.KEY_ROTATION_WORKERS)
+    parser.add_argument('--max-rows-per-sec', type=float, default=rotation.KEY_ROTATION_MAX_ROWS_PER_SEC,
+                        help="0 for no limit")
+    parser.add_argument('--cpu-share', type=float, default=rotation.KEY_ROTATION_CPU_SHARE,
+                        help="share of the time spent working, 1 never sleeps")
+    parser.add_argument('--stage-only', action='store_true', help="re-encrypt into key_rotation, don't switch over")
+    parser.add_argument('--status', action='store_true', help="only print the rows per key_id")
+    args = parser.parse_args()
+
+    if args.to not in crypto.keyring:
+        parser.error(f"key_id {args.to} is not in KEYRING")
+    if args.to != crypto.CURRENT_KEY_ID:
+        print(f"WARNING: key_id {args.to} is not CURRENT_KEY_ID ({crypto.CURRENT_KEY_ID}), "
+              "new rows will keep using the current key")
+
+    with database.db_connection() as cnx:
+        if not cnx:
+            print("Connection failed. Check your config.py and certs/ca.pem file.")
+            return
+
+        try:
+            # adds the key_id column if no server has been started since the upgrade
+            chain.ensure_tables()
+            counts = print_status(cnx)
+            if args.status:
+                return
+            if not any(count for key_id, count in counts.items() if key_id != args.to):
+                print(f"All rows are on key_id {args.to} already.")
+                return
+
+            rotation.ensure_table()
+            throttle = rotation.Throttle(args.max_rows_per_sec, args.cpu_share)
+            start = time.perf_counter()
+            staged, failed = rotation.stage(cnx, args.to, args.batch_size, args.workers, throttle)
+            print(f"Step 1: {staged} rows re-encrypted in {time.perf_counter() - start:.1f}s "
+                  f"({throttle.slept:.1f}s of it throttled).")
+            if failed:
+                print(f"ERROR: {failed} rows failed verification. Look into them (scripts/verify_chain.py) "
+                      "before switching over, nothing was switched.")
+                return
+            if args.stage_only:
+                return
+
+            start = time.perf_counter()
+            rewritten = rotation.switch(cnx, args.to, args.batch_size)
+            print(f"Step 2: chain rebuilt over {rewritten} rows in {time.perf_counter() - start:.1f}s.")
+            print_status(cnx)
+        except chain.ChainBroken as err:
+            print(f"ERROR: {err}. Nothing was switched over.")
+        except mysql.connector.Error as err:
+            print(f"Error: {err}")
+            cnx.rollback()
+            print("Batches staged before the error are kept, run again to continue.")
+
+    database.get_pool().close_all()
+
+if __name__ == "__main__":
+    main()
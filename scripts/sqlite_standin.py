@@ -0,0 +1,167 @@
+import re
+import time
+import sqlite3
+
+import mysql.connector
+
+# SQLite stand-in for the MySQL server, for benchmarks on a machine without one.
+#
+#   import sqlite_standin
+#   sqlite_standin.install('/tmp/bench.db')   # before the first database call
+#
+# install() points mysql.connector.connect() at a SQLite file, so the
+# connection pool, the routes and chain.append_patients() run unchanged. The
+# tables are made from the CREATE TABLE statements in populate_db.py and
+# app/chain.py and app/merkle.py, so new columns show up here too. Only the little SQL the app
+# needs is translated (%s placeholders, FOR UPDATE, INSERT IGNORE).
+#
+# SQLite has one writer at a time and no network, so absolute numbers are
+# not MySQL numbers. `latency` (seconds) adds a sleep per statement to stand
+# in for the round trip to a remote database.
+
+
+def _sql(statement):
+    statement = statement.replace('%s', '?')
+    statement = re.sub(r'\s+FOR UPDATE', '', statement)
+    return statement.replace('INSERT IGNORE', 'INSERT OR IGNORE')
+
+def sqlite_ddl(mysql_ddl):
+    """
+    Translates one of our MySQL CREATE TABLE statements to SQLite.
+    Inline INDEX lines become CREATE INDEX statements.
+    Returns: list of SQLite statements
+    """
+    table = re.search(r'CREATE TABLE IF NOT EXISTS (\w+)', mysql_ddl).group(1)
+    ddl = re.sub(r'INT AUTO_INCREMENT PRIMARY KEY', 'INTEGER PRIMARY KEY AUTOINCREMENT', mysql_ddl)
+    ddl = re.sub(r"ENUM\([^)]*\)", 'TEXT', ddl)
+
+    indexes = []
+    def take_index(match):
+        indexes.append(f"CREATE INDEX IF NOT EXISTS {match.group(2)} ON {table} ({match.group(3)})")
+        return ''
+    ddl = re.sub(r',\s*(UNIQUE\s+)?INDEX (\w+) \(([^)]*)\)', take_index, ddl)
+    return [ddl] + indexes
+
+
+class Cursor:
+    def __init__(self, connection, dictionary):
+        self._connection = connection
+        self._cursor = connection._db.cursor()
+        self._dictionary = dictionary
+
+    def execute(self, statement, params=()):
+        if self._connection.latency:
+            time.sleep(self._connection.latency)
+        if 'FOR UPDATE' in statement and not self._connection._db.in_transaction:
+            # the closest SQLite has to a row lock: take the write lock now
+            self._connection._db.execute('BEGIN IMMEDIATE')
+        try:
+            self._cursor.execute(_sql(statement), tuple(params or ()))
+        except sqlite3.IntegrityError as e:
+            raise mysql.connector.IntegrityError(msg=str(e), errno=1062)
+        except sqlite3.Error as e:
+            raise mysql.connector.Error(msg=str(e))
+
+    def executemany(self, statement, seq_params):
+        if self._connection.latency:
+            time.sleep(self._connection.latency)
+        try:
+            self._cursor.executemany(_sql(statement), [tuple(params) for params in seq_params])
+        except sqlite3.IntegrityError as e:
+            raise mysql.connector.IntegrityError(msg=str(e), errno=1062)
+        except sqlite3.Error as e:
+            raise mysql.connector.Error(msg=str(e))
+
+    def _row(self, row):
+        if row is None or not self._dictionary:
+            return row
+        return {column[0]: value for column, value in zip(self._cursor.description, row)}
+
+    def fetchone(self):
+        return self._row(self._cursor.fetchone())
+
+    def fetchall(self):
+        return [self._row(row) for row in self._cursor.fetchall()]
+
+    def fetchmany(self, size=1):
+        return [self._row(row) for row in self._cursor.fetchmany(size)]
+
+    def __iter__(self):
+        for row in self._cursor:
+            yield self._row(row)
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    def close(self):
+        self._cursor.close()
+
+
+class Connection:
+    def __init__(self, path, latency=0.0):
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self.latency = latency
+        self._open = True
+
+    def cursor(self, dictionary=False, buffered=None, **kwargs):
+        return Cursor(self, dictionary)
+
+    def start_transaction(self):
+        self._db.execute('BEGIN IMMEDIATE')
+
+    @property
+    def in_transaction(self):
+        return self._db.in_transaction
+
+    def commit(self):
+        self._db.commit()
+
+    def rollback(self):
+        self._db.rollback()
+
+    def is_connected(self):
+        return self._open
+
+    def ping(self, reconnect=False, attempts=1, delay=0):
+        if not self._open:
+            raise mysql.connector.InterfaceError(msg="Connection closed")
+
+    def close(self):
+        self._db.close()
+        self._open = False
+
+
+def install(path, latency=0.0):
+    """
+    Creates the tables in the SQLite file at `path` (if missing) and makes
+    mysql.connector.connect() return connections to it from now on.
+    """
+    # imported here, they pull in the app (and config.py)
+    import populate_db
+    from app import chain, merkle
+
+    statements = []
+    for ddl in (populate_db.CREATE_USERS_TABLE, populate_db.CREATE_PATIENTS_TABLE,
+                chain.CREATE_TAIL_TABLE, chain.CREATE_CHECKPOINTS_TABLE,
+                merkle.CREATE_NODES_TABLE, merkle.CREATE_STATE_TABLE):
+        statements += sqlite_ddl(ddl)
+
+    db = sqlite3.connect(path)
+    try:
+        for statement in statements:
+            db.execute(statement)
+        db.commit()
+    finally:
+        db.close()
+
+    mysql.connector.connect = lambda **kwargs: Connection(path, latency)
@@ -0,0 +1,115 @@
+import sys
+import os
+import time
+import random
+import argparse
+import threading
+import multiprocessing
+
+# adds the root folder of the project to the
+# list of places Python looks for code.
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(project_root)
+
+from app import app, chain
+
+# Stress test for concurrent writers: many threads (in one or more processes)
+# call /add_data and /add_data/bulk at the same time, then the whole hash chain
+# is re-verified. A forked chain shows up as a broken segment.
+# It REALLY INSERTS rows into the database in config.py, use a test database.
+#
+#   python scripts/stress_chain_writers.py --processes 2 --threads 8 --requests 25
+
+
+def make_patient(i):
+    return {
+        'first_name': f"Stress{i}", 'last_name': "Writer",
+        'gender': random.random() < 0.5,
+        'age': random.randint(1, 99),
+        'weight': round(random.uniform(40, 150), 1),
+        'height': round(random.uniform(140, 200), 1),
+        'health_history': "stress test",
+    }
+
+def login(client):
+    """Registers a throwaway Group H user and returns the auth header."""
+    username = f"stress_{os.urandom(4).hex()}"
+    client.post('/register', json={'username': username, 'password': 'stress', 'occupation': 'doctor'})
+    response = client.post('/login', json={'username': username, 'password': 'stress'})
+    return {'Authorization': f"Bearer {response.json['token']}"}
+
+def writer(headers, requests, bulk_size, results):
+    client = app.test_client()
+    inserted = failed = 0
+    for i in range(requests):
+        # every other request is a small bulk insert
+        if bulk_size and i % 2:
+            response = client.post('/add_data/bulk', headers=headers,
+                                   json=[make_patient(i) for _ in range(bulk_size)])
+            ok = response.status_code == 201
+            inserted += response.json.get('inserted', 0) if ok else 0
+        else:
+            response = client.post('/add_data', headers=headers, json=make_patient(i))
+            ok = response.status_code == 201
+            inserted += 1 if ok else 0
+        if not ok:
+            failed += 1
+            print(f"request failed: {response.status_code} {response.json}")
+    results.append((inserted, failed))
+
+def run_process(threads, requests, bulk_size, queue=None):
+    headers = login(app.test_client())
+    results = []
+    workers = [
+        threading.Thread(target=writer, args=(headers, requests, bulk_size, results))
+        for _ in range(threads)
+    ]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+
+    totals = (sum(r[0] for r in results), sum(r[1] for r in results))
+    if queue is not None:
+        queue.put(totals)
+    return totals
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=25, help="requests per thread")
+    parser.add_argument('--bulk-size', type=int, default=5, help="rows per bulk request, 0 for none")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.processes > 1:
+        queue = multiprocessing.Queue()
+        procs = [
+            multiprocessing.Process(target=run_process, args=(args.threads, args.requests, args.bulk_size, queue))
+            for _ in range(args.processes)
+        ]
+        for p in procs:
+            p.start()
+        totals = [queue.get() for _ in procs]
+        for p in procs:
+            p.join()
+    else:
+        totals = [run_process(args.threads, args.requests, args.bulk_size)]
+    elapsed = time.perf_counter() - start
+
+    inserted = sum(t[0] for t in totals)
+    failed = sum(t[1] for t in totals)
+    print(f"{inserted} rows inserted by {args.processes * args.threads} writers in {elapsed:.1f}s "
+          f"({inserted / elapsed:.0f} rows/s), {failed} failed requests")
+
+    print("Re-verifying the hash chain...")
+    problems = chain.verify_segments()
+    for start_id, end_id, problem in problems:
+        print(f"FAILED: segment ({start_id}, {end_id}]: {problem}")
+    if problems or failed:
+        sys.exit(1)
+    print("Chain is intact.")
+
+if __name__ == "__main__":
+    main()
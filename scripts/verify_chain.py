@@ -0,0 +1,36 @@
+import sys
+import os
+import argparse
+
+# adds the root folder of the project to the
+# list of places Python looks for code.
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(project_root)
+
+from app import app, chain, merkle
+
+# Re-verifies the whole patients table one checkpoint segment at a time.
+# Exits with status 1 if any segment fails, so it can run from cron.
+#
+#   python scripts/verify_chain.py
+#   python scripts/verify_chain.py --merkle --workers 4   # Merkle subtrees, in parallel
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--merkle', action='store_true', help="verify against the signed Merkle root instead")
+    parser.add_argument('--workers', type=int, default=merkle.MERKLE_VERIFY_WORKERS)
+    parser.add_argument('--chunk', type=int, default=merkle.MERKLE_VERIFY_CHUNK, help="rows per subtree job")
+    args = parser.parse_args()
+
+    with app.app_context():
+        if args.merkle:
+            print("Re-verifying Merkle subtrees...")
+            problems = merkle.verify_tree(args.workers, args.chunk)
+        else:
+            print("Re-verifying hash chain segments...")
+            problems = chain.verify_segments()
+        for start_id, end_id, problem in problems:
+            print(f"FAILED: segment ({start_id}, {end_id}]: {problem}")
+        if problems:
+            sys.exit(1)
+        print("All segments verified.")
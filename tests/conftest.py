@@ -0,0 +1,121 @@
+import os
+import sys
+import sqlite3
+import tempfile
+
+import pytest
+
+# The app reads config.py from sys.path at import time and talks to MySQL, so
+# the tests write a throwaway config and point the app at the SQLite stand-in
+# (scripts/sqlite_standin.py) before anything imports it.
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+_tmp_dir = tempfile.mkdtemp(prefix='dbaas-tests-')
+DB_PATH = os.path.join(_tmp_dir, 'standin.db')
+
+CONFIG = """
+DB_USER = 'test'
+DB_PASSWORD = 'test'
+DB_HOST = 'localhost'
+DB_PORT = 3306
+DB_NAME = 'test'
+JWT_SECRET_KEY = 'jwt-secret-for-the-test-suite-only-0123456789'
+ENCRYPTION_KEY = b'0' * 32
+HMAC_KEY = b'1' * 32
+OPE_KEY = b'2' * 32
+# key 2 is only there for the rotation tests, new rows stay on key 1
+KEYRING = {2: {'ENCRYPTION_KEY': b'a' * 32, 'HMAC_KEY': b'b' * 32, 'OPE_KEY': b'c' * 32}}
+CURRENT_KEY_ID = 1
+BCRYPT_WORKERS = 0
+BCRYPT_LOG_ROUNDS = 4
+CHECKPOINT_INTERVAL = 4
+MERKLE_VERIFY_CHUNK = 4
+"""
+
+with open(os.path.join(_tmp_dir, 'config.py'), 'w') as f:
+    f.write(CONFIG)
+
+sys.path[:0] = [_tmp_dir, os.path.join(project_root, 'scripts'), project_root]
+
+import sqlite_standin
+sqlite_standin.install(DB_PATH)
+
+from app import app as flask_app
+from app import result_cache, snapshot, weight_index
+
+# tables emptied before every test, users are kept so the login works across tests
+DATA_TABLES = ('patients', 'chain_tail', 'chain_checkpoints', 'merkle_nodes', 'merkle_state', 'key_rotation')
+
+
+def db():
+    """Opens the stand-in database directly, behind the app's back (for tampering)."""
+    return sqlite3.connect(DB_PATH)
+
+
+@pytest.fixture(autouse=True)
+def empty_tables():
+    cnx = db()
+    try:
+        tables = {row[0] for row in cnx.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        for table in DATA_TABLES:
+            if table in tables:
+                cnx.execute(f"DELETE FROM {table}")
+        # patient ids are the leaf positions of the Merkle tree, so they start at 1 again
+        cnx.execute("DELETE FROM sqlite_sequence WHERE name = 'patients'")
+        cnx.commit()
+    finally:
+        cnx.close()
+
+    result_cache.result_cache.clear()
+    weight_index.weight_index.clear()
+    snapshot._current = None
+    yield
+
+
+def fresh_reads():
+    """Drops everything the app remembers about verified rows, so the next request reads the table again."""
+    result_cache.result_cache.clear()
+    weight_index.weight_index.clear()
+    snapshot._current = None
+
+
+@pytest.fixture(scope='session')
+def client():
+    return flask_app.test_client()
+
+
+@pytest.fixture(scope='session')
+def headers(client):
+    client.post('/register', json={'username': 'doc', 'password': 'pw', 'occupation': 'doctor'})
+    response = client.post('/login', json={'username': 'doc', 'password': 'pw'})
+    assert response.status_code == 200, response.json
+    return {'Authorization': 'Bearer ' + response.json['token']}
+
+
+@pytest.fixture(scope='session')
+def researcher_headers(client):
+    client.post('/register', json={'username': 'res', 'password': 'pw', 'occupation': 'researcher'})
+    response = client.post('/login', json={'username': 'res', 'password': 'pw'})
+    assert response.status_code == 200, response.json
+    return {'Authorization': 'Bearer ' + response.json['token']}
+
+
+def patient(i):
+    return {
+        'first_name': f'Ann{i}',
+        'last_name': 'Test',
+        'gender': i % 2 == 0,
+        'age': 20 + i,
+        'weight': 50.5 + i,
+        'height': 170,
+        'health_history': f'history {i}',
+    }
+
+
+@pytest.fixture
+def patients(client, headers):
+    """Adds 10 patients (ids 1..10, weight 50.5 + id - 1) through the API."""
+    for i in range(10):
+        response = client.post('/add_data', headers=headers, json=patient(i))
+        assert response.status_code == 201, response.json
+    return [patient(i) for i in range(10)]
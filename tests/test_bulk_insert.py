@@ -0,0 +1,43 @@
+import json
+
+from app import chain, routes
+
+from conftest import patient
+
+
+def test_json_array(client, headers):
+    items = [patient(i) for i in range(4)]
+    items[2] = dict(items[2], weight='heavy')
+    del items[3]['age']
+
+    response = client.post('/add_data/bulk', headers=headers, json=items)
+    assert response.status_code == 201
+    assert response.json['inserted'] == 2
+    assert response.json['patient_ids'] == [1, 2]
+    assert [error['index'] for error in response.json['errors']] == [2, 3]
+
+    names = [row['first_name'] for row in client.get('/query_all', headers=headers).json]
+    assert names == ['Ann0', 'Ann1']
+    assert chain.verify_segments() == []
+
+
+def test_ndjson(client, headers, patients):
+    body = "\n".join(json.dumps(patient(i)) for i in range(10, 15)) + "\n{not json\n"
+    response = client.post('/add_data/bulk', headers=dict(headers, **{'Content-Type': 'application/x-ndjson'}),
+                           data=body)
+    assert response.status_code == 201
+    # one chain extension after the rows that were there
+    assert response.json['patient_ids'] == [11, 12, 13, 14, 15]
+    assert [error['index'] for error in response.json['errors']] == [5]
+    assert len(client.get('/query_all', headers=headers).json) == 15
+    assert chain.verify_segments() == []
+
+
+def test_refused_requests(client, headers, researcher_headers, monkeypatch):
+    assert client.post('/add_data/bulk', headers=researcher_headers, json=[patient(0)]).status_code == 403
+    assert client.post('/add_data/bulk', headers=headers, json={'first_name': 'x'}).status_code == 400
+    assert client.post('/add_data/bulk', headers=headers, json=[{'first_name': 'x'}]).status_code == 400
+
+    monkeypatch.setattr(routes, 'BULK_MAX_ROWS', 2)
+    assert client.post('/add_data/bulk', headers=headers, json=[patient(i) for i in range(3)]).status_code == 413
+    assert client.get('/query_all', headers=headers).json == []
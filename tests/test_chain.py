@@ -0,0 +1,120 @@
+import pytest
+
+from app import chain, database, merkle, rotation
+
+from conftest import db, fresh_reads, patient
+
+
+def query_all(client, headers):
+    fresh_reads()
+    return client.get('/query_all', headers=headers)
+
+
+def test_clean_table_verifies(client, headers, patients):
+    response = query_all(client, headers)
+    assert response.status_code == 200
+    assert [row['patient_id'] for row in response.json] == list(range(1, 11))
+    assert chain.verify_segments() == []
+    assert merkle.verify_tree() == []
+
+
+def test_deleted_middle_row_fails(client, headers, patients):
+    cnx = db()
+    cnx.execute("DELETE FROM patients WHERE patient_id = 5")
+    cnx.commit()
+    cnx.close()
+
+    assert query_all(client, headers).status_code == 500
+    assert chain.verify_segments() != []
+    assert merkle.verify_tree() != []
+
+
+def test_deleted_tail_row_fails(client, headers, patients):
+    cnx = db()
+    cnx.execute("DELETE FROM patients WHERE patient_id = 10")
+    cnx.commit()
+    cnx.close()
+
+    response = query_all(client, headers)
+    assert response.status_code == 500
+    assert response.json['error'] == "Query Failed: Data is missing or out of order."
+
+    fresh_reads()
+    assert client.get('/query_by_weight?min=50&max=70', headers=headers).status_code == 500
+    fresh_reads()
+    assert client.get('/query_all?limit=100', headers=headers).status_code == 500
+    assert merkle.verify_tree() != []
+
+
+def test_tampered_row_fails(client, headers, patients):
+    cnx = db()
+    cnx.execute("UPDATE patients SET height = 199 WHERE patient_id = 3")
+    cnx.commit()
+    cnx.close()
+
+    assert query_all(client, headers).status_code == 500
+    assert chain.verify_segments() != []
+    assert merkle.verify_tree() != []
+
+
+def gapped_table(client, headers):
+    """Gives the table two unused patient_ids (11, 12), like rolled back inserts before chain_tail, and no tree."""
+    cnx = db()
+    cnx.execute("DELETE FROM merkle_state")
+    cnx.execute("DELETE FROM merkle_nodes")
+    cnx.execute("UPDATE chain_tail SET patient_id = patient_id + 2")
+    cnx.commit()
+    cnx.close()
+    for i in range(10, 13):
+        assert client.post('/add_data', headers=headers, json=patient(i)).status_code == 201
+
+
+def test_id_gaps_are_not_tampering(client, headers, patients):
+    gapped_table(client, headers)
+    assert chain.verify_segments() == []
+
+    # a tree needs one row per patient_id
+    with database.db_connection() as cnx:
+        with pytest.raises(chain.IdGaps):
+            chain.rebuild_chain(cnx, (), None)
+
+    # rewriting columns follows the ids that exist (here: a key switch)
+    rotation.ensure_table()
+    with database.db_connection() as cnx:
+        rotation.stage(cnx, key_id=2)
+        assert rotation.switch(cnx, key_id=2) == 13
+    fresh_reads()
+    assert [row['patient_id'] for row in client.get('/query_all', headers=headers).json] == \
+        list(range(1, 11)) + [13, 14, 15]
+    assert chain.verify_segments() == []
+
+
+def test_deleted_row_next_to_a_gap_fails(client, headers, patients):
+    gapped_table(client, headers)
+    cnx = db()
+    cnx.execute("DELETE FROM patients WHERE patient_id = 14")
+    cnx.commit()
+    cnx.close()
+
+    rotation.ensure_table()
+    with database.db_connection() as cnx:
+        rotation.stage(cnx, key_id=2)
+        with pytest.raises(chain.ChainBroken):
+            rotation.switch(cnx, key_id=2)
+
+
+def test_tree_shape_matches_recomputed_root():
+    leaves = [bytes([i]) * 32 for i in range(13)]
+    frontier = merkle.Frontier()
+    nodes = {}
+    for leaf in leaves:
+        for level, idx, node_hash in frontier.append(leaf):
+            nodes[(level, idx)] = node_hash
+
+    root = merkle.subtree_hash(0, len(leaves), lambda level, i: leaves[i] if level == 0 else None)
+    assert frontier.root() == root
+
+    # a range of leaves plus its proof nodes gives the same root
+    keys = merkle.proof_nodes(len(leaves), 3, 9)
+    assert merkle.range_root(len(leaves), 3, leaves[3:9], {key: nodes[key] for key in keys}) == root
+    assert merkle.range_root(len(leaves), 3, [b'x' * 32] + leaves[4:9], {key: nodes[key] for key in keys}) != root
@@ -0,0 +1,46 @@
+from app import crypto
+
+
+def test_cursor_round_trip():
+    token = crypto.sign_cursor(7, b'\x01' * 32)
+    assert crypto.open_cursor(token) == (7, b'\x01' * 32)
+
+
+def test_tampered_cursor_is_refused():
+    token = crypto.sign_cursor(7, b'\x01' * 32)
+    patient_id, chain_hex, signature = token.split('.')
+
+    assert crypto.open_cursor(f"8.{chain_hex}.{signature}") is None
+    assert crypto.open_cursor(f"{patient_id}.{'02' * 32}.{signature}") is None
+    assert crypto.open_cursor(f"{patient_id}.{chain_hex}.{'0' * len(signature)}") is None
+    assert crypto.open_cursor('not-a-cursor') is None
+
+
+def test_pages_cover_the_table(client, headers, patients):
+    seen = []
+    response = client.get('/query_all?limit=3', headers=headers)
+    while True:
+        assert response.status_code == 200
+        seen += [row['patient_id'] for row in response.json['rows']]
+        if not response.json['has_more']:
+            break
+        response = client.get('/query_all?limit=3&cursor=' + response.json['next_cursor'], headers=headers)
+    assert seen == list(range(1, 11))
+
+
+def test_tampered_cursor_on_the_listing(client, headers, patients):
+    token = client.get('/query_all?limit=3', headers=headers).json['next_cursor']
+    patient_id, chain_hex, signature = token.split('.')
+    forged = f"{int(patient_id) + 2}.{chain_hex}.{signature}"
+
+    response = client.get('/query_all?limit=3&cursor=' + forged, headers=headers)
+    assert response.status_code == 400
+
+
+def test_after_id_bounds(client, headers, patients):
+    assert client.get('/query_all?limit=3&after_id=-1', headers=headers).status_code == 400
+
+    response = client.get('/query_all?limit=3&after_id=10', headers=headers)
+    assert response.status_code == 200
+    assert response.json['rows'] == []
+    assert response.json['has_more'] is False
@@ -0,0 +1,34 @@
+from app import routes
+
+LOCAL = {'REMOTE_ADDR': '127.0.0.1'}
+REMOTE = {'REMOTE_ADDR': '203.0.113.7'}
+
+
+def test_local_by_default(client, headers):
+    assert routes.METRICS_ACCESS == 'local'
+    response = client.get('/metrics', environ_base=LOCAL)
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '::1'}).status_code == 200
+    assert client.get('/metrics', environ_base=REMOTE).status_code == 403
+    # a token doesn't open it up to other hosts
+    assert client.get('/metrics', headers=headers, environ_base=REMOTE).status_code == 403
+
+
+def test_token(client, headers, monkeypatch):
+    monkeypatch.setattr(routes, 'METRICS_ACCESS', 'token')
+    assert client.get('/metrics', environ_base=LOCAL).status_code == 401
+    assert client.get('/metrics', environ_base=REMOTE).status_code == 401
+    assert client.get('/metrics', headers=headers, environ_base=REMOTE).status_code == 200
+
+
+def test_public(client, monkeypatch):
+    monkeypatch.setattr(routes, 'METRICS_ACCESS', 'public')
+    assert client.get('/metrics', environ_base=REMOTE).status_code == 200
+
+
+def test_requests_are_counted(client, headers, patients):
+    client.get('/query_all', headers=headers)
+    assert 'get_all_patients' in client.get('/metrics?format=json', environ_base=LOCAL).json['endpoints']
+    text = client.get('/metrics', environ_base=LOCAL).get_data(as_text=True)
+    assert 'dbaas_request_duration_seconds_count{endpoint="get_all_patients"}' in text
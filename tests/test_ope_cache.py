@@ -0,0 +1,54 @@
+import pytest
+from cryptography.exceptions import InvalidTag
+
+from app import crypto
+
+
+def test_cached_values_match_pyope():
+    ciphertext = crypto.ope_encrypt(72.25)
+    assert ciphertext == crypto.ope_cipher.encrypt(7225)
+    assert crypto.ope_cache.get_cipher(7225) == ciphertext
+    assert crypto.ope_decrypt(ciphertext) == 72.25
+
+
+def test_repeated_values_are_hits():
+    cache = crypto.OPECache(max_size=10)
+    cache.put(1, 100)
+    assert cache.get_cipher(1) == 100
+    assert cache.get_plain(100) == 1
+    assert cache.get_cipher(2) is None
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses']) == (2, 1)
+
+
+def test_least_recently_used_is_evicted():
+    cache = crypto.OPECache(max_size=2)
+    cache.put(1, 100)
+    cache.put(2, 200)
+    cache.get_cipher(1)
+    cache.put(3, 300)
+    assert cache.get_cipher(2) is None and cache.get_plain(200) is None
+    assert cache.get_cipher(1) == 100 and cache.get_cipher(3) == 300
+
+
+def test_saved_cache_loads_back(tmp_path):
+    cache = crypto.OPECache(max_size=10)
+    cache.put(1, 100)
+    cache.put(2, 200)
+    path = str(tmp_path / 'ope.cache')
+    cache.save(path)
+
+    loaded = crypto.OPECache(max_size=10)
+    assert loaded.load(path) == 2
+    assert loaded.items() == cache.items()
+
+
+def test_cache_from_another_ope_key_is_refused(tmp_path, monkeypatch):
+    cache = crypto.OPECache(max_size=10)
+    cache.put(1, 100)
+    path = str(tmp_path / 'ope.cache')
+    cache.save(path)
+
+    monkeypatch.setattr(crypto, '_OPE_KEY_FINGERPRINT', b'0' * 16)
+    with pytest.raises(InvalidTag):
+        crypto.OPECache(max_size=10).load(path)
@@ -0,0 +1,54 @@
+import pytest
+from cryptography.exceptions import InvalidTag
+
+from app import crypto
+
+
+@pytest.fixture(scope='module')
+def table():
+    # 50.00 to 50.99, enough to check the lookups
+    return crypto.build_ope_table(5000, 5099)
+
+
+def test_table_matches_pyope(table):
+    assert len(table) == 100
+    for data_int in (5000, 5042, 5099):
+        ciphertext = table.encrypt(data_int)
+        assert ciphertext == crypto.ope_cipher.encrypt(data_int)
+        assert table.decrypt(ciphertext) == data_int
+    assert table.encrypt(4999) is None and table.encrypt(5100) is None
+    assert table.decrypt(table.encrypt(5042) + 1) is None
+
+
+def test_ope_encrypt_uses_the_table(table, monkeypatch):
+    monkeypatch.setattr(crypto, '_ope_table', table)
+    monkeypatch.setattr(crypto, '_ope_table_loaded', True)
+    monkeypatch.setattr(crypto.ope_cipher, 'encrypt', lambda data_int: pytest.fail("pyope was called"))
+    ciphertext = crypto.ope_encrypt(50.42)
+    assert ciphertext == table.encrypt(5042)
+    assert crypto.ope_decrypt(ciphertext) == 50.42
+
+
+def test_saved_table_loads_back(table, tmp_path):
+    path = str(tmp_path / 'ope.tbl')
+    table.save(path)
+    loaded = crypto.OPETable.load(path)
+    assert (loaded.start, list(loaded.ciphertexts)) == (table.start, list(table.ciphertexts))
+
+
+def test_damaged_or_foreign_table_is_refused(table, tmp_path, monkeypatch):
+    path = str(tmp_path / 'ope.tbl')
+    table.save(path)
+    with open(path, 'rb') as f:
+        blob = bytearray(f.read())
+
+    blob[-1] ^= 1
+    damaged = str(tmp_path / 'damaged.tbl')
+    with open(damaged, 'wb') as f:
+        f.write(blob)
+    with pytest.raises(InvalidTag):
+        crypto.OPETable.load(damaged)
+
+    monkeypatch.setattr(crypto, '_OPE_KEY_FINGERPRINT', b'0' * 16)
+    with pytest.raises(InvalidTag):
+        crypto.OPETable.load(path)
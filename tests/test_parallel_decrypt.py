@@ -0,0 +1,50 @@
+import pytest
+
+from app import crypto, database
+
+from conftest import db
+
+
+def raw_rows():
+    with database.db_connection() as cnx:
+        cursor = cnx.cursor(dictionary=True)
+        cursor.execute("SELECT * FROM patients ORDER BY patient_id ASC")
+        return cursor.fetchall()
+
+
+@pytest.fixture
+def workers(monkeypatch):
+    monkeypatch.setattr(crypto, 'DECRYPT_WORKERS', 2)
+    monkeypatch.setattr(crypto, 'DECRYPT_CHUNK_SIZE', 3)
+    yield
+    if crypto._decrypt_executor is not None:
+        crypto._decrypt_executor.shutdown()
+        crypto._decrypt_executor = None
+
+
+def test_same_result_as_serial(patients, workers):
+    rows = raw_rows()
+    serial = crypto.process_rows(rows, verify_chain=True, parallel=False)
+    parallel = crypto.process_rows(rows, verify_chain=True, parallel=True)
+    assert crypto._decrypt_executor is not None
+    assert parallel == serial
+    assert [row['patient_id'] for row in parallel.rows] == list(range(1, 11))
+
+
+def test_tampered_row_fails_on_the_workers(patients, workers):
+    cnx = db()
+    cnx.execute("UPDATE patients SET height = 199 WHERE patient_id = 5")
+    cnx.commit()
+    cnx.close()
+
+    batch = crypto.process_rows(raw_rows(), verify_chain=True, parallel=True)
+    assert [patient_id for patient_id, _ in batch.failures] == [5]
+    assert batch.chain_broken_at == 6
+
+
+def test_large_results_go_parallel(patients, workers, monkeypatch):
+    monkeypatch.setattr(crypto, 'DECRYPT_PARALLEL_MIN_ROWS', 10)
+    crypto.process_rows(raw_rows()[:9])
+    assert crypto._decrypt_executor is None
+    crypto.process_rows(raw_rows())
+    assert crypto._decrypt_executor is not None
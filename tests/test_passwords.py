@@ -0,0 +1,61 @@
+import threading
+
+import pytest
+
+from app import passwords
+
+
+def test_hash_and_check_on_the_pool():
+    hasher = passwords.PasswordHasher(workers=1, max_queue=1)
+    try:
+        password_hash = hasher.hash_password('secret')
+        assert hasher.check_password(password_hash, 'secret')
+        assert not hasher.check_password(password_hash, 'wrong')
+        assert hasher.stats()['completed'] == 3
+    finally:
+        hasher._executor.shutdown()
+
+
+def test_broken_pool_is_replaced():
+    hasher = passwords.PasswordHasher(workers=1, max_queue=1)
+    executor = hasher._get_executor()
+    hasher.hash_password('warm up')
+    for process in list(executor._processes.values()):
+        process.kill()
+        process.join()
+
+    # this one is hashed on the request thread, the next one gets a new pool
+    assert hasher.check_password(hasher.hash_password('secret'), 'secret')
+    assert hasher._executor is not executor
+    if hasher._executor is not None:
+        hasher._executor.shutdown()
+
+
+def test_full_queue_is_overloaded(monkeypatch):
+    hasher = passwords.PasswordHasher(workers=0, max_queue=1)
+    started, release = threading.Event(), threading.Event()
+
+    def slow_hash(password):
+        started.set()
+        release.wait(5)
+        return 'hash'
+    monkeypatch.setattr(passwords, '_hash', slow_hash)
+
+    waiting = threading.Thread(target=hasher.hash_password, args=('first',))
+    waiting.start()
+    started.wait(5)
+    with pytest.raises(passwords.Overloaded):
+        hasher.hash_password('second')
+    release.set()
+    waiting.join()
+    assert hasher.stats()['rejected'] == 1
+    assert hasher.hash_password('third') == 'hash'
+
+
+def test_routes_answer_503(client, headers, monkeypatch):
+    monkeypatch.setattr(passwords, 'hasher', passwords.PasswordHasher(workers=0, max_queue=0))
+    for path, body in (('/login', {'username': 'doc', 'password': 'pw'}),
+                       ('/register', {'username': 'busy', 'password': 'pw', 'occupation': 'doctor'})):
+        response = client.post(path, json=body)
+        assert response.status_code == 503, path
+        assert response.headers['Retry-After'] == str(passwords.BCRYPT_RETRY_AFTER)
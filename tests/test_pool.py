@@ -0,0 +1,93 @@
+import threading
+import time
+
+import mysql.connector
+import pytest
+
+from app import database
+
+
+def test_checkout_and_reuse():
+    pool = database.ConnectionPool(size=2, timeout=1)
+    cnx = pool.acquire()
+    assert pool.stats()['in_use'] == 1
+    pool.release(cnx)
+
+    # the idle connection is handed out again instead of a new one
+    assert pool.acquire() is cnx
+    stats = pool.stats()
+    assert (stats['open'], stats['checkouts'], stats['in_use']) == (1, 2, 1)
+    pool.release(cnx)
+    pool.close_all()
+    assert pool.stats()['open'] == 0
+
+
+def test_open_transaction_is_rolled_back():
+    pool = database.ConnectionPool(size=1, timeout=1)
+    cnx = pool.acquire()
+    cnx.start_transaction()
+    pool.release(cnx)
+    assert not pool.acquire().in_transaction
+
+
+def test_timeout_when_all_connections_are_in_use():
+    pool = database.ConnectionPool(size=1, timeout=0.2)
+    pool.acquire()
+    with pytest.raises(mysql.connector.errors.PoolError):
+        pool.acquire()
+    stats = pool.stats()
+    assert (stats['waits'], stats['timeouts']) == (1, 1)
+
+
+def test_waiter_gets_the_connection_that_is_released():
+    pool = database.ConnectionPool(size=1, timeout=5)
+    cnx = pool.acquire()
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(pool.acquire()))
+    waiter.start()
+    time.sleep(0.1)
+    pool.release(cnx)
+    waiter.join(2)
+    assert got == [cnx]
+
+
+def test_discarded_connection_frees_the_slot_for_a_waiter():
+    pool = database.ConnectionPool(size=1, timeout=5)
+    cnx = pool.acquire()
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(pool.acquire()))
+    waiter.start()
+    time.sleep(0.1)
+
+    # like a stream abandoned part way: the connection can't be reused
+    cnx.unread_result = True
+    start = time.monotonic()
+    pool.release(cnx)
+    waiter.join(2)
+
+    assert time.monotonic() - start < 1
+    assert len(got) == 1 and got[0] is not cnx
+    assert not cnx.is_connected()
+    assert pool.stats()['open'] == 1
+
+
+def test_failed_connect_frees_the_slot(monkeypatch):
+    pool = database.ConnectionPool(size=1, timeout=0.2)
+
+    def refuse():
+        raise mysql.connector.Error(msg="refused")
+    monkeypatch.setattr(pool, '_connect', refuse)
+    with pytest.raises(mysql.connector.Error):
+        pool.acquire()
+    monkeypatch.undo()
+
+    assert pool.stats()['open'] == 0
+    pool.release(pool.acquire())
+
+
+def test_db_connection_hands_the_connection_back():
+    before = database.pool_stats()['in_use']
+    with database.db_connection() as cnx:
+        assert cnx is not None
+        assert database.pool_stats()['in_use'] == before + 1
+    assert database.pool_stats()['in_use'] == before
@@ -0,0 +1,52 @@
+from app import auth
+
+from conftest import db
+
+
+def test_hit_after_the_first_lookup(client, headers, patients):
+    auth.principal_cache.clear()
+    before = auth.principal_cache.stats()
+    client.get('/query_all', headers=headers)
+    client.get('/query_all', headers=headers)
+    after = auth.principal_cache.stats()
+    assert after['misses'] - before['misses'] == 1
+    assert after['hits'] - before['hits'] == 1
+
+
+def test_entries_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(auth.time, 'monotonic', lambda: now[0])
+    cache = auth.PrincipalCache(max_size=10, ttl=300)
+    cache.put(1, {'user_id': 1})
+    now[0] += 299
+    assert cache.get(1) == {'user_id': 1}
+    now[0] += 2
+    assert cache.get(1) is None
+    assert cache.stats()['size'] == 0
+
+
+def test_least_recently_used_is_evicted():
+    cache = auth.PrincipalCache(max_size=2, ttl=300)
+    cache.put(1, 'one')
+    cache.put(2, 'two')
+    cache.get(1)
+    cache.put(3, 'three')
+    assert cache.get(2) is None
+    assert (cache.get(1), cache.get(3)) == ('one', 'three')
+
+
+def test_register_drops_a_stale_entry(client, headers):
+    cnx = db()
+    next_id = (cnx.execute("SELECT MAX(user_id) FROM users").fetchone()[0] or 0) + 1
+    cnx.close()
+    # left over from a user with that id that is gone now
+    auth.principal_cache.put(next_id, {'user_id': next_id, 'username': 'old', 'user_group': 'H'})
+
+    response = client.post('/register', json={'username': f'researcher{next_id}', 'password': 'pw',
+                                               'occupation': 'researcher'})
+    assert response.status_code == 201, response.json
+    assert auth.principal_cache.get(next_id) is None
+
+    token = client.post('/login', json={'username': f'researcher{next_id}', 'password': 'pw'}).json['token']
+    client.get('/query_all', headers={'Authorization': 'Bearer ' + token})
+    assert auth.principal_cache.get(next_id)['user_group'] == 'R'
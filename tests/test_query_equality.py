@@ -0,0 +1,37 @@
+from conftest import db, fresh_reads
+
+
+def ids(response):
+    assert response.status_code == 200, response.json
+    return sorted(row['patient_id'] for row in response.json)
+
+
+def test_gender(client, headers, patients):
+    # even indexes (odd ids) are male
+    assert ids(client.get('/query?gender=male', headers=headers)) == [1, 3, 5, 7, 9]
+    assert ids(client.get('/query?gender=Female&age_min=25', headers=headers)) == [6, 8, 10]
+    assert client.get('/query?gender=other', headers=headers).status_code == 400
+
+
+def test_names(client, headers, patients):
+    assert ids(client.get('/query?first_name=ann4', headers=headers)) == [5]
+    assert ids(client.get('/query?first_name=%20ANN4%20&last_name=test', headers=headers)) == [5]
+    assert ids(client.get('/query?first_name=nobody', headers=headers)) == []
+
+
+def test_researchers_cant_search_names(client, researcher_headers, patients):
+    assert client.get('/query?first_name=ann4', headers=researcher_headers).status_code == 403
+    rows = client.get('/query?gender=male', headers=researcher_headers).json
+    assert len(rows) == 5
+    assert not any('first_name' in row or 'last_name' in row for row in rows)
+
+
+def test_copied_blind_index_is_caught(client, headers, patients):
+    cnx = db()
+    cnx.execute("UPDATE patients SET first_name_bidx = (SELECT first_name_bidx FROM patients WHERE patient_id = 5) "
+                "WHERE patient_id = 2")
+    cnx.commit()
+    cnx.close()
+
+    fresh_reads()
+    assert ids(client.get('/query?first_name=ann4', headers=headers)) == [5]
@@ -0,0 +1,37 @@
+from conftest import db, fresh_reads
+
+
+def ids(response):
+    assert response.status_code == 200, response.json
+    return sorted(row['patient_id'] for row in response.json)
+
+
+def test_age_range(client, headers, patients):
+    # ages are 20 + id - 1
+    assert ids(client.get('/query?age_min=23&age_max=25', headers=headers)) == [4, 5, 6]
+    assert ids(client.get('/query?age_min=28', headers=headers)) == [9, 10]
+    assert ids(client.get('/query?age_max=20', headers=headers)) == [1]
+    assert ids(client.get('/query?age_min=30&age_max=20', headers=headers)) == []
+
+
+def test_combined_with_weight(client, headers, patients):
+    # weights are 50.5 + id - 1
+    assert ids(client.get('/query?age_min=22&weight_max=54', headers=headers)) == [3, 4]
+    assert ids(client.get('/query?weight_min=58.5', headers=headers)) == [9, 10]
+
+
+def test_bad_bounds(client, headers):
+    assert client.get('/query', headers=headers).status_code == 400
+    for query in ('age_min=abc', 'age_max=1.5', 'weight_min=nan', 'weight_max=inf'):
+        assert client.get('/query?' + query, headers=headers).status_code == 400, query
+
+
+def test_moved_age_index_is_caught(client, headers, patients):
+    # give row 1 (age 20) the age_ope of row 5 (age 24), it must still not match
+    cnx = db()
+    cnx.execute("UPDATE patients SET age_ope = (SELECT age_ope FROM patients WHERE patient_id = 5) WHERE patient_id = 1")
+    cnx.commit()
+    cnx.close()
+
+    fresh_reads()
+    assert ids(client.get('/query?age_min=24&age_max=24', headers=headers)) == [5]
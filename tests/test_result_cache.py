@@ -0,0 +1,34 @@
+import threading
+
+from app import result_cache
+
+from conftest import patient
+
+
+def test_hit_extend_miss(client, headers, patients):
+    cache = result_cache.result_cache
+    before = cache.stats()
+
+    assert len(client.get('/query_all', headers=headers).json) == 10
+    assert len(client.get('/query_all', headers=headers).json) == 10
+    assert client.post('/add_data', headers=headers, json=patient(10)).status_code == 201
+    assert len(client.get('/query_all', headers=headers).json) == 11
+
+    after = cache.stats()
+    assert after['misses'] - before['misses'] == 1
+    assert after['hits'] - before['hits'] == 1
+    assert after['extends'] - before['extends'] == 1
+
+
+def test_counters_under_concurrency():
+    cache = result_cache.ResultCache(max_rows=10)
+
+    def count():
+        for _ in range(10000):
+            cache.count('hits')
+    threads = [threading.Thread(target=count) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert cache.stats()['hits'] == 80000
@@ -0,0 +1,64 @@
+import pytest
+
+from app import chain, database, merkle, rotation
+
+from conftest import db, fresh_reads
+
+
+def rotate_to_key_2():
+    rotation.ensure_table()
+    with database.db_connection() as cnx:
+        rotation.stage(cnx, key_id=2, batch_size=3)
+        return rotation.switch(cnx, key_id=2, batch_size=3)
+
+
+def test_switch_keeps_the_data(client, headers, patients):
+    before = client.get('/query_all', headers=headers).json
+    cursor = client.get('/query_all?limit=3', headers=headers).json['next_cursor']
+
+    assert rotate_to_key_2() == 10
+    with database.db_connection() as cnx:
+        assert rotation.key_counts(cnx) == {2: 10}
+
+    fresh_reads()
+    assert client.get('/query_all', headers=headers).json == before
+    assert sorted(row['patient_id'] for row in client.get('/query_by_weight?min=53&max=57', headers=headers).json) == [4, 5, 6, 7]
+    # a cursor from before the switch carries on where it was
+    response = client.get('/query_all?limit=3&cursor=' + cursor, headers=headers)
+    assert response.status_code == 200
+    assert [row['patient_id'] for row in response.json['rows']] == [4, 5, 6]
+    assert response.json['anchor'] == 'checkpoint'
+    response = client.get('/query_all?limit=3&cursor=' + response.json['next_cursor'], headers=headers)
+    assert [row['patient_id'] for row in response.json['rows']] == [7, 8, 9]
+    assert response.json['anchor'] == 'cursor'
+
+    assert chain.verify_segments() == []
+    assert merkle.verify_tree() == []
+
+
+def test_old_cursor_still_catches_tampering(client, headers, patients):
+    cursor = client.get('/query_all?limit=3', headers=headers).json['next_cursor']
+    rotate_to_key_2()
+
+    cnx = db()
+    cnx.execute("UPDATE patients SET row_mac = ? WHERE patient_id = 4", (b"x" * 32,))
+    cnx.commit()
+    cnx.close()
+
+    fresh_reads()
+    assert client.get('/query_all?limit=3&cursor=' + cursor, headers=headers).status_code == 500
+
+
+def test_switch_refuses_a_tampered_table(client, headers, patients):
+    cnx = db()
+    cnx.execute("UPDATE patients SET height = 199 WHERE patient_id = 6")
+    cnx.commit()
+    cnx.close()
+
+    rotation.ensure_table()
+    with database.db_connection() as cnx:
+        with pytest.raises(chain.ChainBroken):
+            rotation.stage(cnx, key_id=2)
+            rotation.switch(cnx, key_id=2)
+        # nothing was switched
+        assert rotation.key_counts(cnx) == {1: 10}
@@ -0,0 +1,79 @@
+import pytest
+
+import populate_db
+import sqlite_standin
+from app import chain
+
+from conftest import db, fresh_reads, patient
+
+# 'patients' as the first release created it
+BASELINE_PATIENTS_TABLE = """
+CREATE TABLE IF NOT EXISTS patients (
+    patient_id INT AUTO_INCREMENT PRIMARY KEY,
+    first_name VARCHAR(100),
+    last_name VARCHAR(100),
+    gender VARBINARY(255),
+    gender_nonce VARBINARY(12),
+    age VARBINARY(255),
+    age_nonce VARBINARY(12),
+    weight BIGINT,
+    height FLOAT,
+    health_history TEXT,
+    row_mac VARBINARY(32),
+    chain_hash VARBINARY(32)
+)
+"""
+
+
+def recreate_patients(ddl):
+    cnx = db()
+    cnx.execute("DROP TABLE IF EXISTS patients")
+    for statement in sqlite_standin.sqlite_ddl(ddl):
+        cnx.execute(statement)
+    cnx.commit()
+    cnx.close()
+    chain._tables_ready = False
+
+
+def columns():
+    cnx = db()
+    names = {row[1] for row in cnx.execute("PRAGMA table_info(patients)")}
+    cnx.close()
+    return names
+
+
+@pytest.fixture
+def baseline_table():
+    recreate_patients(BASELINE_PATIENTS_TABLE)
+    yield
+    recreate_patients(populate_db.CREATE_PATIENTS_TABLE)
+
+
+def test_startup_adds_the_missing_columns(baseline_table):
+    assert 'key_id' not in columns()
+    chain.ensure_tables()
+    assert {column for column, _, _ in chain.PATIENT_UPGRADES} <= columns()
+
+    # running it again changes nothing
+    chain._tables_ready = False
+    chain.ensure_tables()
+
+
+def test_upgraded_table_serves_reads_and_writes(client, headers, baseline_table):
+    chain.ensure_tables()
+    for i in range(5):
+        response = client.post('/add_data', headers=headers, json=patient(i))
+        assert response.status_code == 201, response.json
+
+    # rows from before key versions have no key_id, they are key 1
+    cnx = db()
+    cnx.execute("UPDATE patients SET key_id = NULL")
+    cnx.commit()
+    cnx.close()
+
+    fresh_reads()
+    assert [row['patient_id'] for row in client.get('/query_all', headers=headers).json] == [1, 2, 3, 4, 5]
+    response = client.get('/query_by_weight?min=51&max=53', headers=headers)
+    assert response.status_code == 200
+    assert sorted(row['patient_id'] for row in response.json) == [2, 3]
+    assert [row['patient_id'] for row in client.get('/query?age_min=23', headers=headers).json] == [4, 5]
@@ -0,0 +1,71 @@
+import pytest
+
+from app import result_cache, snapshot
+
+from conftest import db
+
+
+@pytest.fixture
+def snapshot_file(tmp_path, monkeypatch):
+    path = str(tmp_path / 'snapshot.bin')
+    monkeypatch.setattr(snapshot, 'SNAPSHOT_FILE', path)
+    return path
+
+
+def test_verified_table_is_recorded(client, headers, patients):
+    client.get('/query_all', headers=headers)
+    assert len(snapshot._current) == 10
+    assert snapshot._current.values(3) == (True, 22, 52.5)
+    assert snapshot._current.values(11) is None
+
+
+def test_new_rows_top_it_up(client, headers, patients):
+    client.get('/query_all', headers=headers)
+    first = snapshot._current
+    client.post('/add_data', headers=headers, json=dict(patients[0], first_name='New'))
+    client.get('/query_all', headers=headers)
+    assert len(snapshot._current) == 11
+    assert snapshot._current is not first
+
+
+def test_saved_snapshot_loads_back(client, headers, patients, snapshot_file):
+    client.get('/query_all', headers=headers)
+    snapshot._current = None
+    snapshot.load_snapshot()
+    assert len(snapshot._current) == 10
+    assert snapshot._current.values(10) == (False, 29, 59.5)
+
+
+def test_snapshot_of_another_table_is_ignored(client, headers, patients, snapshot_file):
+    client.get('/query_all', headers=headers)
+    cnx = db()
+    cnx.execute("UPDATE patients SET chain_hash = ? WHERE patient_id = 10", (b'x' * 32,))
+    cnx.commit()
+    cnx.close()
+
+    snapshot._current = None
+    snapshot.load_snapshot()
+    assert snapshot._current is None
+
+
+def test_damaged_file_is_ignored(client, headers, patients, snapshot_file):
+    client.get('/query_all', headers=headers)
+    with open(snapshot_file, 'r+b') as f:
+        f.seek(-1, 2)
+        last = f.read(1)
+        f.seek(-1, 2)
+        f.write(bytes([last[0] ^ 1]))
+
+    snapshot._current = None
+    snapshot.load_snapshot()
+    assert snapshot._current is None
+
+
+def test_wrong_values_are_never_served(client, headers, patients):
+    expected = client.get('/query_all', headers=headers).json
+
+    # a snapshot that disagrees with the table only costs a real decryption
+    rows = [dict(row, weight=row['weight'] + 1) for row in expected]
+    snapshot._current = snapshot.Snapshot.from_rows(rows, snapshot._current.tail_hash)
+    result_cache.result_cache.clear()
+    assert client.get('/query_all', headers=headers).json == expected
@@ -0,0 +1,34 @@
+from conftest import db, fresh_reads
+
+
+def test_whole_table(client, headers, patients):
+    response = client.get('/stats', headers=headers)
+    assert response.status_code == 200
+    summary = response.json
+    assert summary['count'] == 10
+    # weights are 50.5 to 59.5, genders alternate
+    assert summary['groups']['all']['weight']['min'] == 50.5
+    assert summary['groups']['all']['weight']['max'] == 59.5
+    assert summary['groups']['all']['weight']['mean'] == 55.0
+    assert summary['groups']['female']['count'] + summary['groups']['male']['count'] == 10
+
+
+def test_weight_range_and_bins(client, headers, patients):
+    summary = client.get('/stats?min=53&max=57&bins=4', headers=headers).json
+    assert summary['count'] == 4
+    assert len(summary['histogram_edges']['weight']) == 5
+
+
+def test_bad_parameters_are_refused(client, headers, patients):
+    for query in ('min=abc', 'max=abc', 'min=nan', 'max=inf', 'min=-inf&max=60', 'bins=abc', 'bins=0', 'bins=1000'):
+        assert client.get('/stats?' + query, headers=headers).status_code == 400, query
+
+
+def test_tampered_table_fails(client, headers, patients):
+    cnx = db()
+    cnx.execute("DELETE FROM patients WHERE patient_id = 4")
+    cnx.commit()
+    cnx.close()
+
+    fresh_reads()
+    assert client.get('/stats', headers=headers).status_code == 500
@@ -0,0 +1,70 @@
+import json
+
+import pytest
+
+from app import database, routes
+
+from conftest import db, fresh_reads
+
+
+@pytest.fixture(autouse=True)
+def small_batches(monkeypatch):
+    monkeypatch.setattr(routes, 'STREAM_BATCH_SIZE', 3)
+
+
+def ndjson(client, headers):
+    fresh_reads()
+    response = client.get('/query_all?stream=ndjson', headers=headers)
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def test_ndjson_stream(client, headers, patients):
+    records = ndjson(client, headers)
+    assert [record['data']['patient_id'] for record in records[:-1]] == list(range(1, 11))
+    assert records[-1] == {"type": "trailer", "status": "ok", "rows": 10, "dropped": 0, "last_patient_id": 10}
+    assert [record['data'] for record in records[:-1]] == client.get('/query_all', headers=headers).json
+
+
+def test_json_stream(client, headers, patients):
+    response = client.get('/query_all?stream=json&fields=age', headers=headers)
+    body = json.loads(response.get_data(as_text=True))
+    assert [sorted(row) for row in body['rows']] == [['age', 'patient_id']] * 10
+    assert body['trailer']['status'] == 'ok'
+
+
+def test_bad_format(client, headers):
+    assert client.get('/query_all?stream=xml', headers=headers).status_code == 400
+
+
+def test_deleted_row_ends_the_stream(client, headers, patients):
+    cnx = db()
+    cnx.execute("DELETE FROM patients WHERE patient_id = 5")
+    cnx.commit()
+    cnx.close()
+
+    records = ndjson(client, headers)
+    assert records[-1]['status'] == 'chain_broken'
+    assert records[-1]['patient_id'] == 6
+    assert all(record['data']['patient_id'] < 5 for record in records[:-1])
+
+
+def test_deleted_tail_ends_the_stream(client, headers, patients):
+    cnx = db()
+    cnx.execute("DELETE FROM patients WHERE patient_id = 10")
+    cnx.commit()
+    cnx.close()
+
+    records = ndjson(client, headers)
+    assert records[-1]['status'] == 'chain_broken'
+    assert records[-1]['patient_id'] == 10
+
+
+def test_client_leaving_early_gives_the_connection_back(client, headers, patients):
+    before = database.pool_stats()['in_use']
+    response = client.get('/query_all?stream=ndjson', headers=headers, buffered=False)
+    first = next(response.response)
+    assert json.loads(first)['type'] == 'row'
+    response.close()
+    assert database.pool_stats()['in_use'] == before
@@ -0,0 +1,54 @@
+from app import weight_index
+
+from conftest import db, fresh_reads
+
+
+def query_by_weight(client, headers, low, high):
+    return client.get(f'/query_by_weight?min={low}&max={high}', headers=headers)
+
+
+def test_results_match_the_range(client, headers, patients):
+    response = query_by_weight(client, headers, 53, 57)
+    assert response.status_code == 200
+    # weights are 50.5 + id - 1
+    assert sorted(row['patient_id'] for row in response.json) == [4, 5, 6, 7]
+
+    # the second query is served by the index
+    response = query_by_weight(client, headers, 53, 57)
+    assert sorted(row['patient_id'] for row in response.json) == [4, 5, 6, 7]
+    assert weight_index.weight_index.stats()['verified'] is True
+
+
+def test_new_rows_show_up(client, headers, patients):
+    assert query_by_weight(client, headers, 53, 57).status_code == 200
+    response = client.post('/add_data', headers=headers, json={
+        'first_name': 'New', 'last_name': 'Row', 'gender': True, 'age': 40,
+        'weight': 55.0, 'height': 180, 'health_history': 'new',
+    })
+    assert response.status_code == 201
+
+    response = query_by_weight(client, headers, 53, 57)
+    assert sorted(row['patient_id'] for row in response.json) == [4, 5, 6, 7, 11]
+
+
+def test_row_hidden_from_the_index_fails(client, headers, patients):
+    assert query_by_weight(client, headers, 53, 57).status_code == 200
+
+    # a NULL weight drops row 5 out of any range scan
+    cnx = db()
+    cnx.execute("UPDATE patients SET weight = NULL WHERE patient_id = 5")
+    cnx.commit()
+    cnx.close()
+
+    fresh_reads()
+    assert query_by_weight(client, headers, 53, 57).status_code == 500
+
+
+def test_weight_moved_out_of_range_fails(client, headers, patients):
+    cnx = db()
+    cnx.execute("UPDATE patients SET weight = weight + 1000000000 WHERE patient_id = 5")
+    cnx.commit()
+    cnx.close()
+
+    fresh_reads()
+    assert query_by_weight(client, headers, 53, 57).status_code == 500